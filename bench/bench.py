@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the inventory process against the fake `gcloud`
+
+The inventory runs in-process, end to end, with the fake `gcloud`
+of this directory first on the PATH. Reported:
+
+* wall time of the run
+* time per stage: cumulated over the worker threads, with call counts
+* peak RSS of the process
+* bytes written to the temporary directory and uploaded to the bucket
+
+Usage:
+
+    python bench/bench.py --projects=4 --entries=1000 --latency=0.1
+
+@author: jldupont
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import resource
+import tempfile
+import threading
+from functools import wraps
+from typing import Dict, List
+
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(os.path.dirname(BENCH_DIR), "src")
+
+
+class Stages:
+    """
+    Cumulated time and call count per stage, thread-safe
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.times: Dict[str, float] = {}
+        self.counts: Dict[str, int] = {}
+
+    def add(self, stage: str, duration: float):
+        with self._lock:
+            self.times[stage] = self.times.get(stage, 0.0) + duration
+            self.counts[stage] = self.counts.get(stage, 0) + 1
+
+    def wrap(self, module, name: str, stage: str):
+        fnc = getattr(module, name)
+
+        if fnc.__code__.co_flags & 0x80:  # coroutine function
+
+            @wraps(fnc)
+            async def timed_async(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await fnc(*args, **kwargs)
+                finally:
+                    self.add(stage, time.perf_counter() - start)
+
+            setattr(module, name, timed_async)
+            return
+
+        @wraps(fnc)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fnc(*args, **kwargs)
+            finally:
+                self.add(stage, time.perf_counter() - start)
+
+        setattr(module, name, timed)
+
+
+def get_dir_size(path: str) -> int:
+    total = 0
+    for root, _dirs, files in os.walk(path):
+        total += sum(os.path.getsize(os.path.join(root, name))
+                     for name in files)
+    return total
+
+
+def bench(projects: int = 2,
+          locations: int = 2,
+          fail_locations: int = 1,
+          entries: int = 100,
+          padding: int = 0,
+          latency: float = 0.0,
+          services: str = "",
+          engine: str = "threads",
+          concurrency: int = 8,
+          format: str = "json",
+          incremental: bool = False,
+          page_size: int = 0,
+          loglevel: str = "WARNING",
+          output: str = ""):
+    """
+    Runs the inventory once against the fake `gcloud`
+
+    --projects: number of target projects
+    --locations: number of available locations
+    --fail_locations: number of locations reported as not available
+    --entries: number of entries per listing
+    --padding: characters added to the name of each entry
+    --latency: seconds slept by each fake listing
+    --services: enabled APIs, separated by ';' (default: all supported)
+    --engine: 'threads' or 'asyncio'
+    --concurrency: max concurrency of the listings
+    --format: output format e.g. 'json', 'ndjson.gz'
+    --incremental: reference the files of the previous snapshot
+    --page_size: stream the listings, by pages of this size
+    --loglevel: loglevel of the inventory process
+    --output: path of a JSON file for the results
+    """
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    bucket_dir = os.path.join(workdir, "bucket")
+
+    good: List[str] = [f"l{index}" for index in range(locations)]
+    bad: List[str] = [f"bad{index}" for index in range(fail_locations)]
+
+    fake = {
+        "entries": entries,
+        "padding": padding,
+        "latency": latency,
+        "fail_locations": bad,
+        "bucket": bucket_dir,
+    }
+    if services:
+        fake["services"] = services.split(";")
+
+    os.environ["FAKEGCLOUD"] = json.dumps(fake)
+    os.environ["PATH"] = BENCH_DIR + os.pathsep + os.environ["PATH"]
+    os.environ.update({
+        "TARGETPROJECTID": ";".join(f"bench-{index}"
+                                    for index in range(projects)),
+        "TARGETLOCATIONS": ";".join(good + bad),
+        "TARGETBUCKET": "bench",
+        "TARGETBUCKETPROJECT": "bench",
+        "MAXCONCURRENCY": str(concurrency),
+        "ENGINE": engine,
+        "OUTPUTFORMAT": format,
+        "INCREMENTAL": str(incremental),
+        "PAGESIZE": str(page_size),
+    })
+    #
+    # The caches would skip work across benchmark runs
+    #
+    os.environ.setdefault("NEGATIVECACHETTL", "0")
+    os.environ.setdefault("SERVICESCACHETTL", "0")
+
+    sys.path.insert(0, SRC_DIR)
+    import logger
+    import uploader
+    import proc_inventory
+    from store import get_temp_dir
+
+    logger.set_params(loglevel)
+
+    stages = Stages()
+    stages.wrap(proc_inventory, "resolve_target_projects", "projects")
+    stages.wrap(proc_inventory, "get_project_services", "services")
+    stages.wrap(proc_inventory, "get_listings", "listings")
+    stages.wrap(proc_inventory, "get_listings_async", "listings")
+    stages.wrap(proc_inventory, "store_spec_list", "store")
+    stages.wrap(uploader, "upload_object", "upload")
+    stages.wrap(proc_inventory, "finalize_project", "finalize")
+
+    start = time.perf_counter()
+    proc_inventory.run()
+    wall = time.perf_counter() - start
+
+    results = {
+        "wall_seconds": round(wall, 3),
+        "stages": {
+            stage: {"seconds": round(seconds, 3),
+                    "calls": stages.counts[stage]}
+            for stage, seconds in stages.times.items()
+        },
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "bytes_written": get_dir_size(get_temp_dir()),
+        "bytes_uploaded": get_dir_size(bucket_dir),
+    }
+
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"wall time: {results['wall_seconds']:.3f}s")
+    for stage, dic in results["stages"].items():
+        print(f"  {stage:<10} {dic['seconds']:>9.3f}s {dic['calls']:>6} "
+              "call(s)")
+    print(f"peak RSS: {results['peak_rss_kb']} KB")
+    print(f"bytes written: {results['bytes_written']}")
+    print(f"bytes uploaded: {results['bytes_uploaded']}")
+
+    if output:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    import fire  # type: ignore
+    fire.Fire(bench)
@@ -0,0 +1,186 @@
+"""
+Single-archive snapshots
+
+With `Archive` enabled, the files of a snapshot (the service class
+files, manifest.json, timings.json and config.json) are packed into a
+single object, `{PROJECT}/{TIMESTAMP}/snapshot.archive`, instead of one
+object each: fewer write operations and fewer objects to list.
+
+Layout:
+
+    [member] ... [member] [table of contents] [trailer]
+
+* member: the bytes of a file, as is. A compressed service class file
+  is compressed on its own: a member is read alone.
+* table of contents: JSON, {"Version": 1, "Members": {NAME:
+  {"Offset": ..., "Size": ...}}}, the offsets from the start of the
+  archive
+* trailer: 24 bytes i.e. the offset and the size of the table of
+  contents (big endian, 8 bytes each) then the magic `GCPINVA1`
+
+A member is thus read with a seek in a local copy or with range reads
+from the bucket (see `store.load_archive_member`), without retrieving
+the whole archive.
+
+@author: jldupont
+"""
+import io
+import os
+import json
+import shutil
+import struct
+from typing import Dict, List, Tuple, Union, BinaryIO
+
+
+ARCHIVE_FILE = "snapshot.archive"
+CONTENT_TYPE = "application/octet-stream"
+
+VERSION = 1
+MAGIC = b"GCPINVA1"
+TRAILER = struct.Struct(">QQ8s")
+
+#
+# The tail read first from the bucket: usually holds the
+# table of contents along the trailer
+#
+TAIL_SIZE = 64 * 1024
+
+Members = Dict[str, dict]
+
+
+def pack(path: str, files: List[Tuple[str, str]]) -> Members:
+    """
+    Writes the archive of the files i.e. (member name, local path)
+
+    Returns the table of contents
+    """
+    members: Members = {}
+
+    with open(path, "wb") as out:
+        for name, file_path in files:
+            offset = out.tell()
+            with open(file_path, "rb") as f:
+                shutil.copyfileobj(f, out)
+            members[name] = {"Offset": offset, "Size": out.tell() - offset}
+
+        toc = json.dumps({"Version": VERSION, "Members": members}).encode()
+        offset = out.tell()
+        out.write(toc)
+        out.write(TRAILER.pack(offset, len(toc), MAGIC))
+
+    return members
+
+
+def parse_trailer(data: bytes) -> Tuple[int, int]:
+    """
+    The offset and the size of the table of contents
+    """
+    if len(data) < TRAILER.size:
+        raise ValueError("Not an archive: too short")
+
+    offset, size, magic = TRAILER.unpack(data[-TRAILER.size:])
+    if magic != MAGIC:
+        raise ValueError("Not an archive: invalid trailer")
+    return offset, size
+
+
+def parse_toc(data: bytes) -> Members:
+    toc = json.loads(data)
+    if toc.get("Version") != VERSION:
+        raise ValueError(f"Unsupported archive version: {toc.get('Version')}")
+    return toc["Members"]
+
+
+def read_toc(path: str) -> Members:
+    with open(path, "rb") as f:
+        f.seek(-min(TRAILER.size, os.path.getsize(path)), os.SEEK_END)
+        offset, size = parse_trailer(f.read(TRAILER.size))
+        f.seek(offset)
+        return parse_toc(f.read(size))
+
+
+class MemberReader(io.RawIOBase):
+    """
+    A member of a local archive, as a file of its own
+    """
+
+    def __init__(self, f: BinaryIO, offset: int, size: int):
+        self._f = f
+        self._offset = offset
+        self._size = size
+        self._pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, pos: int, whence: int = io.SEEK_SET) -> int:
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._pos,
+                io.SEEK_END: self._size}[whence]
+        self._pos = max(0, min(self._size, base + pos))
+        return self._pos
+
+    def readinto(self, buffer) -> int:
+        count = min(len(buffer), self._size - self._pos)
+        if count <= 0:
+            return 0
+        self._f.seek(self._offset + self._pos)
+        data = self._f.read(count)
+        buffer[:len(data)] = data
+        self._pos += len(data)
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self._f.close()
+        super().close()
+
+
+def split_member_path(path: str) -> Union[Tuple[str, str], None]:
+    """
+    A member is addressed as a file of the archive seen as a directory
+    e.g. '{ROOT}/{PROJECT}/{TIMESTAMP}/snapshot.archive/manifest.json'
+
+    Returns (path of the archive, member name), None if not a member
+    """
+    archive, _, name = path.rpartition("/")
+    if os.path.basename(archive) != ARCHIVE_FILE or \
+            not os.path.isfile(archive):
+        return None
+    return archive, name
+
+
+def open_member(archive: str, name: str) -> BinaryIO:
+
+    member = read_toc(archive).get(name, None)
+    if member is None:
+        raise FileNotFoundError(f"No member '{name}' in archive: {archive}")
+
+    raw = MemberReader(open(archive, "rb"), member["Offset"], member["Size"])
+    return io.BufferedReader(raw)  # type: ignore
+
+
+def open_binary(path: str) -> BinaryIO:
+    """
+    A file or a member of an archive
+    """
+    member = split_member_path(path)
+    if member is None:
+        return open(path, "rb")
+    return open_member(*member)
+
+
+def get_members(base_path: str) -> Dict[str, str]:
+    """
+    The member names of the archive of a snapshot directory, if any,
+    and their paths
+    """
+    archive = f"{base_path}/{ARCHIVE_FILE}"
+    if not os.path.isfile(archive):
+        return {}
+    return {name: f"{archive}/{name}" for name in read_toc(archive)}
@@ -0,0 +1,159 @@
+"""
+Caches persisted across runs
+
+Cloud Run Job containers are stateless: the caches are stored
+in the bucket alongside the snapshots i.e.
+
+    {PROJECT_ID}/_cache/{NAME}.json
+
+or in a local directory if `CacheDir` is configured.
+
+@author: jldupont
+"""
+import os
+import json
+import time
+import logging
+import threading
+from typing import Dict, List, Union
+from pygcloud.tools import mkdir  # type: ignore
+from models import Config
+from cmds import cat_object
+from store import get_temp_dir
+from uploader import upload_object
+
+
+info = logging.info
+error = logging.error
+
+
+def get_cache_object_path(project: str, name: str) -> str:
+    return f"{project}/_cache/{name}.json"
+
+
+def load_cache(config: Config, project: str, name: str) -> dict:
+    """
+    An empty cache is returned if it is not available
+    """
+    object_path = get_cache_object_path(project, name)
+
+    try:
+        if config.CacheDir:
+            path = f"{config.CacheDir}/{object_path}"
+            if not os.path.exists(path):
+                return {}
+            with open(path, "r") as f:
+                return json.load(f)
+
+        result = cat_object(config.TargetBucketProject,
+                            config.TargetBucket,
+                            object_path)
+        if not result.success:
+            return {}
+        return json.loads(result.message)
+
+    except Exception as e:
+        error(f"! Unable to load cache '{object_path}': {e}")
+        return {}
+
+
+def save_cache(config: Config, project: str, name: str, dic: dict):
+    """
+    Failing to save a cache is not fatal: it is only logged
+    """
+    object_path = get_cache_object_path(project, name)
+    base_dir = config.CacheDir or get_temp_dir()
+    path = f"{base_dir}/{object_path}"
+
+    try:
+        mkdir(os.path.dirname(path))
+        with open(path, "w") as f:
+            json.dump(dic, f)
+    except Exception as e:
+        error(f"! Unable to write cache '{path}': {e}")
+        return
+
+    if config.CacheDir:
+        return
+
+    result = upload_object(config, path, object_path, "application/json")
+    if not result.success:
+        error(f"! Unable to upload cache '{object_path}': {result.message}")
+
+
+SERVICES_CACHE_NAME = "services"
+
+
+def load_services_cache(config: Config,
+                        project: str) -> Union[List[str], None]:
+    """
+    The names of the supported service classes enabled in a project
+
+    None is returned if the cache is missing or older than
+    `ServicesCacheTtl`
+    """
+    dic = load_cache(config, project, SERVICES_CACHE_NAME)
+
+    timestamp = dic.get("Timestamp", 0)
+    if timestamp + config.ServicesCacheTtl <= time.time():
+        return None
+
+    return dic.get("ServiceClasses", None)
+
+
+def save_services_cache(config: Config, project: str, names: List[str]):
+    save_cache(config, project, SERVICES_CACHE_NAME,
+               {"Timestamp": time.time(), "ServiceClasses": names})
+
+
+class NegativeCache:
+    """
+    The (service class, location) pairs known to be unavailable
+    in a project, each with an expiry time (epoch seconds)
+
+    Expired entries are listed again i.e. re-probed.
+    """
+
+    NAME = "negative"
+
+    def __init__(self, ttl: int,
+                 entries: Union[Dict[str, float], None] = None):
+        self.ttl = ttl
+        self.entries: Dict[str, float] = entries or {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(service_class_name: str, location: Union[str, None]) -> str:
+        return f"{service_class_name}@{location}"
+
+    def is_unavailable(self, service_class_name: str,
+                       location: Union[str, None]) -> bool:
+        key = self.key(service_class_name, location)
+        return self.entries.get(key, 0) > time.time()
+
+    def record(self, service_class_name: str,
+               location: Union[str, None],
+               unavailable: bool):
+        key = self.key(service_class_name, location)
+        with self._lock:
+            if unavailable:
+                self.entries[key] = time.time() + self.ttl
+            else:
+                self.entries.pop(key, None)
+
+    def to_dict(self) -> dict:
+        now = time.time()
+        with self._lock:
+            return {key: expiry for key, expiry in self.entries.items()
+                    if expiry > now}
+
+    @classmethod
+    def load(cls, config: Config, project: str) -> "NegativeCache":
+        entries = load_cache(config, project, cls.NAME)
+        cache = cls(config.NegativeCacheTtl, entries)
+        info(f"> Negative cache of project '{project}': "
+             f"{len(cache.to_dict())} entries")
+        return cache
+
+    def save(self, config: Config, project: str):
+        save_cache(config, project, self.NAME, self.to_dict())
@@ -1,26 +1,234 @@
 """
 @author: jldupont
 """
+import sys
+import json
+import time
+import asyncio
 import logging
-from typing import List, Union
+from typing import List, Tuple, Union
 from pygcloud.core import GCloud  # type: ignore
 from pygcloud.models import Result, OptionalParam, GCPService  # type: ignore
 from pygcloud.gcp.models import Spec  # type: ignore
-from models import Config
+from pygcloud.utils import prepare_params, split_head_tail  # type: ignore
+from dataclasses import fields, MISSING
+from models import Config, Span, ServiceClassConfig
+from timings import span
+from ratelimit import get_limiter, is_retryable
 
 
 error = logging.error
+warning = logging.warning
 info = logging.info
+debug = logging.debug
+
+DEFAULT_TIMEOUT = 300
+CHUNK_SIZE = 64 * 1024
+
+ENV_VARS_DELIMITER = "^##^"
+
+STATUS_OK = "ok"
+STATUS_UNAVAILABLE = "unavailable"
+STATUS_FAILED = "failed"
+STATUS_THROTTLED = "throttled"
+
+
+class Listing(list):
+    """
+    The specs of a listing along with its status:
+
+    * ok
+    * unavailable: the service is not available in the location
+    * failed: listing or parsing error
+    * throttled: the API quota is exhausted, the listing is retried
+      (see `ratelimit`) else reported as failed
+    """
+
+    def __init__(self, specs=(), status: str = STATUS_OK):
+        super().__init__(specs)
+        self.status = status
 
 
 def get_inventory(project: str,
                   service_class: GCPService,
                   location: Union[str, None] = None,
-                  exit_on_error: bool = False
+                  exit_on_error: bool = False,
+                  backend: str = "gcloud",
+                  page_size: int = 0,
+                  selection: Union[ServiceClassConfig, None] = None,
+                  argv: Union[Tuple[str, ...], None] = None
                   ) -> List[Spec]:
+    """
+    backend: 'gcloud' i.e. one `gcloud ... list` process per listing
+             or 'rest' i.e. direct calls to the list endpoints
+    page_size: with 'gcloud', the listing is retrieved by pages and
+               parsed as it is produced (see `stream`)
+    selection: with 'gcloud', filter & fields applied server side.
+               With 'rest', applied to the service classes without
+               endpoint, listed through gcloud.
+    argv: the `gcloud` command compiled in the plan (see `plan`),
+          else built from the above
+
+    The listing is paced and retried when throttled, see `ratelimit`
+    """
+    limiter = get_limiter()
+    attempt = 0
+
+    while True:
+        delay = limiter.reserve(service_class)
+        if delay is None:
+            return deadline_passed(project, service_class)
+        time.sleep(delay)
+
+        listing = _get_inventory(project, service_class, location,
+                                 exit_on_error, backend, page_size,
+                                 selection, argv)
+
+        delay = retry_delay(project, service_class, listing, attempt)
+        if delay is None:
+            return listing
+        time.sleep(delay)
+        attempt += 1
+
+
+def _get_inventory(project: str,
+                   service_class: GCPService,
+                   location: Union[str, None],
+                   exit_on_error: bool,
+                   backend: str,
+                   page_size: int,
+                   selection: Union[ServiceClassConfig, None],
+                   argv: Union[Tuple[str, ...], None]
+                   ) -> List[Spec]:
+
+    if backend == "rest":
+        from rest import get_inventory_rest
+        return get_inventory_rest(project, service_class, location,
+                                  page_size, selection)
+
+    if page_size > 0:
+        from stream import get_inventory_streamed
+        return get_inventory_streamed(project, service_class, location,
+                                      page_size, selection,
+                                      argv)  # type: ignore
+
+    cmd = get_cmd_from_argv(argv, exit_on_error) if argv else \
+        get_cmd_list(project, service_class, location, exit_on_error,
+                     selection=selection)
+
+    with span("list", project, service_class.__name__, location) as _span:
+        result: Result = cmd()
+        record_result(_span, result)
+
+    return parse_listing(project, service_class, location, result)
+
+
+async def get_inventory_async(project: str,
+                              service_class: GCPService,
+                              location: Union[str, None] = None,
+                              timeout: float = DEFAULT_TIMEOUT,
+                              page_size: int = 0,
+                              selection: Union[ServiceClassConfig,
+                                               None] = None,
+                              argv: Union[Tuple[str, ...], None] = None
+                              ) -> List[Spec]:
+    """
+    Same as `get_inventory` but the `gcloud` process is driven
+    by the running event loop
+    """
+    limiter = get_limiter()
+    attempt = 0
+
+    while True:
+        delay = limiter.reserve(service_class)
+        if delay is None:
+            return deadline_passed(project, service_class)
+        await asyncio.sleep(delay)
+
+        listing = await _get_inventory_async(project, service_class,
+                                             location, timeout, page_size,
+                                             selection, argv)
+
+        delay = retry_delay(project, service_class, listing, attempt)
+        if delay is None:
+            return listing
+        await asyncio.sleep(delay)
+        attempt += 1
+
+
+async def _get_inventory_async(project: str,
+                               service_class: GCPService,
+                               location: Union[str, None],
+                               timeout: float,
+                               page_size: int,
+                               selection: Union[ServiceClassConfig, None],
+                               argv: Union[Tuple[str, ...], None]
+                               ) -> List[Spec]:
+
+    if page_size > 0:
+        from stream import get_inventory_streamed_async
+        return await get_inventory_streamed_async(
+            project, service_class, location, page_size,
+            timeout, selection, argv)  # type: ignore
+
+    cmd = get_cmd_from_argv(argv) if argv else \
+        get_cmd_list(project, service_class, location, selection=selection)
+
+    with span("list", project, service_class.__name__, location) as _span:
+        result: Result = await exec_async(cmd, timeout)
+        record_result(_span, result)
+
+    return parse_listing(project, service_class, location, result)
+
+
+def retry_delay(project: str,
+                service_class: GCPService,
+                listing: List[Spec],
+                attempt: int) -> Union[float, None]:
+    """
+    The seconds to wait before retrying a throttled listing, else None
 
-    cmd = get_cmd_list(project, service_class, location, exit_on_error)
-    result: Result = cmd()
+    A throttled listing that is not retried is reported as failed.
+    """
+    if getattr(listing, "status", STATUS_OK) != STATUS_THROTTLED:
+        return None
+
+    delay = get_limiter().backoff(project, service_class, attempt)
+    if delay is None:
+        error(f"Failed to list {service_class.__name__}: throttled")
+        listing.status = STATUS_FAILED  # type: ignore
+    return delay
+
+
+def deadline_passed(project: str, service_class: GCPService) -> Listing:
+    error(f"Failed to list {service_class.__name__} of project "
+          f"'{project}': deadline passed")
+    return Listing(status=STATUS_FAILED)
+
+
+def record_result(_span: Span, result: Result):
+    _span.Bytes = len(result.message or "")
+    _span.Status = STATUS_OK if result.success else STATUS_FAILED
+
+
+def parse_listing(project: str,
+                  service_class: GCPService,
+                  location: Union[str, None],
+                  result: Result) -> Listing:
+    """
+    `parse_inventory_result` within a timing span
+    """
+    with span("parse", project, service_class.__name__, location) as _span:
+        specs = parse_inventory_result(service_class, location, result)
+        _span.Entries = len(specs)
+        _span.Status = specs.status
+
+    return specs
+
+
+def parse_inventory_result(service_class: GCPService,
+                           location: Union[str, None],
+                           result: Result) -> Listing:
 
     #
     # I am choosing to log errors here instead of deferring to the caller:
@@ -30,10 +238,14 @@ def get_inventory(project: str,
         if "INVALID_ARGUMENT: Location" in result.message:
             info(f"! {service_class.__name__} does appear "
                  f"to be available in location: {location}")
-            return []
+            return Listing(status=STATUS_UNAVAILABLE)
+
+        if is_retryable(result.message, result.code):
+            warning(f"! {service_class.__name__} throttled: {result.message}")
+            return Listing(status=STATUS_THROTTLED)
 
         error(f"Failed to list {service_class.__name__}: {result.message}")
-        return []
+        return Listing(status=STATUS_FAILED)
 
     spec_class: Spec = service_class.SPEC_CLASS  # type: ignore
 
@@ -42,19 +254,98 @@ def get_inventory(project: str,
     except Exception as e:
         error("! Failed to parse entries related to "
               f"{service_class.__name__}: {e}")
-        return []
+        return Listing(status=STATUS_FAILED)
+
+    return Listing(specs)
 
-    return specs
+
+def get_cmd_args(cmd: GCloud) -> List[str]:
+    """
+    The complete argument vector of a command, executable included
+    """
+    head, tail = split_head_tail(cmd.head_tail)
+    return prepare_params([cmd._exec_path] + head + tail)
+
+
+def get_cmd_from_argv(argv: Tuple[str, ...],
+                      exit_on_error: bool = False) -> GCloud:
+    """
+    The command of a complete argument vector, see `get_cmd_args`
+    """
+    return GCloud(*argv[1:], cmd=argv[0], exit_on_error=exit_on_error)
+
+
+async def exec_async(cmd: GCloud, timeout: float = DEFAULT_TIMEOUT) -> Result:
+    """
+    Execute a command in a subprocess managed by the running event loop
+
+    The output is streamed from the pipes as it is produced.
+    The process is killed if it does not complete within `timeout` seconds.
+    The error handling options of the command
+    (i.e. exit_on_error, log_error) are honored.
+    """
+    args: List[str] = get_cmd_args(cmd)
+    debug(f"exec_async: {args}")
+
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            *args,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE)
+    except FileNotFoundError:
+        raise FileNotFoundError(f"Command not found: {args[0]}")
+
+    async def _read(stream) -> bytes:
+        chunks: List[bytes] = []
+        while chunk := await stream.read(CHUNK_SIZE):
+            chunks.append(chunk)
+        return b"".join(chunks)
+
+    try:
+        stdout, stderr = await asyncio.wait_for(
+            asyncio.gather(_read(proc.stdout), _read(proc.stderr)),
+            timeout)
+        code = await proc.wait()
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+        stdout = b""
+        stderr = f"Timeout after {timeout}s: {' '.join(args)}".encode()
+        code = -1
+
+    if code == 0:
+        result = Result(success=True,
+                        message=stdout.decode().strip(), code=0)
+    else:
+        result = Result(success=False,
+                        message=stderr.decode().strip(), code=code)
+
+    if not result.success:
+        if cmd._log_error:
+            error(f"Error executing command: {args}: {result.message}")
+        if cmd._exit_on_error:
+            sys.exit(result.code)
+
+    return result
 
 
 def get_cmd_list(project: str,
                  service_class: GCPService,
                  location: Union[str, None] = None,
-                 exit_on_error: bool = False
+                 exit_on_error: bool = False,
+                 page_size: int = 0,
+                 selection: Union[ServiceClassConfig, None] = None
                  ) -> GCloud:
+    """
+    page_size: the entries are retrieved, and printed, by pages
+    selection: `--filter` and `--format json(...)` projection
+    """
 
-    group = service_class.GROUP
-    group.extend(service_class.GROUP_SUB_DESCRIBE)
+    #
+    # Do not extend `GROUP` in place: it is class state shared
+    # across all the calls, including those running in parallel
+    #
+    group = service_class.GROUP + service_class.GROUP_SUB_DESCRIBE
 
     where = "--region"
 
@@ -65,11 +356,115 @@ def get_cmd_list(project: str,
     return GCloud(group, "list",
                   "--project", project,
                   OptionalParam(where, location),
-                  "--format", "json",
+                  OptionalParam("--page-size", str(page_size)
+                                if page_size > 0 else None),
+                  OptionalParam("--filter", selection.Filter
+                                if selection is not None else None),
+                  "--format", get_format(service_class, selection),
                   cmd="gcloud",
                   exit_on_error=exit_on_error)
 
 
+def get_required_fields(service_class: GCPService) -> List[str]:
+    """
+    The fields without a default value in the spec of a service class
+    """
+    return [
+        _field.name for _field in fields(service_class.SPEC_CLASS)
+        if _field.default is MISSING and _field.default_factory is MISSING
+    ]
+
+
+def get_selected_fields(service_class: GCPService,
+                        selection: Union[ServiceClassConfig, None]
+                        ) -> Union[List[str], None]:
+    """
+    The fields selected, including the required ones,
+    or None if all fields are retained
+    """
+    if selection is None or len(selection.Fields) == 0:
+        return None
+
+    selected: List[str] = list(selection.Fields)
+    for name in get_required_fields(service_class):
+        if name not in selected:
+            selected.append(name)
+    return selected
+
+
+def get_format(service_class: GCPService,
+               selection: Union[ServiceClassConfig, None]) -> str:
+    """
+    https://cloud.google.com/sdk/gcloud/reference/topic/projections
+    """
+    selected = get_selected_fields(service_class, selection)
+    if selected is None:
+        return "json"
+    return f"json({','.join(selected)})"
+
+
+def get_cmd_projects_list(filter: str) -> GCloud:
+    return GCloud("projects", "list",
+                  "--filter", filter,
+                  "--format", "json",
+                  cmd="gcloud",
+                  exit_on_error=False,
+                  log_error=True)
+
+
+def resolve_target_projects(target: str) -> List[str]:
+    """
+    Resolve the target projects specification i.e. a ';' separated
+    list of entries, each of which being:
+
+    * a project id
+    * folder:$FOLDER_ID   : the active projects directly in the folder
+    * label:$KEY=$VALUE   : the active projects holding the label
+
+    The selectors are resolved once, at the start of the run.
+    """
+    projects: List[str] = []
+
+    for entry in target.split(";"):
+        entry = entry.strip()
+        if entry == "":
+            continue
+
+        kind, _, value = entry.partition(":")
+
+        if kind == "folder":
+            filter = f"parent.type=folder AND parent.id={value}"
+        elif kind == "label":
+            key, _, label_value = value.partition("=")
+            filter = f"labels.{key}={label_value}"
+        else:
+            projects.append(entry)
+            continue
+
+        cmd = get_cmd_projects_list(
+            f"{filter} AND lifecycleState=ACTIVE")
+        result: Result = cmd()
+
+        if not result.success:
+            error(f"Failed to resolve projects from '{entry}': "
+                  f"{result.message}")
+            continue
+
+        resolved = [item["projectId"] for item in json.loads(result.message)]
+        info(f"> Projects resolved from '{entry}': {resolved}")
+        projects.extend(resolved)
+
+    return list(dict.fromkeys(projects))
+
+
+def get_cmd_project_describe(config: Config) -> GCloud:
+    return GCloud("projects", "describe", config.ProjectId,
+                  "--format", "json",
+                  cmd="gcloud",
+                  exit_on_error=False,
+                  log_error=False)
+
+
 def get_cmd_storage_bucket_describe(config: Config, bucket: str) -> GCloud:
     return GCloud("storage", "buckets", "describe", f"gs://{bucket}",
                   "--project", config.TargetBucketProject,
@@ -119,6 +514,43 @@ def check_if_cloud_run_job_exists(config: Config) -> bool:
     return result.success
 
 
+def get_env_vars(config: Config) -> str:
+    """
+    The configuration of the inventory process, as environment variables
+
+    The values may contain commas (e.g. JSON): an alternate
+    delimiter is used, see `gcloud topic escaping`
+    """
+    env_vars = {
+        "TARGETPROJECTID": config.TargetProjectId,
+        "TARGETLOCATIONS": config.TargetLocations,
+        "TARGETBUCKET": config.TargetBucket,
+        "TARGETBUCKETPROJECT": config.TargetBucketProject,
+        "MAXCONCURRENCY": config.MaxConcurrency,
+        "ENGINE": config.Engine,
+        "LISTINGTIMEOUT": config.ListingTimeout,
+        "BACKEND": config.Backend,
+        "INCREMENTAL": config.Incremental,
+        "OUTPUTFORMAT": config.OutputFormat,
+        "ARCHIVE": config.Archive,
+        "NEGATIVECACHETTL": config.NegativeCacheTtl,
+        "SERVICESCACHETTL": config.ServicesCacheTtl,
+        "PAGESIZE": config.PageSize,
+        "RATELIMIT": config.RateLimit,
+        "RATEBURST": config.RateBurst,
+        "MAXRETRIES": config.MaxRetries,
+        "BACKOFFBASE": config.BackoffBase,
+        "BACKOFFMAX": config.BackoffMax,
+        "DEADLINE": config.Deadline,
+        "SERVICECLASSES": json.dumps({
+            name: selection.to_dict()
+            for name, selection in config.ServiceClasses.items()
+        }),
+    }
+    return ENV_VARS_DELIMITER + ENV_VARS_DELIMITER[1:-1].join(
+        f"{key}={value}" for key, value in env_vars.items())
+
+
 def get_cmd_cloud_run_job_create_or_update(config: Config,
                                            exists_already: bool) -> GCloud:
     """
@@ -132,13 +564,10 @@ def get_cmd_cloud_run_job_create_or_update(config: Config,
                   "--image",
                   "docker.io/jldupont/gcp-inventory"
                   f":{config.ContainerRelease}",
-                  "--set-env-vars",
-                  f"TARGETPROJECTID={config.TargetProjectId},"
-                  f"TARGETLOCATIONS={config.TargetLocations},"
-                  f"TARGETBUCKET={config.TargetBucket},"
-                  f"TARGETBUCKETPROJECT={config.TargetBucketProject}",
+                  "--set-env-vars", get_env_vars(config),
                   OptionalParam("--service-account",
                                 config.ServiceAccountEmail),
+                  "--tasks", str(config.TaskCount),
                   cmd="gcloud",
                   exit_on_error=False,
                   log_error=True)
@@ -215,3 +644,106 @@ def upload_path_recursive(target_project: str,
                  exit_on_error=False)
     result: Result = cmd()
     return result
+
+
+def upload_files(target_project: str,
+                 target_bucket: str,
+                 file_paths: List[str],
+                 object_prefix: str,
+                 content_type: Union[str, None] = None,
+                 content_encoding: Union[str, None] = None) -> Result:
+    """
+    Upload local files under a GCS bucket object prefix
+    with the specified object metadata
+    """
+    cmd = GCloud("storage", "cp", *file_paths,
+                 f"gs://{target_bucket}/{object_prefix}",
+                 "--project", target_project,
+                 OptionalParam("--content-type", content_type),
+                 OptionalParam("--content-encoding", content_encoding),
+                 cmd="gcloud",
+                 exit_on_error=False)
+    result: Result = cmd()
+    return result
+
+
+def create_object(target_project: str,
+                  target_bucket: str,
+                  file_path: str,
+                  object_path: str) -> Result:
+    """
+    Upload a local file to a GCS bucket object only if the object
+    does not exist yet: fails otherwise
+    """
+    cmd = GCloud("storage", "cp", file_path,
+                 f"gs://{target_bucket}/{object_path}",
+                 "--project", target_project,
+                 "--if-generation-match=0",
+                 cmd="gcloud",
+                 exit_on_error=False,
+                 log_error=False)
+    result: Result = cmd()
+    return result
+
+
+def list_objects(target_project: str,
+                 target_bucket: str,
+                 prefix: str) -> List[str]:
+    """
+    The paths of the GCS bucket objects under a prefix
+    """
+    cmd = GCloud("storage", "ls",
+                 f"gs://{target_bucket}/{prefix}",
+                 "--project", target_project,
+                 cmd="gcloud",
+                 exit_on_error=False,
+                 log_error=False)
+    result: Result = cmd()
+    if not result.success:
+        return []
+
+    head = f"gs://{target_bucket}/"
+    return [line.strip()[len(head):] for line in result.message.splitlines()
+            if line.strip().startswith(head)]
+
+
+def cat_object_range(target_project: str,
+                     target_bucket: str,
+                     object_path: str,
+                     byte_range: str) -> Union[bytes, None]:
+    """
+    Retrieve a byte range of a GCS bucket object e.g. '0-99' or
+    '-24' (the last 24 bytes), as is: the content may be binary
+
+    Returns None on failure
+    """
+    import subprocess
+    cmd = GCloud("storage", "cat",
+                 f"gs://{target_bucket}/{object_path}",
+                 f"--range={byte_range}",
+                 "--project", target_project,
+                 cmd="gcloud")
+    args: List[str] = get_cmd_args(cmd)
+    debug(f"cat_object_range: {args}")
+
+    proc = subprocess.run(args, capture_output=True)
+    if proc.returncode != 0:
+        debug(f"cat_object_range: {proc.stderr.decode().strip()}")
+        return None
+    return proc.stdout
+
+
+def cat_object(target_project: str,
+               target_bucket: str,
+               object_path: str) -> Result:
+    """
+    Retrieve the content of a GCS bucket object
+    """
+    cmd = GCloud("storage", "cat",
+                 f"gs://{target_bucket}/{object_path}",
+                 "--project", target_project,
+                 cmd="gcloud",
+                 exit_on_error=False,
+                 log_error=False)
+    result: Result = cmd()
+    return result
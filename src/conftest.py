@@ -0,0 +1,52 @@
+"""
+Fixtures shared by the tests
+
+@author: jldupont
+"""
+import os
+import pytest
+
+
+class FakeSpec:
+    """
+    Stands for a pygcloud `Spec`
+    """
+
+    def __init__(self, **kw):
+        self.kw = kw
+
+    def to_dict(self):
+        return self.kw
+
+
+@pytest.fixture
+def fake_spec():
+    return FakeSpec
+
+
+@pytest.fixture
+def temp_dir(tmp_path, monkeypatch) -> str:
+    """
+    The files of the run are written under `tmp_path`
+    """
+    import store
+    monkeypatch.setattr(store, "TEMPDIR", str(tmp_path))
+    return str(tmp_path)
+
+
+@pytest.fixture
+def fake_gcloud(tmp_path, monkeypatch):
+    """
+    Factory: installs a script as 'gcloud', first on the PATH
+
+    Returns the path of the script.
+    """
+    def install(script: str):
+        path = tmp_path / "gcloud"
+        path.write_text(script)
+        path.chmod(0o755)
+        monkeypatch.setenv("PATH",
+                           f"{tmp_path}{os.pathsep}{os.environ['PATH']}")
+        return path
+
+    return install
@@ -0,0 +1,203 @@
+"""
+Differences between two snapshots of a project
+
+The resources are keyed by their stable identity (selfLink, else name,
+see `utils.get_resource_id`) and compared through the hash of their
+canonical form: only the resources whose hashes differ are compared
+field by field, in a second pass over the files concerned.
+
+Service classes whose manifest entries are identical in both snapshots
+(i.e. same file, see incremental snapshots) are not read at all.
+
+@author: jldupont
+"""
+import os
+import json
+import logging
+from typing import List, Dict, Tuple, Union, Set, Any
+from store import get_local_snapshots, get_local_spec_list_paths, \
+    read_spec_dicts, load_local_json
+from utils import get_resource_id, get_canonical_hash
+
+
+info = logging.info
+
+Change = Dict[str, Any]
+
+
+def get_latest_timestamp(root: str, project: str) -> Union[str, None]:
+    """
+    From the 'latest.json' of the project, else the last complete snapshot
+    """
+    path = f"{root}/{project}/latest.json"
+    if os.path.exists(path):
+        with open(path, "r") as f:
+            return json.load(f)["Timestamp"]
+
+    snapshots = get_local_snapshots(root, project)
+    return snapshots[-1][1] if snapshots else None
+
+
+def resolve_timestamp(root: str, project: str,
+                      ts: Union[str, None] = None) -> str:
+    """
+    The timestamp of a complete snapshot of the project in a local copy
+    of the bucket, by default the latest
+
+    'fire' passes numeric looking timestamps as numbers.
+    """
+    if ts is None:
+        latest = get_latest_timestamp(root, project)
+        if latest is None:
+            raise ValueError(f"No snapshot found for project '{project}'")
+        return latest
+
+    ts = str(ts)
+    if (project, ts) not in get_local_snapshots(root, project):
+        raise ValueError(f"No snapshot '{ts}' found for project '{project}'")
+    return ts
+
+
+def get_previous_timestamp(root: str, project: str,
+                           ts: str) -> Union[str, None]:
+    previous = [_ts for _, _ts in get_local_snapshots(root, project)
+                if _ts < ts]
+    return previous[-1] if previous else None
+
+
+def load_manifest(root: str, project: str, ts: str) -> dict:
+    return load_local_json(f"{root}/{project}/{ts}", "manifest.json") or {}
+
+
+def get_hashes(path: Union[str, None]) -> Dict[str, str]:
+    """
+    The canonical hash of each resource of a service class file
+    """
+    if path is None:
+        return {}
+    return {get_resource_id(dic): get_canonical_hash(dic)
+            for dic in read_spec_dicts(path)}
+
+
+def get_entries(path: str, ids: Set[str]) -> Dict[str, dict]:
+    return {resource_id: dic for dic in read_spec_dicts(path)
+            if (resource_id := get_resource_id(dic)) in ids}
+
+
+def diff_values(old: Any, new: Any, path: str = "") -> List[Change]:
+    """
+    The field level changes between two JSON values
+
+    Lists are compared by position.
+    """
+    if isinstance(old, dict) and isinstance(new, dict):
+        changes: List[Change] = []
+        for key in sorted(set(old) | set(new), key=str):
+            _path = f"{path}.{key}" if path else str(key)
+            if key not in old:
+                changes.append({"Path": _path, "New": new[key]})
+            elif key not in new:
+                changes.append({"Path": _path, "Old": old[key]})
+            else:
+                changes.extend(diff_values(old[key], new[key], _path))
+        return changes
+
+    if isinstance(old, list) and isinstance(new, list):
+        changes = []
+        for index in range(max(len(old), len(new))):
+            _path = f"{path}[{index}]"
+            if index >= len(old):
+                changes.append({"Path": _path, "New": new[index]})
+            elif index >= len(new):
+                changes.append({"Path": _path, "Old": old[index]})
+            else:
+                changes.extend(diff_values(old[index], new[index], _path))
+        return changes
+
+    if old == new:
+        return []
+
+    return [{"Path": path, "Old": old, "New": new}]
+
+
+def diff_service_class(old_path: Union[str, None],
+                       new_path: Union[str, None]) -> dict:
+
+    old_hashes = get_hashes(old_path)
+    new_hashes = get_hashes(new_path)
+
+    changed = {resource_id for resource_id, digest in new_hashes.items()
+               if resource_id in old_hashes
+               and old_hashes[resource_id] != digest}
+
+    old_entries = get_entries(old_path, changed) if changed else {}
+    new_entries = get_entries(new_path, changed) if changed else {}
+
+    return {
+        "Added": sorted(set(new_hashes) - set(old_hashes)),
+        "Removed": sorted(set(old_hashes) - set(new_hashes)),
+        "Changed": [
+            {"Id": resource_id,
+             "Changes": diff_values(old_entries[resource_id],
+                                    new_entries[resource_id])}
+            for resource_id in sorted(changed)
+        ],
+    }
+
+
+def diff_snapshots(root: str, project: str,
+                   old_ts: str, new_ts: str) -> dict:
+    """
+    The resources added, removed and changed, per service class,
+    from the snapshot `old_ts` to the snapshot `new_ts`
+    """
+    old_paths = get_local_spec_list_paths(root, project, old_ts)
+    new_paths = get_local_spec_list_paths(root, project, new_ts)
+
+    old_manifest = load_manifest(root, project, old_ts)
+    new_manifest = load_manifest(root, project, new_ts)
+
+    result: Dict[str, dict] = {}
+
+    for name in sorted(set(old_paths) | set(new_paths)):
+        old_path = old_paths.get(name, None)
+        new_path = new_paths.get(name, None)
+
+        old_entry = old_manifest.get(name, None)
+        if old_entry is not None and old_entry == new_manifest.get(name):
+            info(f"> {name}: unchanged")
+            continue
+
+        changes = diff_service_class(old_path, new_path)
+        if any(changes.values()):
+            result[name] = changes
+
+        info(f"> {name}: {len(changes['Added'])} added, "
+             f"{len(changes['Removed'])} removed, "
+             f"{len(changes['Changed'])} changed")
+
+    return {
+        "Project": project,
+        "From": old_ts,
+        "To": new_ts,
+        "ServiceClasses": result,
+    }
+
+
+def resolve_timestamps(root: str, project: str,
+                       old_ts: Union[str, None],
+                       new_ts: Union[str, None]) -> Tuple[str, str]:
+    """
+    By default, the latest snapshot against the previous one
+    """
+    new_ts = resolve_timestamp(root, project, new_ts)
+
+    if old_ts is not None:
+        return resolve_timestamp(root, project, old_ts), new_ts
+
+    old_ts = get_previous_timestamp(root, project, new_ts)
+    if old_ts is None:
+        raise ValueError(f"No snapshot prior to '{new_ts}' found "
+                         f"for project '{project}'")
+
+    return old_ts, new_ts
@@ -0,0 +1,162 @@
+"""
+Concurrent execution of the listing tasks
+
+Each task of the plan, i.e. (project, service class, location), is
+listed through its own `gcloud ... list` invocation: these are
+independent of one another and are thus performed concurrently,
+bounded by `max_concurrency`.
+
+Two engines are available:
+* threads: a pool of worker threads, each blocking on one listing
+* asyncio: a single event loop driving all the listing subprocesses
+
+@author: jldupont
+"""
+import asyncio
+import logging
+import threading
+from itertools import chain
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, Future, as_completed
+from typing import List, Tuple, Union, Dict, Iterator, Iterable, Callable, \
+    Sequence
+from pygcloud.models import GCPService  # type: ignore
+from pygcloud.gcp.models import Spec  # type: ignore
+from models import PlanTask
+
+
+info = logging.info
+
+Task = Tuple[GCPService, Union[str, None]]
+Submit = Callable[..., Future]
+
+
+def get_tasks(service_class: GCPService, locations: str) -> List[Task]:
+    """
+    The listing tasks required for a service class
+
+    Service classes requiring a location are listed
+    once per configured location.
+    """
+    if not service_class.LISTING_REQUIRES_LOCATION:
+        return [(service_class, None)]
+
+    location_list: List[str] = locations.split(";")
+    return [(service_class, location) for location in location_list]
+
+
+@contextmanager
+def thread_pool(max_concurrency: int) -> Iterator[Submit]:
+
+    with ThreadPoolExecutor(max_workers=max_concurrency) as pool:
+        yield pool.submit
+
+
+@contextmanager
+def event_loop(max_concurrency: int) -> Iterator[Submit]:
+    """
+    The event loop runs in its own thread so that results
+    can be consumed, through regular futures, as they complete
+    """
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def bounded(fnc, *args):
+        async with semaphore:
+            return await fnc(*args)
+
+    def submit(fnc, *args) -> Future:
+        return asyncio.run_coroutine_threadsafe(bounded(fnc, *args), loop)
+
+    try:
+        yield submit
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+
+ENGINES = {
+    "threads": thread_pool,
+    "asyncio": event_loop,
+}
+
+
+def get_execution_order(plan: Sequence[PlanTask]) -> List[PlanTask]:
+    """
+    The tasks not skipped, longest first. A task without history
+    costs the average of its project (see `plan.compile_plan`):
+    only the projects without any history come last, in plan order.
+    """
+    return sorted((task for task in plan if not task.Skipped),
+                  key=lambda task: -(task.Cost or 0.0))
+
+
+def merge(results: List[Iterable[Spec]]) -> Iterable[Spec]:
+    """
+    The entries of the listings of a service class, in order
+    """
+    if all(isinstance(result, list) for result in results):
+        return [spec for result in results for spec in result]
+    return chain.from_iterable(results)
+
+
+def execute(plan: Sequence[PlanTask],
+            fnc: Callable[[PlanTask], Iterable[Spec]],
+            max_concurrency: int = 1,
+            engine: str = "threads"
+            ) -> Iterator[Tuple[str, GCPService, Iterable[Spec]]]:
+    """
+    Runs `fnc(task)` for all the tasks of the plan (see `plan`) that
+    are not skipped, longest first, and yields (project, service_class,
+    specs) as soon as all the listings of the service class complete:
+    its file is stored and uploaded while the other listings run.
+    The service classes with all their tasks skipped come first.
+
+    The projects share the same workers.
+    With the 'asyncio' engine, `fnc` must be a coroutine function.
+
+    The entries of a service class are merged in the order of the
+    locations: the files are thus identical to a sequential run.
+    Listings that are not lists (i.e. streamed) are merged lazily:
+    the consumer reads them through.
+    """
+    Group = Tuple[str, GCPService]
+
+    tasks: Dict[Group, List[PlanTask]] = {}
+    for task in plan:
+        tasks.setdefault((task.Project, task.ServiceClass), []).append(task)
+
+    order = get_execution_order(plan)
+    info(f"> Executing {len(order)} listing task(s) with engine '{engine}' "
+         f"and max concurrency: {max_concurrency}")
+
+    with ENGINES[engine](max_concurrency) as submit:
+
+        futures: Dict[Tuple[str, str, Union[str, None]], Future] = {
+            task.key: submit(fnc, task) for task in order
+        }
+        groups: Dict[Future, Group] = {
+            futures[task.key]: (task.Project, task.ServiceClass)
+            for task in order
+        }
+        remaining: Dict[Group, int] = {
+            group: sum(not task.Skipped for task in liste)
+            for group, liste in tasks.items()
+        }
+
+        for group, count in remaining.items():
+            if count == 0:
+                yield group[0], group[1], []
+
+        for future in as_completed(futures.values()):
+            group = groups[future]
+            remaining[group] -= 1
+            if remaining[group] > 0:
+                continue
+            results = [futures[task.key].result() for task in tasks[group]
+                       if not task.Skipped]
+            yield group[0], group[1], merge(results)
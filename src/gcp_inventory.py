@@ -4,8 +4,6 @@
 """
 import logger
 import logging
-from proc_deploy import run as run_deploy
-from proc_inventory import run as run_inventory
 
 info = logging.info
 
@@ -16,6 +14,15 @@ class Commands:
 
     The following commands are available:
     * deploy: Deploy the Cloud Run Job that will inventory the target project
+    * deploy_batch: Deploy to the projects of several configuration files
+    * inventory: Performs the inventory
+    * estimate: Predicts the run time of the inventory from history
+    * cat: Prints a service class of the latest snapshot in the bucket
+    * index: Ingests local snapshots into a SQLite query index
+    * query: Prints the resources of the query index matching criteria
+    * diff: Compares two local snapshots
+    * graph: Exports the relationship graph of a local snapshot
+    * policy: Evaluates policy rules against a local snapshot
     """
 
     def deploy(self,
@@ -28,25 +35,238 @@ class Commands:
         --path: path to configuration file
         --loglevel: loglevel to use (DEBUG, INFO, WARNING, ERROR)
         """
+        from proc_deploy import run as run_deploy
         logger.set_params(loglevel)
         try:
             run_deploy(path)
         except KeyboardInterrupt:
             pass
 
-    def inventory(self, path: str = 'config.yaml', loglevel: str = 'INFO'):
+    def deploy_batch(self, *paths: str, concurrency: int = 4,
+                     loglevel: str = 'INFO'):
+        """
+        Deploy the Cloud Run Jobs of several configuration files,
+        in parallel
+
+        paths: paths to the configuration files
+        --concurrency: maximum number of deployments in parallel
+        --loglevel: loglevel to use (DEBUG, INFO, WARNING, ERROR)
+        """
+        from proc_deploy import run_batch
+        logger.set_params(loglevel)
+        try:
+            run_batch(list(paths), concurrency)
+        except KeyboardInterrupt:
+            pass
+
+    def inventory(self, path: str = 'config.yaml', loglevel: str = 'INFO',
+                  refresh: bool = False, plan_only: bool = False):
         """
         Performs the inventory in the active project
 
         --path: path to configuration file
         --loglevel: loglevel to use (DEBUG, INFO, WARNING, ERROR)
+        --refresh: ignores the cached list of enabled services
+        --plan_only: prints the plan of the listings, as JSON, and exits
         """
+        from proc_inventory import run as run_inventory
         logger.set_params(loglevel)
         try:
-            run_inventory(path)
+            run_inventory(path, refresh, plan_only)
         except KeyboardInterrupt:
             pass
 
+    def estimate(self, path: str = 'config.yaml', loglevel: str = 'WARNING',
+                 refresh: bool = False, output: str = None):
+        """
+        Predicts the run time of the inventory, and the cost of each
+        listing, from the timings of the previous snapshots
+
+        --path: path to configuration file
+        --loglevel: loglevel to use (DEBUG, INFO, WARNING, ERROR)
+        --refresh: ignores the cached list of enabled services
+        --output: path of the JSON report, else printed
+        """
+        import json
+        from proc_inventory import estimate
+        logger.set_params(loglevel)
+
+        report = estimate(refresh)
+
+        if output is None:
+            print(json.dumps(report, indent=2))
+            return
+
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    def cat(self, project: str, service_class: str,
+            loglevel: str = 'WARNING'):
+        """
+        Prints the entries of a service class of the latest snapshot of
+        a project in the bucket, one JSON object per line. Only the file
+        of the service class is retrieved: range reads from an archive.
+
+        --project: the project id
+        --service_class: the service class name e.g. PubsubTopic
+        --loglevel: loglevel to use (DEBUG, INFO, WARNING, ERROR)
+        """
+        import json
+        from utils import get_config_from_environment, abort
+        from store import load_spec_dicts
+        logger.set_params(loglevel)
+
+        config = get_config_from_environment()
+        try:
+            for dic in load_spec_dicts(config, project, service_class):
+                print(json.dumps(dic))
+        except ValueError as e:
+            abort(str(e))
+
+    def index(self, path: str, db: str = 'index.sqlite',
+              project: str = None, loglevel: str = 'INFO'):
+        """
+        Ingests the snapshots of a local copy of the bucket into
+        a SQLite query index. The snapshots already indexed are skipped.
+
+        --path: local directory e.g. synced with 'gcloud storage rsync'
+        --db: path to the SQLite database
+        --project: restricts the ingestion to a project
+        --loglevel: loglevel to use (DEBUG, INFO, WARNING, ERROR)
+        """
+        import os
+        from utils import abort
+        from index import ingest
+        logger.set_params(loglevel)
+
+        if not os.path.isdir(path):
+            abort(f"! Directory not found: {path}")
+
+        ingest(path, db, project)
+
+    def query(self, db: str = 'index.sqlite', project: str = None,
+              service_class: str = None, name: str = None,
+              ts: str = None, loglevel: str = 'WARNING'):
+        """
+        Prints the resources of the query index matching the criteria,
+        from the latest snapshot of each project unless --ts is given,
+        one JSON object per line
+
+        --db: path to the SQLite database (see the 'index' command)
+        --project: the project id
+        --service_class: the service class name e.g. PubsubTopic
+        --name: the resource id or its last segment
+        --ts: timestamp of the snapshot
+        --loglevel: loglevel to use (DEBUG, INFO, WARNING, ERROR)
+        """
+        import os
+        import json
+        from utils import abort
+        from index import connect, query
+        logger.set_params(loglevel)
+
+        if not os.path.isfile(db):
+            abort(f"! Index database not found: {db}")
+
+        conn = connect(db)
+        try:
+            rows = query(conn, project, service_class, name, ts)
+        except ValueError as e:
+            abort(str(e))
+        finally:
+            conn.close()
+
+        for _project, _ts, _service_class, _name, resource in rows:
+            print(json.dumps({"Project": _project, "Timestamp": _ts,
+                              "ServiceClass": _service_class,
+                              "Id": _name, "Resource": resource}))
+
+    def diff(self, path: str, project: str,
+             old: str = None, new: str = None,
+             output: str = None, loglevel: str = 'WARNING'):
+        """
+        Compares two snapshots of a project in a local copy of the bucket,
+        by default the latest against the previous one
+
+        --path: local directory e.g. synced with 'gcloud storage rsync'
+        --project: the project id
+        --old: timestamp of the older snapshot
+        --new: timestamp of the newer snapshot
+        --output: path of the JSON report, else printed
+        --loglevel: loglevel to use (DEBUG, INFO, WARNING, ERROR)
+        """
+        import json
+        from utils import abort
+        from diff import diff_snapshots, resolve_timestamps
+        logger.set_params(loglevel)
+
+        try:
+            old_ts, new_ts = resolve_timestamps(path, project, old, new)
+        except ValueError as e:
+            abort(str(e))
+        report = diff_snapshots(path, project, old_ts, new_ts)
+
+        if output is None:
+            print(json.dumps(report, indent=2))
+            return
+
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    def graph(self, path: str, project: str, ts: str = None,
+              format: str = 'dot', output: str = None,
+              loglevel: str = 'WARNING'):
+        """
+        Exports the relationship graph of a snapshot of a project
+        in a local copy of the bucket, by default the latest
+
+        --path: local directory e.g. synced with 'gcloud storage rsync'
+        --project: the project id
+        --ts: timestamp of the snapshot
+        --format: 'dot' (Graphviz) or 'json'
+        --output: path of the file, else printed
+        --loglevel: loglevel to use (DEBUG, INFO, WARNING, ERROR)
+        """
+        from utils import abort
+        from graph import get_graph, export
+        logger.set_params(loglevel)
+
+        try:
+            text = export(get_graph(path, project, ts), format)
+        except ValueError as e:
+            abort(str(e))
+
+        if output is None:
+            print(text, end="")
+            return
+
+        with open(output, "w") as f:
+            f.write(text)
+
+    def policy(self, path: str, project: str, rules: str = 'policy.yaml',
+               ts: str = None, output: str = None,
+               loglevel: str = 'INFO'):
+        """
+        Evaluates the policy rules against a snapshot of a project
+        in a local copy of the bucket, by default the latest
+
+        --path: local directory e.g. synced with 'gcloud storage rsync'
+        --project: the project id
+        --rules: path of the YAML rules file
+        --ts: timestamp of the snapshot
+        --output: path of the findings, else 'findings.json'
+                  in the snapshot directory
+        --loglevel: loglevel to use (DEBUG, INFO, WARNING, ERROR)
+        """
+        from utils import abort
+        from policy import run as run_policy
+        logger.set_params(loglevel)
+
+        try:
+            run_policy(path, project, rules, ts, output)
+        except ValueError as e:
+            abort(str(e))
+
 
 if __name__ == "__main__":
     import fire  # type: ignore
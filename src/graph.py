@@ -0,0 +1,284 @@
+"""
+Relationship graph of the resources of a snapshot
+
+The nodes are the resources of the snapshot. The edges are the
+references between them:
+
+* references serialized by pygcloud (`Ref` i.e. service_type, name, ...)
+  e.g. a backend service -> its network endpoint group
+* string values equal to the fully qualified identity of another
+  resource (self link, email, name with a path) e.g. a scheduler
+  job -> the pubsub topic it publishes to
+
+Each edge is labelled with the path of its field in the resource
+e.g. 'pubsubTarget.topicName'.
+
+The references are resolved through lookup maps, built once from the
+identities of all the nodes: the cost is linear in the size of the
+snapshot. The fields typed `RefUsedBy` by pygcloud (e.g. 'users') hold
+reversed references: the edge goes from the user to the resource.
+
+References to resources not in the snapshot (e.g. a service account
+of another project) are kept as external nodes.
+
+@author: jldupont
+"""
+import json
+import typing
+import logging
+import dataclasses
+from functools import lru_cache
+from typing import List, Dict, Tuple, Union, Set, Iterator, Any
+from pygcloud.gcp.catalog import get_listable_services  # type: ignore
+from pygcloud.gcp.models import RefUsedBy  # type: ignore
+from store import get_local_spec_list_paths, read_spec_dicts
+from utils import get_resource_id, is_ref, format_ref
+
+
+info = logging.info
+
+Edge = Tuple[str, str, str]
+
+
+@lru_cache(maxsize=1)
+def get_used_by_fields() -> Set[str]:
+    """
+    The names of the fields typed `RefUsedBy` in the pygcloud specs
+    """
+    names: Set[str] = set()
+    seen: Set[type] = set()
+
+    def visit(classe: type):
+        if classe in seen or not dataclasses.is_dataclass(classe):
+            return
+        seen.add(classe)
+        try:
+            hints = typing.get_type_hints(classe)
+        except Exception:
+            return
+        for name, hint in hints.items():
+            args = typing.get_args(hint) or (hint,)
+            for arg in args:
+                if arg is RefUsedBy:
+                    names.add(name)
+                elif isinstance(arg, type):
+                    visit(arg)
+
+    for service_class in get_listable_services():
+        visit(service_class.SPEC_CLASS)
+
+    return names
+
+
+def get_string_identities(dic: dict) -> List[str]:
+    """
+    The fully qualified string values by which a resource may be
+    referred to: self link, email, name with a path e.g.
+    'projects/p/topics/t'
+
+    A bare name e.g. 't' is not an identity: any string
+    of another resource could be equal to it.
+    """
+    metadata = dic.get("metadata", None)
+    values = [dic.get("selfLink", None), dic.get("email", None),
+              metadata.get("selfLink", None)
+              if isinstance(metadata, dict) else None]
+
+    identities = [value for value in values
+                  if isinstance(value, str) and value]
+
+    name = dic.get("name", None)
+    if isinstance(name, str) and "/" in name:
+        identities.append(name)
+    return identities
+
+
+def iter_values(value: Any, field: str = ""
+                ) -> Iterator[Tuple[str, Any]]:
+    """
+    Yields (field path, value) of the references and strings
+    e.g. 'spec.template.serviceAccount', without the list indices
+    """
+    if is_ref(value) or isinstance(value, str):
+        yield field, value
+    elif isinstance(value, dict):
+        for key, item in value.items():
+            yield from iter_values(item, f"{field}.{key}" if field else key)
+    elif isinstance(value, list):
+        for item in value:
+            yield from iter_values(item, field)
+
+
+class Graph:
+    """
+    Nodes with an adjacency index in both directions
+    """
+
+    def __init__(self):
+        self.nodes: Dict[str, dict] = {}
+        self.outgoing: Dict[str, List[Tuple[str, str]]] = {}
+        self.incoming: Dict[str, List[Tuple[str, str]]] = {}
+
+    def add_node(self, node_id: str, service_class: str, name: str,
+                 external: bool = False):
+        if node_id in self.nodes:
+            return
+        self.nodes[node_id] = {"Id": node_id,
+                               "ServiceClass": service_class,
+                               "Name": name,
+                               "External": external}
+        self.outgoing[node_id] = []
+        self.incoming[node_id] = []
+
+    def add_edge(self, source: str, target: str, field: str):
+        if source == target or (target, field) in self.outgoing[source]:
+            return
+        self.outgoing[source].append((target, field))
+        self.incoming[target].append((source, field))
+
+    @property
+    def edges(self) -> List[Edge]:
+        return [(source, target, field)
+                for source, targets in self.outgoing.items()
+                for target, field in targets]
+
+    def to_dict(self) -> dict:
+        return {
+            "Nodes": list(self.nodes.values()),
+            "Edges": [{"From": source, "To": target, "Field": field}
+                      for source, target, field in self.edges],
+        }
+
+    def to_dot(self) -> str:
+        """
+        Graphviz: one cluster per service class
+        """
+        ids = {node_id: f"n{index}"
+               for index, node_id in enumerate(self.nodes)}
+
+        clusters: Dict[str, List[str]] = {}
+        for node_id, node in self.nodes.items():
+            clusters.setdefault(node["ServiceClass"], []).append(node_id)
+
+        lines = ["digraph G {",
+                 '\tfontname="Helvetica,Arial,sans-serif"',
+                 '\tnode [fontname="Helvetica,Arial,sans-serif"]',
+                 '\tedge [fontname="Helvetica,Arial,sans-serif"]']
+
+        for index, (service_class, node_ids) in enumerate(clusters.items()):
+            lines.append(f"\tsubgraph cluster_{index} {{")
+            lines.append(f"\t\tlabel = {json.dumps(service_class)};")
+            for node_id in node_ids:
+                node = self.nodes[node_id]
+                style = ", style=dashed" if node["External"] else ""
+                lines.append(f"\t\t{ids[node_id]} "
+                             f"[label={json.dumps(node['Name'])}{style}];")
+            lines.append("\t}")
+
+        for source, target, field in self.edges:
+            lines.append(f"\t{ids[source]} -> {ids[target]} "
+                         f"[label={json.dumps(field)}];")
+
+        lines.append("}")
+        return "\n".join(lines) + "\n"
+
+
+def short_name(value: str) -> str:
+    return value.rstrip("/").rsplit("/", 1)[-1]
+
+
+def build_graph(resources: Dict[str, List[dict]]) -> Graph:
+    """
+    resources: the entries of each service class
+    """
+    graph = Graph()
+
+    by_string: Dict[str, str] = {}
+    by_ref: Dict[str, str] = {}
+    by_type_name: Dict[Tuple[str, str], str] = {}
+
+    #
+    # First pass: the nodes and the lookup maps
+    #
+    for service_class, entries in resources.items():
+        for dic in entries:
+            node_id = get_resource_id(dic)
+            graph.add_node(node_id, service_class, short_name(node_id))
+
+            for identity in get_string_identities(dic):
+                by_string.setdefault(identity, node_id)
+
+            for value in [dic.get("selfLink", None), dic.get("name", None),
+                          (dic.get("metadata", None) or {}).get("selfLink")]:
+                if is_ref(value):
+                    by_ref.setdefault(format_ref(value), node_id)
+                    by_type_name.setdefault(
+                        (value["service_type"], value["name"]), node_id)
+
+    def resolve_ref(ref: dict) -> str:
+        node_id = by_ref.get(format_ref(ref), None) or \
+            by_type_name.get((ref["service_type"], ref["name"]), None)
+        if node_id is None:
+            node_id = format_ref(ref)
+            graph.add_node(node_id, str(ref["service_type"]),
+                           str(ref["name"]), external=True)
+        return node_id
+
+    #
+    # Second pass: the edges
+    #
+    used_by = get_used_by_fields()
+
+    for service_class, entries in resources.items():
+        for dic in entries:
+            node_id = get_resource_id(dic)
+
+            for field, value in iter_values(dic):
+                if field.split(".")[0] in ["selfLink", "name", "metadata"]:
+                    continue
+
+                if is_ref(value):
+                    target = resolve_ref(value)
+                else:
+                    target = by_string.get(value, None)
+                    if target is None:
+                        continue
+
+                if field.rsplit(".", 1)[-1] in used_by:
+                    graph.add_edge(target, node_id, field)
+                else:
+                    graph.add_edge(node_id, target, field)
+
+    info(f"> Graph: {len(graph.nodes)} node(s), "
+         f"{len(graph.edges)} edge(s)")
+
+    return graph
+
+
+def load_snapshot(root: str, project: str,
+                  ts: str) -> Dict[str, List[dict]]:
+    return {
+        service_class: list(read_spec_dicts(path))
+        for service_class, path in get_local_spec_list_paths(
+            root, project, ts).items()
+    }
+
+
+def export(graph: Graph, fmt: str = "dot") -> str:
+    if fmt == "dot":
+        return graph.to_dot()
+    if fmt == "json":
+        return json.dumps(graph.to_dict(), indent=2)
+    raise ValueError(f"Invalid graph format: {fmt}")
+
+
+def get_graph(root: str, project: str,
+              ts: Union[str, None] = None) -> Graph:
+    """
+    The graph of a snapshot, by default the latest
+    """
+    from diff import resolve_timestamp
+
+    ts = resolve_timestamp(root, project, ts)
+
+    return build_graph(load_snapshot(root, project, ts))
@@ -0,0 +1,231 @@
+"""
+Query index over a snapshot history
+
+The snapshots of a local copy of the bucket (e.g. obtained through
+`gcloud storage rsync gs://$BUCKET $DIR`) are ingested into a SQLite
+database:
+
+* snapshots: the (project, timestamp) already indexed
+* resources: one row per resource per snapshot, keyed by
+  (project, timestamp, service class, resource id)
+* documents: the content of the resources, JSON, stored once
+  per distinct content
+
+The resource id is the selfLink, else the name (see `utils.get_resource_id`).
+An unchanged resource thus only costs a row in `resources` per snapshot.
+
+Ingestion is incremental: the snapshots already indexed are skipped.
+
+https://www.sqlite.org/json1.html
+
+@author: jldupont
+"""
+import json
+import sqlite3
+import hashlib
+import logging
+from typing import List, Tuple, Union, Iterator
+from store import get_local_snapshots, get_local_spec_list_paths, \
+    read_spec_dicts
+from utils import get_resource_id, get_canonical_json
+
+
+info = logging.info
+
+BATCH_SIZE = 10_000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS snapshots (
+    project TEXT NOT NULL,
+    ts TEXT NOT NULL,
+    resources INTEGER NOT NULL,
+    PRIMARY KEY (project, ts)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS documents (
+    hash TEXT PRIMARY KEY,
+    data TEXT NOT NULL CHECK (json_valid(data))
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS resources (
+    project TEXT NOT NULL,
+    ts TEXT NOT NULL,
+    service_class TEXT NOT NULL,
+    name TEXT NOT NULL,
+    hash TEXT NOT NULL REFERENCES documents (hash),
+    PRIMARY KEY (project, ts, service_class, name)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS resources_by_name
+    ON resources (name, ts);
+
+CREATE INDEX IF NOT EXISTS resources_by_class
+    ON resources (service_class, ts);
+"""
+
+
+def connect(db_path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(db_path)
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def get_indexed_snapshots(conn: sqlite3.Connection) -> List[Tuple[str, str]]:
+    return [(project, ts) for project, ts in
+            conn.execute("SELECT project, ts FROM snapshots")]
+
+
+def iter_snapshot_rows(root: str, project: str, ts: str
+                       ) -> Iterator[Tuple[str, str, str]]:
+    """
+    Yields (service class, resource id, canonical JSON document)
+    of the resources of a snapshot
+    """
+    for service_class, path in get_local_spec_list_paths(root, project,
+                                                         ts).items():
+        for dic in read_spec_dicts(path):
+            yield service_class, get_resource_id(dic), get_canonical_json(dic)
+
+
+def ingest_snapshot(conn: sqlite3.Connection,
+                    root: str, project: str, ts: str) -> int:
+    """
+    A snapshot is ingested in a single transaction
+
+    Returns the number of resources
+    """
+    count = 0
+    documents: List[Tuple[str, str]] = []
+    resources: List[Tuple[str, str, str, str, str]] = []
+
+    def flush():
+        conn.executemany("INSERT OR IGNORE INTO documents VALUES (?, ?)",
+                         documents)
+        conn.executemany("INSERT OR REPLACE INTO resources "
+                         "VALUES (?, ?, ?, ?, ?)", resources)
+        documents.clear()
+        resources.clear()
+
+    with conn:
+        for service_class, name, data in iter_snapshot_rows(root, project,
+                                                            ts):
+            digest = hashlib.sha256(data.encode()).hexdigest()
+            documents.append((digest, data))
+            resources.append((project, ts, service_class, name, digest))
+            count += 1
+            if len(resources) >= BATCH_SIZE:
+                flush()
+        flush()
+
+        conn.execute("INSERT INTO snapshots VALUES (?, ?, ?)",
+                     (project, ts, count))
+
+    return count
+
+
+def ingest(root: str, db_path: str,
+           project: Union[str, None] = None) -> int:
+    """
+    Ingest the snapshots not yet indexed
+
+    Returns the number of snapshots ingested
+    """
+    conn = connect(db_path)
+    try:
+        indexed = set(get_indexed_snapshots(conn))
+        pending = [snapshot for snapshot in get_local_snapshots(root, project)
+                   if snapshot not in indexed]
+
+        info(f"> Snapshots already indexed: {len(indexed)}, "
+             f"to ingest: {len(pending)}")
+
+        for _project, ts in pending:
+            count = ingest_snapshot(conn, root, _project, ts)
+            info(f"> Indexed snapshot '{ts}' of project '{_project}': "
+                 f"{count} resource(s)")
+
+        conn.execute("PRAGMA optimize")
+        return len(pending)
+    finally:
+        conn.close()
+
+
+def first_seen(conn: sqlite3.Connection, name: str
+               ) -> Union[Tuple[str, str, str], None]:
+    """
+    The (project, timestamp, service class) of the first snapshot
+    holding a resource
+    """
+    return conn.execute("SELECT project, ts, service_class FROM resources "
+                        "WHERE name = ? ORDER BY ts LIMIT 1",
+                        (name,)).fetchone()
+
+
+def search(conn: sqlite3.Connection,
+           service_class: str,
+           path: str,
+           value,
+           since: Union[str, None] = None
+           ) -> List[Tuple[str, str, str, dict]]:
+    """
+    The (project, timestamp, resource id, document) of the resources
+    of a service class whose field at the JSON `path` (e.g.
+    '$.spec.template.spec.containers[0].image') equals `value`
+    """
+    rows = conn.execute(
+        "SELECT r.project, r.ts, r.name, d.data "
+        "FROM resources r JOIN documents d ON d.hash = r.hash "
+        "WHERE r.service_class = ? AND r.ts >= ? "
+        "AND json_extract(d.data, ?) = ? "
+        "ORDER BY r.ts, r.name",
+        (service_class, since or "", path, value))
+
+    return [(project, ts, name, json.loads(data))
+            for project, ts, name, data in rows]
+
+
+def query(conn: sqlite3.Connection,
+          project: Union[str, None] = None,
+          service_class: Union[str, None] = None,
+          name: Union[str, None] = None,
+          ts: Union[str, None] = None
+          ) -> List[Tuple[str, str, str, str, dict]]:
+    """
+    The (project, timestamp, service class, resource id, document) of
+    the resources of a snapshot, by default the latest of each project
+
+    name: the resource id or its last segment e.g. 't1' for
+          'projects/p/topics/t1'
+    """
+    if conn.execute("SELECT count(*) FROM snapshots").fetchone()[0] == 0:
+        raise ValueError("No snapshot indexed")
+
+    if ts is None:
+        snapshots = conn.execute(
+            "SELECT project, max(ts) FROM snapshots "
+            "WHERE ? IS NULL OR project = ? GROUP BY project",
+            (project, project)).fetchall()
+    else:
+        snapshots = conn.execute(
+            "SELECT project, ts FROM snapshots "
+            "WHERE ts = ? AND (? IS NULL OR project = ?)",
+            (ts, project, project)).fetchall()
+
+    rows: List[Tuple[str, str, str, str, dict]] = []
+    for _project, _ts in snapshots:
+        rows.extend(
+            (_project, _ts, _service_class, _name, json.loads(data))
+            for _service_class, _name, data in conn.execute(
+                "SELECT r.service_class, r.name, d.data "
+                "FROM resources r JOIN documents d ON d.hash = r.hash "
+                "WHERE r.project = ? AND r.ts = ? "
+                "AND (? IS NULL OR r.service_class = ?) "
+                "AND (? IS NULL OR r.name = ? "
+                "OR substr(r.name, -length(?) - 1) = '/' || ?) "
+                "ORDER BY r.service_class, r.name",
+                (_project, _ts, service_class, service_class,
+                 name, name, name, name)))
+
+    return rows
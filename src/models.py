@@ -1,9 +1,35 @@
 """
 @author: jldupont
 """
-from typing import Union, List
-from dataclasses import dataclass, field, asdict  # type: ignore
-from croniter import croniter  # type: ignore
+from typing import Union, List, Dict, Tuple
+from dataclasses import dataclass, field, fields, asdict  # type: ignore
+
+
+DEFAULT_MAX_CONCURRENCY = 8
+DEFAULT_LISTING_TIMEOUT = 300
+DEFAULT_NEGATIVE_CACHE_TTL = 24 * 3600
+DEFAULT_SERVICES_CACHE_TTL = 24 * 3600
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_BACKOFF_BASE = 1.0
+DEFAULT_BACKOFF_MAX = 60.0
+
+ENGINES = ["threads", "asyncio"]
+BACKENDS = ["gcloud", "rest"]
+OUTPUT_FORMATS = ["json", "ndjson", "ndjson.gz", "ndjson.zst"]
+POLICY_OPERATORS = ["eq", "ne", "in", "not_in", "exists", "missing",
+                    "matches", "contains"]
+
+
+def to_bool(value: Union[str, bool, None], default: bool = False) -> bool:
+    """
+    Booleans from the configuration file are native
+    whereas those from the environment are strings
+    """
+    if value is None or value == "":
+        return default
+    if isinstance(value, bool):
+        return value
+    return str(value).lower() in ["1", "true", "yes", "on"]
 
 
 class _Base:
@@ -20,19 +46,170 @@ class Service(_Base):
     enabled: bool
 
 
+def parse_service_classes(value: Union[str, dict, None]
+                          ) -> Dict[str, "ServiceClassConfig"]:
+    """
+    The `ServiceClasses` section, from the configuration file (dict)
+    or from the environment (JSON string)
+    """
+    import json
+
+    if value is None or value == "":
+        return {}
+    if isinstance(value, str):
+        value = json.loads(value)
+    if not isinstance(value, dict):
+        raise ValueError(f"Invalid ServiceClasses: {value}")
+
+    names = [_field.name for _field in fields(ServiceClassConfig)]
+    result: Dict[str, ServiceClassConfig] = {}
+
+    for name, entry in value.items():
+        if isinstance(entry, ServiceClassConfig):
+            result[name] = entry
+            continue
+        unknown = set(entry or {}) - set(names)
+        if unknown:
+            raise ValueError(f"Invalid ServiceClasses entry '{name}': "
+                             f"unknown option(s) {sorted(unknown)}")
+        result[name] = ServiceClassConfig(**(entry or {}))
+
+    return result
+
+
+@dataclass
+class ServiceClassConfig(_Base):
+    """
+    The selection applied to the listings of a service class
+
+    Filter: gcloud `--filter` expression e.g. "labels.env=prod"
+    Fields: the fields retained e.g. ["name", "labels.env"].
+            The fields required by the spec of the service class
+            are always retained.
+    Enabled: False excludes the service class from the inventory
+    """
+    Filter: Union[str, None] = None
+    Fields: List[str] = field(default_factory=list)
+    Enabled: bool = True
+
+    def __post_init__(self):
+        if isinstance(self.Fields, str):
+            self.Fields = [name.strip() for name in self.Fields.split(",")
+                           if name.strip()]
+        self.Fields = list(self.Fields or [])
+        self.Enabled = to_bool(self.Enabled, default=True)
+
+
+@dataclass
+class PolicyRule(_Base):
+    """
+    A finding is reported for each resource matching the condition
+
+    Name: identifies the rule in the findings
+    ServiceClass: the service class name e.g. 'StorageBucket',
+                  '*' for all of them
+    Field: dotted path e.g. 'iamConfiguration.publicAccessPrevention'.
+           Lists along the path are traversed: the condition holds
+           if it holds for any of the values.
+    Operator: see POLICY_OPERATORS
+    Value: compared against, a list for 'in' & 'not_in',
+           a regular expression for 'matches'
+    """
+    Name: str
+    ServiceClass: str
+    Field: str
+    Operator: str = field(default="eq")
+    Value: Union[str, int, float, bool, list, None] = field(default=None)
+    Severity: str = field(default="MEDIUM")
+    Description: str = field(default_factory=str)
+
+    def __post_init__(self):
+        if not self.Name:
+            raise ValueError("A policy rule requires a Name")
+        if not self.ServiceClass or not self.Field:
+            raise ValueError(f"Policy rule '{self.Name}' requires "
+                             "a ServiceClass and a Field")
+        if self.Operator not in POLICY_OPERATORS:
+            raise ValueError(f"Policy rule '{self.Name}': invalid "
+                             f"operator: {self.Operator}")
+        if self.Operator in ["in", "not_in"] and \
+                not isinstance(self.Value, list):
+            raise ValueError(f"Policy rule '{self.Name}': operator "
+                             f"'{self.Operator}' requires a list")
+
+
 @dataclass
 class Config(_Base):
     """
+    TargetProjectId: a project id, a list of project ids or selectors
+                     i.e. 'folder:$FOLDER_ID' or 'label:$KEY=$VALUE'.
+                     A list is normalized to a ';' separated string.
     ProjectNumber: used along ServiceAccountEmail
                    This parameter is inspected from the target project
+    MaxConcurrency: maximum number of listings performed in parallel
+    Engine: how the listings are driven i.e. 'threads' (one worker thread
+            per listing in flight) or 'asyncio' (a single event loop)
+    ListingTimeout: seconds after which a listing is aborted ('asyncio')
+    Backend: 'gcloud' (one process per listing) or 'rest' (direct calls
+             to the list endpoints over keep-alive connections)
+    RestBaseUrl: overrides the API hosts of the 'rest' backend
+    Incremental: service class files identical to those of the previous
+                 snapshot are referenced instead of uploaded again
+    OutputFormat: format of the service class files i.e. 'json' (array),
+                  'ndjson', 'ndjson.gz' or 'ndjson.zst' (needs 'zstandard')
+    Archive: the files of a snapshot are uploaded as a single indexed
+             archive instead of one object each (see `archive`)
+    NegativeCacheTtl: seconds during which a (service class, location)
+                      found unavailable is not listed again (0: disabled)
+    ServicesCacheTtl: seconds during which the service classes enabled
+                      in a project are taken from the cache (0: disabled)
+    RefreshServices: ignores the cached service classes
+    PageSize: listings are retrieved by pages of this size and parsed
+              as they are produced, bounding memory ('gcloud' backend)
+    ServiceClasses: selection per service class name, see
+                    `ServiceClassConfig`. From the environment,
+                    as a JSON object.
+    RateLimit: listings started per second, per API (e.g. 'compute',
+               'run'), 0: unlimited
+    RateBurst: listings that may start at once, per API, within RateLimit
+    MaxRetries: retries of a listing throttled by its API
+                (e.g. RESOURCE_EXHAUSTED, 429)
+    BackoffBase: seconds, base of the jittered exponential backoff
+    BackoffMax: seconds, maximum backoff between two retries
+    Deadline: seconds after which no listing is started nor retried
+              (0: none)
+    CacheDir: local directory for the caches instead of the bucket
+    TaskCount: tasks of the Cloud Run Job execution, each inventorying
+               a share of the service classes (see `shard`)
     """
     #
     # Used during inventory process
     #
     TargetLocations: str = field(default_factory=list)
-    TargetProjectId: str = field(default="PROJECT_NOT_SET")
+    TargetProjectId: Union[str, List[str]] = field(default="PROJECT_NOT_SET")
     TargetBucket: str = field(default_factory=str)
     TargetBucketProject: str = field(default_factory=str)
+    MaxConcurrency: int = field(default=DEFAULT_MAX_CONCURRENCY)
+    Engine: str = field(default="threads")
+    ListingTimeout: int = field(default=DEFAULT_LISTING_TIMEOUT)
+    Backend: str = field(default="gcloud")
+    RestBaseUrl: Union[str, None] = field(default=None)
+    Incremental: bool = field(default=False)
+    OutputFormat: str = field(default="json")
+    Archive: bool = field(default=False)
+    NegativeCacheTtl: int = field(default=DEFAULT_NEGATIVE_CACHE_TTL)
+    ServicesCacheTtl: int = field(default=DEFAULT_SERVICES_CACHE_TTL)
+    RefreshServices: bool = field(default=False)
+    PageSize: int = field(default=0)
+    ServiceClasses: Dict[str, ServiceClassConfig] = \
+        field(default_factory=dict)
+    RateLimit: float = field(default=0)
+    RateBurst: int = field(default=0)
+    MaxRetries: int = field(default=DEFAULT_MAX_RETRIES)
+    BackoffBase: float = field(default=DEFAULT_BACKOFF_BASE)
+    BackoffMax: float = field(default=DEFAULT_BACKOFF_MAX)
+    Deadline: int = field(default=0)
+    CacheDir: Union[str, None] = field(default=None)
 
     #
     # Relevant to deployment
@@ -43,15 +220,201 @@ class Config(_Base):
     Schedule: str = field(default_factory=str)
     ProjectNumber: Union[int, None] = field(default=None)
     ServiceAccountEmail: Union[str, None] = field(default=None)
+    TaskCount: int = field(default=1)
 
     def __post_init__(self):
+        if isinstance(self.TargetProjectId, list):
+            self.TargetProjectId = ";".join(self.TargetProjectId)
+
+        if self.MaxConcurrency is None:
+            self.MaxConcurrency = DEFAULT_MAX_CONCURRENCY
+        self.MaxConcurrency = int(self.MaxConcurrency)
+        if self.MaxConcurrency < 1:
+            raise ValueError("MaxConcurrency must be at least 1")
+
+        self.Engine = self.Engine or "threads"
+        if self.Engine not in ENGINES:
+            raise ValueError(f"Invalid engine: {self.Engine}")
+
+        self.Backend = self.Backend or "gcloud"
+        if self.Backend not in BACKENDS:
+            raise ValueError(f"Invalid backend: {self.Backend}")
+
+        self.Incremental = to_bool(self.Incremental)
+
+        self.OutputFormat = self.OutputFormat or "json"
+        if self.OutputFormat not in OUTPUT_FORMATS:
+            raise ValueError(f"Invalid output format: {self.OutputFormat}")
+
+        self.Archive = to_bool(self.Archive)
+
+        if self.NegativeCacheTtl is None:
+            self.NegativeCacheTtl = DEFAULT_NEGATIVE_CACHE_TTL
+        self.NegativeCacheTtl = int(self.NegativeCacheTtl)
+
+        if self.ServicesCacheTtl is None:
+            self.ServicesCacheTtl = DEFAULT_SERVICES_CACHE_TTL
+        self.ServicesCacheTtl = int(self.ServicesCacheTtl)
+
+        self.RefreshServices = to_bool(self.RefreshServices)
+
+        self.PageSize = int(self.PageSize or 0)
+        if self.PageSize < 0:
+            raise ValueError("PageSize must not be negative")
+
+        self.ServiceClasses = parse_service_classes(self.ServiceClasses)
+
+        self.RateLimit = float(self.RateLimit or 0)
+        self.RateBurst = int(self.RateBurst or 0)
+        if self.RateLimit < 0 or self.RateBurst < 0:
+            raise ValueError("RateLimit and RateBurst must not be negative")
+
+        if self.MaxRetries is None or self.MaxRetries == "":
+            self.MaxRetries = DEFAULT_MAX_RETRIES
+        self.MaxRetries = int(self.MaxRetries)
+
+        self.BackoffBase = float(self.BackoffBase or DEFAULT_BACKOFF_BASE)
+        self.BackoffMax = float(self.BackoffMax or DEFAULT_BACKOFF_MAX)
+
+        self.Deadline = int(self.Deadline or 0)
+
+        self.TaskCount = int(self.TaskCount or 1)
+        if self.TaskCount < 1:
+            raise ValueError("TaskCount must be at least 1")
+        if self.Archive and self.TaskCount > 1:
+            raise ValueError("Archive is not supported with several tasks")
+
+        if self.ListingTimeout is None:
+            self.ListingTimeout = DEFAULT_LISTING_TIMEOUT
+        self.ListingTimeout = int(self.ListingTimeout)
+
         if self.Schedule is None:
             return
+        from croniter import croniter  # type: ignore
         if not croniter.is_valid(self.Schedule):
             raise ValueError("Invalid schedule")
 
 
+@dataclass(frozen=True)
+class PlanTask(_Base):
+    """
+    A listing of the inventory plan
+
+    ServiceClass: the service class (pygcloud `GCPService`)
+    Argv: the complete `gcloud` command, empty with the 'rest' backend
+    Skipped: known to be unavailable, not listed
+    Cost: the seconds spent on the listing in the previous snapshot,
+          None without history
+    """
+    Project: str
+    ServiceClass: type
+    Location: Union[str, None] = None
+    Argv: Tuple[str, ...] = ()
+    Skipped: bool = False
+    Cost: Union[float, None] = None
+
+    @property
+    def key(self) -> Tuple[str, str, Union[str, None]]:
+        return (self.Project, self.ServiceClass.__name__, self.Location)
+
+    def to_dict(self):
+        return {
+            "Project": self.Project,
+            "ServiceClass": self.ServiceClass.__name__,
+            "Location": self.Location,
+            "Argv": list(self.Argv),
+            "Skipped": self.Skipped,
+            "Cost": self.Cost,
+        }
+
+
+@dataclass
+class Shard(_Base):
+    """
+    The task of a Cloud Run Job execution
+
+    Execution: the name of the execution, shared by its tasks
+    """
+    Index: int
+    Count: int
+    Execution: str
+
+
+@dataclass
+class ExecutionPlan(_Base):
+    """
+    The work shared by the tasks of an execution, decided once
+
+    Services: the service class names of each project
+    Costs: the seconds spent listing each service class of each project
+           in the previous snapshot
+    """
+    Timestamp: str
+    Services: Dict[str, List[str]] = field(default_factory=dict)
+    Costs: Dict[str, Dict[str, float]] = field(default_factory=dict)
+
+
+@dataclass
+class ManifestEntry(_Base):
+    """
+    Hash: sha256 of the service class file
+    Timestamp: the snapshot where the file was uploaded
+               i.e. a previous one if the content did not change
+    """
+    Hash: str
+    Timestamp: str
+
+
+@dataclass
+class Span(_Base):
+    """
+    The timing of a step of the inventory process
+
+    Name: 'services', 'list', 'parse', 'store', 'upload' or 'run'
+    ServiceClass: for the uploads, also the closing files e.g. 'config'
+    Start: seconds since the start of the run
+    Duration: seconds
+    Entries: number of entries processed
+    Bytes: number of bytes produced or transferred
+    Status: 'ok', 'unavailable', 'failed' or 'error' (exception raised)
+    """
+    Name: str
+    Project: Union[str, None] = None
+    ServiceClass: Union[str, None] = None
+    Location: Union[str, None] = None
+    Start: float = 0.0
+    Duration: float = 0.0
+    Entries: Union[int, None] = None
+    Bytes: Union[int, None] = None
+    Status: str = "ok"
+
+
 @dataclass
 class Snapshot(_Base):
+    """
+    Format: the output format of the service class files
+    Retries: the retries of the listings of each service class,
+             following throttling
+    Archive: the files are packed in the archive of the snapshot
+    Failed: the service classes with a failed listing e.g. still
+            throttled after the retries: their file is incomplete
+    """
     Timestamp: str = field(default_factory=str)
     ServiceClasses: List[str] = field(default_factory=list)
+    Manifest: Dict[str, ManifestEntry] = field(default_factory=dict)
+    Format: str = field(default="json")
+    Retries: Dict[str, int] = field(default_factory=dict)
+    Archive: bool = field(default=False)
+    Failed: List[str] = field(default_factory=list)
+
+    @classmethod
+    def from_json(cls, json_str: str):
+        import json
+        names = [_field.name for _field in fields(cls)]
+        dic = {key: value for key, value in json.loads(json_str).items()
+               if key in names}
+        manifest = {
+            name: ManifestEntry(**entry)
+            for name, entry in dic.pop("Manifest", {}).items()
+        }
+        return cls(**dic, Manifest=manifest)
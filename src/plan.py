@@ -0,0 +1,147 @@
+"""
+The inventory plan of a run
+
+The listings are compiled once, up front, into an immutable plan:
+one task per (project, service class, location) with its complete
+`gcloud` command. The plan is deduplicated, serializable (see
+`inventory --plan_only`) and fed as is to the executor.
+
+Each task carries its cost, i.e. the duration of the same listing in
+the previous snapshot (see `timings.json`): the executor starts the
+longest tasks first so that a dominant listing does not end up last,
+alone, on an otherwise idle pool. The same history gives an estimate
+of the run (see `get_estimate`).
+
+@author: jldupont
+"""
+import json
+import heapq
+import logging
+from typing import List, Tuple, Union, Callable, Dict
+from pygcloud.models import GCPService  # type: ignore
+from models import Config, PlanTask, ServiceClassConfig, Snapshot
+from executor import get_tasks, get_execution_order
+from cmds import get_cmd_list, get_cmd_args
+from store import load_previous_timings
+
+
+info = logging.info
+
+Plan = Tuple[PlanTask, ...]
+
+#
+# (service class name, location) -> seconds
+#
+TaskCosts = Dict[Tuple[str, Union[str, None]], float]
+
+
+def get_task_costs(timings: dict) -> TaskCosts:
+    """
+    The seconds spent on each listing, retries included
+    """
+    costs: TaskCosts = {}
+    for span in timings.get("Spans", []):
+        if span.get("Name") == "list" and span.get("ServiceClass"):
+            key = (span["ServiceClass"], span.get("Location"))
+            costs[key] = round(costs.get(key, 0.0) +
+                               (span.get("Duration") or 0.0), 6)
+    return costs
+
+
+def load_task_costs(config: Config, project: str,
+                    previous: Union[Snapshot, None] = None) -> TaskCosts:
+    """
+    From the timings of the previous snapshot, if any
+    """
+    timings = load_previous_timings(config, project, previous)
+    return get_task_costs(timings) if timings is not None else {}
+
+
+def get_argv(project: str,
+             service_class: GCPService,
+             location: Union[str, None],
+             page_size: int = 0,
+             selection: Union[ServiceClassConfig, None] = None
+             ) -> Tuple[str, ...]:
+    cmd = get_cmd_list(project, service_class, location,
+                       page_size=page_size, selection=selection)
+    return tuple(get_cmd_args(cmd))
+
+
+def compile_plan(projects_services: List[Tuple[str, List[GCPService]]],
+                 locations: str,
+                 page_size: int = 0,
+                 selections: Union[Dict[str, ServiceClassConfig],
+                                   None] = None,
+                 skip: Union[Callable[[str, GCPService, Union[str, None]],
+                                      bool], None] = None,
+                 with_argv: bool = True,
+                 costs: Union[Dict[str, TaskCosts], None] = None) -> Plan:
+    """
+    The tasks, in the order of the projects, of their service classes
+    then of the locations
+
+    skip: the tasks for which `skip(project, service_class, location)`
+          is True are planned as skipped
+    with_argv: False with the 'rest' backend
+    costs: the costs of the tasks of each project (see `load_task_costs`).
+           The listings without history cost the average of the project.
+    """
+    tasks: Dict[Tuple[str, str, Union[str, None]], PlanTask] = {}
+
+    for project, services in projects_services:
+        known: TaskCosts = (costs or {}).get(project, {})
+        default = round(sum(known.values()) / len(known), 6) if known \
+            else None
+        for service_class in services:
+            selection = (selections or {}).get(service_class.__name__)
+            for _, location in get_tasks(service_class, locations):
+                task = PlanTask(
+                    Project=project,
+                    ServiceClass=service_class,
+                    Location=location,
+                    Argv=get_argv(project, service_class, location,
+                                  page_size, selection)
+                    if with_argv else (),
+                    Skipped=skip is not None
+                    and skip(project, service_class, location),
+                    Cost=known.get((service_class.__name__, location),
+                                   default))
+                tasks.setdefault(task.key, task)
+
+    plan: Plan = tuple(tasks.values())
+
+    info(f"> Plan: {len(plan)} task(s), "
+         f"{sum(task.Skipped for task in plan)} skipped")
+    return plan
+
+
+def to_json(plan: Plan) -> str:
+    return json.dumps([task.to_dict() for task in plan], indent=2)
+
+
+def get_estimate(plan: Plan, max_concurrency: int = 1) -> dict:
+    """
+    The run time predicted from the costs of the tasks
+
+    The tasks are assigned, in the order of execution, to the first
+    worker available: the estimate is the time the last one completes.
+    The tasks without history are counted as `Unknown`, at no cost.
+    """
+    tasks = get_execution_order(plan)
+    workers = [0.0] * max(1, max_concurrency)
+
+    for task in tasks:
+        heapq.heapreplace(workers, workers[0] + (task.Cost or 0.0))
+
+    return {
+        "MaxConcurrency": max(1, max_concurrency),
+        "Tasks": len(tasks),
+        "Unknown": sum(task.Cost is None for task in tasks),
+        "Total": round(sum(task.Cost or 0.0 for task in tasks), 6),
+        "Estimate": round(max(workers), 6),
+        "Costs": [{"Project": task.Project,
+                   "ServiceClass": task.ServiceClass.__name__,
+                   "Location": task.Location,
+                   "Cost": task.Cost} for task in tasks],
+    }
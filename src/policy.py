@@ -0,0 +1,221 @@
+"""
+Policy evaluation over a snapshot
+
+The rules are declared in a YAML file, alongside `config.yaml`:
+
+    Rules:
+      - Name: bucket-public-access
+        ServiceClass: StorageBucket
+        Field: iamConfiguration.publicAccessPrevention
+        Operator: ne
+        Value: enforced
+        Severity: HIGH
+
+Each rule is compiled once into a predicate and the predicates are
+grouped per service class: each service class file is then read once,
+whatever the number of rules, and files without rules are not read.
+
+The findings are written to 'findings.json' in the snapshot directory.
+
+@author: jldupont
+"""
+import os
+import re
+import json
+import logging
+from dataclasses import fields
+from typing import List, Dict, Callable, Union, Any
+from models import PolicyRule
+from store import get_local_spec_list_paths, read_spec_dicts
+from utils import get_resource_id, get_config_from_file
+
+
+info = logging.info
+
+ALL_SERVICE_CLASSES = "*"
+FINDINGS_NAME = "findings.json"
+
+Predicate = Callable[[dict], bool]
+Finding = Dict[str, Any]
+
+_MISSING = object()
+
+
+def load_rules(path: str) -> List[PolicyRule]:
+    if not os.path.isfile(path):
+        raise ValueError(f"Policy rules file not found: {path}")
+
+    data = get_config_from_file(path) or {}
+    return parse_rules(data.get("Rules", None) or [])
+
+
+def parse_rule(entry: dict) -> PolicyRule:
+    """
+    Invalid rules raise ValueError, with the name of the rule
+    """
+    name = entry.get("Name", None)
+
+    unknown = sorted(set(entry) - {_field.name
+                                   for _field in fields(PolicyRule)})
+    if unknown:
+        raise ValueError(f"Policy rule '{name}': unknown key(s): {unknown}")
+
+    rule = PolicyRule(**entry)
+
+    if rule.Operator == "matches":
+        try:
+            re.compile(str(rule.Value))
+        except re.error as e:
+            raise ValueError(f"Policy rule '{name}': invalid regular "
+                             f"expression: {e}")
+
+    return rule
+
+
+def parse_rules(entries: List[dict]) -> List[PolicyRule]:
+    rules = [parse_rule(entry) for entry in entries]
+
+    names = [rule.Name for rule in rules]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f"Duplicate policy rule name(s): {duplicates}")
+
+    return rules
+
+
+def compile_path(path: str) -> Callable[[Any], List[Any]]:
+    """
+    The values at a dotted path, traversing the lists
+    """
+    keys = path.split(".")
+
+    def resolve(value: Any) -> List[Any]:
+        values = [value]
+        for key in keys:
+            _values = []
+            for item in values:
+                for element in (item if isinstance(item, list) else [item]):
+                    if isinstance(element, dict):
+                        _value = element.get(key, _MISSING)
+                        if _value is not _MISSING:
+                            _values.append(_value)
+            values = _values
+            if not values:
+                break
+        return [element for item in values
+                for element in (item if isinstance(item, list) else [item])]
+
+    return resolve
+
+
+OPERATORS: Dict[str, Callable[[Any, Any], bool]] = {
+    "eq": lambda value, expected: value == expected,
+    "ne": lambda value, expected: value != expected,
+    "in": lambda value, expected: value in expected,
+    "not_in": lambda value, expected: value not in expected,
+    "matches": lambda value, regex: isinstance(value, str)
+    and regex.search(value) is not None,
+    "contains": lambda value, expected: isinstance(value, str)
+    and str(expected) in value,
+}
+
+
+def compile_rule(rule: PolicyRule) -> Predicate:
+    resolve = compile_path(rule.Field)
+
+    if rule.Operator == "exists":
+        return lambda dic: len(resolve(dic)) > 0
+
+    if rule.Operator == "missing":
+        return lambda dic: len(resolve(dic)) == 0
+
+    test = OPERATORS[rule.Operator]
+    expected = re.compile(str(rule.Value)) if rule.Operator == "matches" \
+        else rule.Value
+
+    def predicate(dic: dict) -> bool:
+        #
+        # An absent field is compared as null
+        #
+        return any(test(value, expected) for value in resolve(dic) or [None])
+
+    return predicate
+
+
+class Policy:
+    """
+    The compiled rules, grouped per service class
+    """
+
+    def __init__(self, rules: List[PolicyRule]):
+        self.rules = rules
+        self.by_class: Dict[str, List[tuple]] = {}
+        for rule in rules:
+            self.by_class.setdefault(rule.ServiceClass, []).append(
+                (rule, compile_rule(rule)))
+
+    def get_rules(self, service_class: str) -> List[tuple]:
+        return self.by_class.get(service_class, []) + \
+            self.by_class.get(ALL_SERVICE_CLASSES, [])
+
+    def evaluate(self, service_class: str, entries) -> List[Finding]:
+        """
+        A single pass over the entries of a service class
+        """
+        rules = self.get_rules(service_class)
+        findings: List[Finding] = []
+        if not rules:
+            return findings
+
+        for dic in entries:
+            for rule, predicate in rules:
+                if predicate(dic):
+                    findings.append({
+                        "Rule": rule.Name,
+                        "Severity": rule.Severity,
+                        "ServiceClass": service_class,
+                        "Id": get_resource_id(dic),
+                    })
+        return findings
+
+
+def evaluate_snapshot(policy: Policy, root: str, project: str,
+                      ts: str) -> dict:
+    findings: List[Finding] = []
+
+    for service_class, path in sorted(get_local_spec_list_paths(
+            root, project, ts).items()):
+        if not policy.get_rules(service_class):
+            continue
+        _findings = policy.evaluate(service_class, read_spec_dicts(path))
+        info(f"> {service_class}: {len(_findings)} finding(s)")
+        findings.extend(_findings)
+
+    return {
+        "Project": project,
+        "Timestamp": ts,
+        "Rules": len(policy.rules),
+        "Findings": findings,
+    }
+
+
+def run(root: str, project: str, rules_path: str,
+        ts: Union[str, None] = None,
+        output: Union[str, None] = None) -> dict:
+    """
+    Evaluates the rules against a snapshot, by default the latest,
+    and writes the findings in the snapshot directory
+    """
+    from diff import resolve_timestamp
+
+    ts = resolve_timestamp(root, project, ts)
+
+    policy = Policy(load_rules(rules_path))
+    report = evaluate_snapshot(policy, root, project, ts)
+
+    output = output or f"{root}/{project}/{ts}/{FINDINGS_NAME}"
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    info(f"> Findings: {len(report['Findings'])}, written to: {output}")
+    return report
@@ -1,78 +1,177 @@
 """
+The pre-flight checks (project description, bucket, service account,
+existing job & scheduler) are independent of each other: they are run
+concurrently and all the failures are reported together.
+
+Several configuration files, i.e. several projects, can be deployed
+in parallel, see `run_batch`.
+
 @author: jldupont
 """
+import asyncio
 import logging
+from typing import List, Dict, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from pygcloud.core import GCloud  # type: ignore
 from pygcloud.models import Result
 from pygcloud.gcp.models import ProjectDescription
-from pygcloud.cmds import cmd_retrieve_project_description
 from models import Config
 from utils import safe_get_config, abort
-from cmds import check_if_bucket_exists, check_if_service_account_exists, \
-    check_if_cloud_run_job_exists, deploy_cloud_run_job, \
-    check_if_cloud_run_job_scheduler_exists, deploy_cloud_run_scheduler
+from cmds import exec_async, get_cmd_project_describe, \
+    get_cmd_storage_bucket_describe, get_cmd_iam_service_account_describe, \
+    get_cmd_cloud_run_job_describe, deploy_cloud_run_job, \
+    get_cmd_scheduler_for_cloud_run_job_describe, deploy_cloud_run_scheduler
 
 info = logging.info
+error = logging.error
 
+DEFAULT_BATCH_CONCURRENCY = 4
 
-def run(path: str = 'config.yaml'):
 
-    info(f"> Configuration from : {path}")
-    config: Config = safe_get_config(path)
+class DeployError(Exception):
+    """
+    Carries all the failures of a deployment
+    """
 
-    info(f"> Configuration: {config}")
+    def __init__(self, project: str, failures: List[str]):
+        self.project = project
+        self.failures = failures
+        super().__init__(f"Project '{project}': " + "; ".join(failures))
 
-    info(f"> Deploying to project: {config.ProjectId}")
 
-    info("* Retrieving project description")
-    project_description: ProjectDescription = \
-        cmd_retrieve_project_description(config.ProjectId)
+def get_preflight_cmds(config: Config) -> Dict[str, GCloud]:
+    cmds = {
+        "project": get_cmd_project_describe(config),
+        "bucket": get_cmd_storage_bucket_describe(config,
+                                                  config.TargetBucket),
+        "job": get_cmd_cloud_run_job_describe(config),
+        "scheduler": get_cmd_scheduler_for_cloud_run_job_describe(config),
+    }
+    if config.ServiceAccountEmail is not None:
+        cmds["service_account"] = get_cmd_iam_service_account_describe(config)
+    return cmds
 
-    info(f"  Project number: {project_description.projectNumber}")
-    config.ProjectNumber = project_description.projectNumber
 
-    info(f"* Checking if bucket '{config.TargetBucket}' "
-         f"in project '{config.TargetBucketProject}' exists")
-    if not check_if_bucket_exists(config):
-        abort("The bucket does not exist. Please create it first")
+async def run_preflight_async(config: Config) -> Dict[str, Result]:
+    cmds = get_preflight_cmds(config)
+    results = await asyncio.gather(*[exec_async(cmd)
+                                     for cmd in cmds.values()])
+    return dict(zip(cmds, results))
 
-    info(f"  Bucket '{config.TargetBucket}' in project "
-         f"'{config.TargetBucketProject}' exists")
 
-    if config.ServiceAccountEmail is not None:
-        info("* Checking if service account"
-             f" '{config.ServiceAccountEmail}' exists")
-        if not check_if_service_account_exists(config):
-            abort("The service account does not exist. "
-                  "Please create it first")
-        info(f"  Service account '{config.ServiceAccountEmail}' exists")
-
-    info("* Checking if Cloud Run Job 'gcp-inventory' exists")
-    exists_already = check_if_cloud_run_job_exists(config)
-    if exists_already:
-        info("  Cloud Run Job 'gcp-inventory' exists")
-        action = "Updating"
-    else:
-        action = "Creating"
-        info("  Cloud Run Job 'gcp-inventory' does not exist"
-             f" in region: {config.JobRegion}")
+def check_preflight(config: Config,
+                    results: Dict[str, Result]) -> List[str]:
+    """
+    Updates the configuration from the results
 
-    info(f"> {action} Cloud Run Job... ")
-    result: Result = deploy_cloud_run_job(config, exists_already)
-    if not result.success:
-        abort(f"Failed to {action} Cloud Run Job")
+    Returns the failures
+    """
+    failures: List[str] = []
 
-    info("> Checking if execution schedule is installed ...")
-    exists_already = check_if_cloud_run_job_scheduler_exists(config)
-    if exists_already:
-        info("  Cloud Scheduler exists")
-        action = "Updating"
+    result = results["project"]
+    if result.success:
+        description = ProjectDescription.from_string(result.message)
+        config.ProjectNumber = description.projectNumber
+        info(f"  Project number: {config.ProjectNumber}")
     else:
-        action = "Creating"
-        info("  Cloud Scheduler does not exist")
+        failures.append("Unable to retrieve the project description: "
+                        f"{result.message}")
+
+    if not results["bucket"].success:
+        failures.append(f"The bucket '{config.TargetBucket}' in project "
+                        f"'{config.TargetBucketProject}' does not exist. "
+                        "Please create it first")
+
+    if "service_account" in results and \
+            not results["service_account"].success:
+        failures.append(f"The service account '{config.ServiceAccountEmail}'"
+                        " does not exist. Please create it first")
+
+    return failures
+
+
+def preflight(config: Config) -> Tuple[bool, bool]:
+    """
+    Returns whether the Cloud Run Job and the Cloud Scheduler
+    exist already
+    """
+    info(f"* Pre-flight checks for project: {config.ProjectId}")
+    results = asyncio.run(run_preflight_async(config))
+
+    failures = check_preflight(config, results)
+    if failures:
+        raise DeployError(config.ProjectId, failures)
 
+    return results["job"].success, results["scheduler"].success
+
+
+def deploy(config: Config):
+
+    info(f"> Deploying to project: {config.ProjectId}")
+
+    job_exists, scheduler_exists = preflight(config)
+
+    action = "Updating" if job_exists else "Creating"
+    info(f"> {action} Cloud Run Job in region: {config.JobRegion}")
+    result: Result = deploy_cloud_run_job(config, job_exists)
+    if not result.success:
+        raise DeployError(config.ProjectId,
+                          [f"Failed to {action} Cloud Run Job"])
+
+    action = "Updating" if scheduler_exists else "Creating"
     info(f"> {action} Cloud Scheduler... ")
-    result: Result = deploy_cloud_run_scheduler(config, exists_already)
+    result = deploy_cloud_run_scheduler(config, scheduler_exists)
     if not result.success:
-        abort(f"Failed to {action} Cloud Scheduler")
+        raise DeployError(config.ProjectId,
+                          [f"Failed to {action} Cloud Scheduler"])
+
+    info(f"! Done: {config.ProjectId}")
+
+
+def run(path: str = 'config.yaml'):
+
+    info(f"> Configuration from : {path}")
+    config: Config = safe_get_config(path)
+
+    info(f"> Configuration: {config}")
 
-    info("! Done")
+    try:
+        deploy(config)
+    except DeployError as e:
+        abort("\n".join(e.failures))
+
+
+def run_batch(paths: List[str],
+              concurrency: int = DEFAULT_BATCH_CONCURRENCY):
+    """
+    Deploys to the projects of several configuration files in parallel
+
+    All the configurations are loaded before any deployment starts.
+    """
+    configs: List[Config] = []
+    for path in paths:
+        info(f"> Configuration from : {path}")
+        configs.append(safe_get_config(path))
+
+    errors: List[str] = []
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+        futures = [pool.submit(deploy, config) for config in configs]
+
+    #
+    # Any exception, not only a DeployError, fails its project only:
+    # the failures of all the projects are reported
+    #
+    for config, future in zip(configs, futures):
+        exc = future.exception()
+        if isinstance(exc, DeployError):
+            errors.append(str(exc))
+        elif exc is not None:
+            errors.append(f"Project '{config.ProjectId}': {exc!r}")
+
+    info(f"> Deployed: {len(configs) - len(errors)} / {len(configs)}")
+
+    if errors:
+        for message in errors:
+            error(message)
+        abort(f"Failed to deploy to {len(errors)} project(s)")
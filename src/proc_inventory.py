@@ -4,128 +4,656 @@ The actual task that performs the inventory of the active project
 @author: jldupont
 """
 import logging
-from typing import List, Union
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import List, Union, Tuple, Dict, Set, Iterator, Iterable
 from pygcloud.models import GCPService   # type: ignore
 from pygcloud.gcp.models import Spec, ServiceDescription  # type: ignore
 from pygcloud.gcp.catalog import \
-    get_service_classes_from_services_list  # type: ignore
+    get_service_classes_from_services_list, lookup  # type: ignore
 from pygcloud.cmds import cmd_retrieve_enabled_services   # type: ignore
-from models import Config, Snapshot
-from utils import get_config_from_environment, get_now_timestamp, abort
-from cmds import get_inventory, upload_path_recursive
-from store import store_spec_list, store_config, get_temp_dir, store_snapshot
+from models import Config, Snapshot, ManifestEntry, ServiceClassConfig, \
+    Shard, ExecutionPlan, PlanTask, \
+    DEFAULT_LISTING_TIMEOUT
+from utils import get_config_from_environment, get_now_timestamp, abort, \
+    prune_spec_list
+from cmds import get_inventory, get_inventory_async, get_selected_fields, \
+    resolve_target_projects, STATUS_OK, STATUS_UNAVAILABLE, STATUS_FAILED
+from cache import NegativeCache, load_services_cache, save_services_cache
+from executor import execute
+from plan import Plan, TaskCosts, compile_plan, to_json, load_task_costs, \
+    get_estimate
+from timings import span, reset as reset_timings, get_timings
+from ratelimit import configure as configure_limiter, get_limiter
+from uploader import Uploader
+from shard import get_shard, load_plan, claim_plan, load_costs, get_work, \
+    finalize_shard
+from store import store_spec_list, store_config, get_temp_dir, \
+    store_snapshot, store_manifest, store_timings, discard_spec_list, \
+    load_previous_snapshot, get_spec_list_path, get_output_format, \
+    OutputFormat, FORMATS, store_archive
+from archive import ARCHIVE_FILE, CONTENT_TYPE as ARCHIVE_CONTENT_TYPE
 
 
 debug = logging.debug
 info = logging.info
 error = logging.error
+warning = logging.warning
 
 
-def get_listings(project: str,
-                 service: GCPService,
-                 location: Union[str, None] = None) -> List[Spec]:
+NegativeCaches = Union[Dict[str, NegativeCache], None]
+Failures = Union[Set[Tuple[str, str]], None]
+Selections = Union[Dict[str, ServiceClassConfig], None]
 
-    info(f"* Retrieving {service.__name__} instance(s) "
-         f"from location({location or 'all'}) ...")
-    specs: List[Spec] = get_inventory(project, service, location)
-    return specs
 
+def record_listing(caches: NegativeCaches,
+                   task: PlanTask,
+                   specs: List[Spec]):
+    """
+    Only the listings requiring a location are recorded
+    in the negative cache of the project
+    """
+    if caches is None or task.Location is None:
+        return
 
-def list_with_locations(project: str,
-                        service: GCPService,
-                        locations: str) -> List[Spec]:
+    status = getattr(specs, "status", STATUS_OK)
+    if status == STATUS_FAILED:
+        return
 
-    all_entries: List[Spec] = []
+    caches[task.Project].record(task.ServiceClass.__name__, task.Location,
+                                status == STATUS_UNAVAILABLE)
 
-    location_list: List[str] = locations.split(";")
-    location: str
 
-    for location in location_list:
-        entries = get_listings(project, service, location)
-        all_entries.extend(entries)
+def record_failure(failed: Failures,
+                   task: PlanTask,
+                   specs: List[Spec]):
+    """
+    The (project, service class) of a failed listing
+    """
+    if failed is not None and \
+            getattr(specs, "status", STATUS_OK) == STATUS_FAILED:
+        failed.add((task.Project, task.ServiceClass.__name__))
 
-    return all_entries
 
+def get_listings(task: PlanTask,
+                 backend: str = "gcloud",
+                 caches: NegativeCaches = None,
+                 page_size: int = 0,
+                 selections: Selections = None,
+                 failed: Failures = None) -> List[Spec]:
 
-def list_no_location(project: str,
-                     service: GCPService) -> List[Spec]:
-    return get_listings(project, service, None)
+    service = task.ServiceClass
+    info(f"* Retrieving {service.__name__} instance(s) "
+         f"from location({task.Location or 'all'}) ...")
+    specs: List[Spec] = \
+        get_inventory(task.Project, service, task.Location, backend=backend,
+                      page_size=page_size,
+                      selection=(selections or {}).get(service.__name__),
+                      argv=task.Argv or None)
+    record_listing(caches, task, specs)
+    record_failure(failed, task, specs)
+    return specs
 
 
-def run(path: str = 'config.yaml'):
+async def get_listings_async(task: PlanTask,
+                             timeout: int = DEFAULT_LISTING_TIMEOUT,
+                             caches: NegativeCaches = None,
+                             page_size: int = 0,
+                             selections: Selections = None,
+                             failed: Failures = None
+                             ) -> List[Spec]:
+
+    service = task.ServiceClass
+    info(f"* Retrieving {service.__name__} instance(s) "
+         f"from location({task.Location or 'all'}) ...")
+    specs: List[Spec] = \
+        await get_inventory_async(
+            task.Project, service, task.Location, timeout,
+            page_size=page_size,
+            selection=(selections or {}).get(service.__name__),
+            argv=task.Argv or None)
+    record_listing(caches, task, specs)
+    record_failure(failed, task, specs)
+    return specs
+
+
+def is_known_unavailable(caches: Dict[str, NegativeCache],
+                         project: str,
+                         service: GCPService,
+                         location: Union[str, None]) -> bool:
+
+    if location is None:
+        return False
+
+    if caches[project].is_unavailable(service.__name__, location):
+        info(f"> Skipping {service.__name__} in location '{location}' "
+             f"of project '{project}': known to be unavailable")
+        return True
+
+    return False
 
-    config: Config = get_config_from_environment()
-    info(f"> Configuration: {config}")
 
-    project: str = config.TargetProjectId
+def get_project_services(project: str) -> List[GCPService]:
 
-    liste: List[ServiceDescription] = \
-        cmd_retrieve_enabled_services(project)
+    with span("services", project) as _span:
+        liste: List[ServiceDescription] = \
+            cmd_retrieve_enabled_services(project)
+        _span.Entries = len(liste)
 
-    debug(f"> List of services enabled: {liste}")
+    debug(f"> List of services enabled in '{project}': {liste}")
 
     services: List[GCPService] = \
         get_service_classes_from_services_list(liste)
 
-    info(f"> List of supported services in the project: {services}")
+    info(f"> List of supported services in the project '{project}': "
+         f"{services}")
+
+    return services
+
+
+def resolve_project_services(config: Config,
+                             refresh: bool,
+                             project: str) -> Tuple[List[GCPService], bool]:
+    """
+    The supported service classes of a project, from the cache if
+    it is fresh enough, else from the list of enabled services
+
+    Returns (service classes, True if from the cache)
+    """
+    if config.ServicesCacheTtl > 0 and not refresh:
+        names = load_services_cache(config, project)
+        if names is not None:
+            services: List[GCPService] = \
+                [lookup(name) for name in names if lookup(name) is not None]
+            info(f"> Supported services in the project '{project}' "
+                 f"(cached): {services}")
+            return services, True
+
+    services = get_project_services(project)
+
+    if config.ServicesCacheTtl > 0:
+        save_services_cache(config, project,
+                            [service.__name__ for service in services])
+
+    return services, False
+
+
+def check_selections(config: Config):
+
+    from rest import has_endpoint
+
+    for name, selection in config.ServiceClasses.items():
+        if lookup(name) is None:
+            warning(f"! Unknown service class in ServiceClasses: {name}")
+        if selection.Filter and config.Backend == "rest" and \
+                has_endpoint(name):
+            warning(f"! The filter of {name} is not applied "
+                    "with the 'rest' backend")
+
+
+def select_services(config: Config,
+                    projects_services: List[Tuple[str, List[GCPService]]]
+                    ) -> List[Tuple[str, List[GCPService]]]:
+    """
+    Excludes the service classes disabled through `ServiceClasses`
+    """
+    def enabled(service: GCPService) -> bool:
+        selection = config.ServiceClasses.get(service.__name__, None)
+        return selection is None or selection.Enabled
+
+    return [
+        (project, [service for service in services if enabled(service)])
+        for project, services in projects_services
+    ]
+
+
+def revalidate_services(config: Config,
+                        projects_services: List[Tuple[str, List[GCPService]]],
+                        revalidations: Dict[str, Future]
+                        ) -> List[Tuple[str, List[GCPService]]]:
+    """
+    Compares the cached service classes with the current ones,
+    updates the caches and returns the service classes missed
+    """
+    extra: List[Tuple[str, List[GCPService]]] = []
+
+    for project, services in projects_services:
+        future = revalidations.get(project, None)
+        if future is None:
+            continue
+
+        try:
+            current: List[GCPService] = future.result()
+        except (Exception, SystemExit) as e:
+            error(f"! Unable to revalidate the services of '{project}': {e}")
+            continue
+
+        missed = [service for service in current if service not in services]
+        if len(missed) > 0:
+            info(f"> Services enabled in '{project}' since the cache "
+                 f"was refreshed: {missed}")
+            extra.append((project, missed))
+
+        save_services_cache(config, project,
+                            [service.__name__ for service in current])
+
+    return extra
+
+
+def run(path: str = 'config.yaml', refresh: bool = False,
+        plan_only: bool = False):
+    """
+    refresh: forces the refresh of the cached service classes
+    plan_only: prints the plan of the listings instead of executing it
+    """
+    reset_timings()
+
+    with span("run"):
+        inventory(refresh, plan_only)
+
+
+def inventory(refresh: bool, plan_only: bool = False):
+
+    config: Config = get_config_from_environment()
+    info(f"> Configuration: {config}")
+
+    #
+    # The deadline runs from here
+    #
+    configure_limiter(config)
+
+    projects: List[str] = resolve_target_projects(config.TargetProjectId)
+    if len(projects) == 0:
+        abort(f"! No project matches: {config.TargetProjectId}")
+
+    info(f"> Inventoring project(s): {projects}")
+
+    previous: Dict[str, Union[Snapshot, None]] = {}
+    caches: NegativeCaches = None
+
+    refresh = refresh or config.RefreshServices
+
+    with ThreadPoolExecutor(max_workers=config.MaxConcurrency) as pool:
+        resolved: List[Tuple[List[GCPService], bool]] = list(pool.map(
+            partial(resolve_project_services, config, refresh), projects))
+
+        if config.Incremental:
+            previous = dict(zip(projects, pool.map(
+                partial(load_previous_snapshot, config), projects)))
+
+        if config.NegativeCacheTtl > 0:
+            caches = dict(zip(projects, pool.map(
+                partial(NegativeCache.load, config), projects)))
+
+        #
+        # The durations of the listings in the previous snapshots:
+        # the longest are started first
+        #
+        costs: Dict[str, TaskCosts] = dict(zip(projects, pool.map(
+            partial(load_task_costs, config), projects,
+            [previous.get(project) for project in projects])))
+
+    check_selections(config)
+
+    projects_services: List[Tuple[str, List[GCPService]]] = \
+        select_services(config, [
+            (project, services)
+            for project, (services, _) in zip(projects, resolved)
+        ])
+
+    #
+    # The cached service classes are revalidated in the background,
+    # along the listings
+    #
+    revalidation_pool = ThreadPoolExecutor(max_workers=config.MaxConcurrency)
+    revalidations: Dict[str, Future] = {
+        project: revalidation_pool.submit(get_project_services, project)
+        for project, (_, cached) in zip(projects, resolved)
+        if cached
+    }
 
     bucket = config.TargetBucket
     bucket_project = config.TargetBucketProject
-    locations: str = config.TargetLocations
 
-    info(f"> Inventoring project: {config.TargetProjectId}")
     info(f"> Bucket: gs://{bucket} in project '{bucket_project}'")
 
     ts = get_now_timestamp()
+
+    shard = get_shard()
+    if shard is not None and config.Archive:
+        abort("! Archive is not supported with several tasks")
+    if shard is not None:
+        ts, projects_services = plan_shard(config, shard, ts,
+                                           projects_services)
+
     info(f"> Using the following timestamp: {ts}")
 
-    processed_service_classes: List[str] = []
+    skip = partial(is_known_unavailable, caches) \
+        if caches is not None else None
+
+    #
+    # With the 'rest' backend, there is no command to compile
+    #
+    plan: Plan = compile_plan(projects_services, config.TargetLocations,
+                              config.PageSize, config.ServiceClasses, skip,
+                              with_argv=config.Backend != "rest",
+                              costs=costs)
+
+    if plan_only:
+        revalidation_pool.shutdown(cancel_futures=True)
+        print(to_json(plan))
+        return
+
+    fmt: OutputFormat = get_output_format(config.OutputFormat)
+    info(f"> Output format: {fmt.name}")
+
+    snapshots: Dict[str, Snapshot] = {
+        project: Snapshot(Timestamp=ts, Format=fmt.name,
+                          Archive=config.Archive)
+        for project in projects
+    }
+
+    engine = config.Engine
+
+    failed: Set[Tuple[str, str]] = set()
+
+    if config.Backend == "rest":
+        #
+        # The HTTP calls are blocking: they need the worker threads
+        #
+        from rest import configure as configure_rest
+        configure_rest(config.RestBaseUrl)
+        fnc = partial(get_listings, backend="rest", caches=caches,
+                      page_size=config.PageSize,
+                      selections=config.ServiceClasses, failed=failed)
+        engine = "threads"
+    elif engine == "asyncio":
+        fnc = partial(get_listings_async, timeout=config.ListingTimeout,
+                      caches=caches, page_size=config.PageSize,
+                      selections=config.ServiceClasses, failed=failed)
+    else:
+        fnc = partial(get_listings, caches=caches,
+                      page_size=config.PageSize,
+                      selections=config.ServiceClasses, failed=failed)
+
+    listings = execute(plan, fnc,
+                       max_concurrency=config.MaxConcurrency,
+                       engine=engine)
+
+    uploader = Uploader(config, max_workers=config.MaxConcurrency)
+
+    store_listings(listings, snapshots, previous, uploader, fmt,
+                   config.ServiceClasses)
+
+    #
+    # The services enabled since the cache was refreshed
+    # are inventoried in a second pass
+    #
+    extra: List[Tuple[str, List[GCPService]]] = select_services(
+        config, revalidate_services(config, projects_services, revalidations))
+    revalidation_pool.shutdown()
+
+    if len(extra) > 0 and shard is not None:
+        #
+        # The tasks share the service classes of the execution plan
+        #
+        warning(f"! Service classes enabled since cached: {extra}, "
+                "inventoried from the next execution")
+    elif len(extra) > 0:
+        plan = compile_plan(extra, config.TargetLocations, config.PageSize,
+                            config.ServiceClasses, skip,
+                            with_argv=config.Backend != "rest",
+                            costs=costs)
+        listings = execute(plan, fnc,
+                           max_concurrency=config.MaxConcurrency,
+                           engine=engine)
+        store_listings(listings, snapshots, previous, uploader, fmt,
+                       config.ServiceClasses)
 
-    for service_class in services:
+    try:
+        for project in projects:
+            snapshots[project].Failed = sorted(
+                name for _project, name in failed if _project == project)
+            cache = caches[project] if caches is not None else None
+            finalize_project(config, project, snapshots[project], uploader,
+                             shard, cache)
+    finally:
+        uploader.close()
 
-        service_class_name = service_class.__name__
+    info("> Done")
+
+
+def estimate(refresh: bool = False) -> dict:
+    """
+    The run time of the inventory predicted from the timings of the
+    previous snapshots, without running any listing
+
+    With several tasks (see `shard`), the workers of all the tasks
+    are counted as one pool: the estimate is then a lower bound.
+    """
+    config: Config = get_config_from_environment()
+
+    projects: List[str] = resolve_target_projects(config.TargetProjectId)
+    if len(projects) == 0:
+        abort(f"! No project matches: {config.TargetProjectId}")
 
-        requires_location = service_class.LISTING_REQUIRES_LOCATION
+    refresh = refresh or config.RefreshServices
 
-        specs: List[Spec] = []
+    with ThreadPoolExecutor(max_workers=config.MaxConcurrency) as pool:
+        resolved: List[Tuple[List[GCPService], bool]] = list(pool.map(
+            partial(resolve_project_services, config, refresh), projects))
+        costs: Dict[str, TaskCosts] = dict(zip(projects, pool.map(
+            partial(load_task_costs, config), projects)))
 
-        if requires_location:
-            specs = list_with_locations(project, service_class, locations)
-        else:
-            specs = list_no_location(project, service_class)
+    projects_services: List[Tuple[str, List[GCPService]]] = \
+        select_services(config, [
+            (project, services)
+            for project, (services, _) in zip(projects, resolved)
+        ])
+
+    plan: Plan = compile_plan(projects_services, config.TargetLocations,
+                              with_argv=False, costs=costs)
+
+    return get_estimate(plan, config.MaxConcurrency * max(1, config.TaskCount))
+
+
+def store_listings(listings: Iterator[Tuple[str, GCPService, Iterable[Spec]]],
+                   snapshots: Dict[str, Snapshot],
+                   previous: Dict[str, Union[Snapshot, None]],
+                   uploader: Uploader,
+                   fmt: OutputFormat,
+                   selections: Selections = None):
+    """
+    Stores the listings of the service classes as they complete
+    and starts uploading them
+
+    The entries are restricted to the fields selected, if any.
+    """
+    for project, service_class, specs in listings:
+
+        service_class_name = service_class.__name__
+        snapshot = snapshots[project]
+        ts = snapshot.Timestamp
+
+        selected = get_selected_fields(
+            service_class, (selections or {}).get(service_class_name))
+        if selected is not None:
+            specs = prune_spec_list(specs, selected)
 
         try:
-            store_spec_list(config, ts, service_class_name, specs)
+            digest = store_spec_list(project, ts, service_class_name, specs,
+                                     fmt)
         except Exception as e:
             error(f"! Failed to store spec list: {e}")
             continue
 
-        processed_service_classes.append(service_class_name)
-        info(f"> Done with {service_class_name}")
+        snapshot.ServiceClasses.append(service_class_name)
+        entry = get_manifest_entry(project, service_class_name, digest,
+                                   snapshot, previous.get(project))
+        snapshot.Manifest[service_class_name] = entry
+
+        #
+        # With an archive, the file is uploaded as one of its members
+        #
+        if entry.Timestamp == ts and not snapshot.Archive:
+            uploader.submit(project,
+                            get_spec_list_path(project, ts,
+                                               service_class_name, fmt),
+                            f"{project}/{ts}/{service_class_name}"
+                            f"{fmt.extension}",
+                            fmt.content_type, fmt.content_encoding)
+
+        info(f"> Done with {service_class_name} in project '{project}'")
+
+
+def get_manifest_entry(project: str,
+                       service_class_name: str,
+                       digest: str,
+                       snapshot: Snapshot,
+                       previous: Union[Snapshot, None]) -> ManifestEntry:
+    """
+    An unchanged file is referenced from the snapshot where it
+    was last uploaded instead of being uploaded again
+
+    The hash covers the uncompressed content: a reference is thus
+    only valid between snapshots of the same format, both archived
+    or not.
+    """
+    ts = snapshot.Timestamp
+    fmt = FORMATS[snapshot.Format]
+
+    entry = previous.Manifest.get(service_class_name, None) \
+        if previous is not None and previous.Format == fmt.name \
+        and previous.Archive == snapshot.Archive else None
+
+    if entry is not None and entry.Hash == digest:
+        discard_spec_list(project, ts, service_class_name, fmt)
+        return entry
+
+    return ManifestEntry(Hash=digest, Timestamp=ts)
+
+
+def plan_shard(config: Config, shard: Shard, ts: str,
+               projects_services: List[Tuple[str, List[GCPService]]]
+               ) -> Tuple[str, List[Tuple[str, List[GCPService]]]]:
+    """
+    The timestamp and the service classes of the task, from
+    the plan of the execution (see `shard`)
+    """
+    plan = load_plan(config, shard)
+
+    if plan is None:
+        projects = [project for project, _ in projects_services]
+        with ThreadPoolExecutor(max_workers=config.MaxConcurrency) as pool:
+            costs = dict(zip(projects, pool.map(partial(load_costs, config),
+                                                projects)))
+        plan = claim_plan(config, shard, ExecutionPlan(
+            Timestamp=ts,
+            Services={project: [service.__name__ for service in services]
+                      for project, services in projects_services},
+            Costs=costs))
+
+    if set(plan.Services) != {project for project, _ in projects_services}:
+        abort(f"! The projects of the execution plan differ: "
+              f"{sorted(plan.Services)}")
+
+    work = get_work(plan, shard)
+    return plan.Timestamp, [
+        (project, [lookup(name) for name in names
+                   if lookup(name) is not None])
+        for project, names in work.items()
+    ]
+
+
+def finalize_project(config: Config, project: str, snapshot: Snapshot,
+                     uploader: Uploader, shard: Union[Shard, None] = None,
+                     cache: Union[NegativeCache, None] = None):
+    """
+    Writes the snapshot closing files of a project then uploads them
+    once all the service class files of the project are uploaded,
+    and saves its negative cache
+
+    With several tasks, this is left to the last one to complete.
+    """
+    snapshot.Retries = get_limiter().get_retries(project)
+
+    info(f"> Waiting for the uploads of project '{project}' to complete")
+
+    if not uploader.wait(project):
+        abort(f"! Failed to upload the files of project '{project}'")
+
+    #
+    # All the spans of the project are complete
+    #
+    timings: dict = get_timings().to_dict(project)
+
+    negative = cache.to_dict() if cache is not None else None
+
+    if shard is not None:
+        merged = finalize_shard(config, project, snapshot, timings,
+                                uploader, shard, negative)
+        if merged is None:
+            return
+        snapshot, timings, negative = merged
+
+    if negative is not None:
+        NegativeCache(config.NegativeCacheTtl, negative).save(config, project)
+
+    close_snapshot(config, project, snapshot, timings, uploader)
+
+
+def close_snapshot(config: Config, project: str, snapshot: Snapshot,
+                   timings: dict, uploader: Uploader):
+
+    ts = snapshot.Timestamp
+
+    #
+    # The service classes complete in any order
+    #
+    snapshot.ServiceClasses.sort()
+    snapshot.Manifest = dict(sorted(snapshot.Manifest.items()))
 
     try:
-        store_config(config, ts)
-        info("> Done with config")
+        store_config(config, project, ts)
+        store_manifest(project, ts, snapshot.Manifest)
+        info(f"> Done with config of project '{project}'")
     except Exception as e:
         abort(f"! Failed to store config: {e}")
 
-    snapshot: Snapshot = \
-        Snapshot(Timestamp=ts, ServiceClasses=processed_service_classes)
-
     try:
-        store_snapshot(config, snapshot)
-        info("> Done with snapshot 'latest'")
+        store_snapshot(project, snapshot)
+        info(f"> Done with snapshot 'latest' of project '{project}'")
     except Exception as e:
         abort(f"! Unable to create snapshot 'latest': {e}")
 
-    info(f"> Uploading files to bucket: gs//{config.TargetBucket}")
+    try:
+        store_timings(project, ts, timings)
+    except Exception as e:
+        abort(f"! Failed to store timings: {e}")
 
+    #
+    # The files closing the snapshot, in order:
+    # config.json signals the snapshot is complete
+    #
     tempdir = get_temp_dir()
-    result = upload_path_recursive(config.TargetBucketProject,
-                                   config.TargetBucket,
-                                   f"{tempdir}/{config.TargetProjectId}")
-
-    if not result.success:
-        abort(f"! Failed to upload files to bucket: {result.message}")
 
-    info("> Done")
+    uploads: List[Tuple[str, str, str]] = [
+        (f"{tempdir}/{project}/{ts}/{name}", f"{project}/{ts}/{name}",
+         "application/json")
+        for name in ["manifest.json", "timings.json", "config.json"]
+    ]
+
+    if snapshot.Archive:
+        #
+        # The archive holds all the files above
+        #
+        uploads = [(store_archive(project, snapshot),
+                    f"{project}/{ts}/{ARCHIVE_FILE}", ARCHIVE_CONTENT_TYPE)]
+
+    uploads.append((f"{tempdir}/{project}/latest.json",
+                    f"{project}/latest.json", "application/json"))
+
+    for file_path, object_path, content_type in uploads:
+        uploader.submit(project, file_path, object_path, content_type)
+        if not uploader.wait(project):
+            abort(f"! Failed to upload files to bucket: {object_path}")
@@ -0,0 +1,195 @@
+"""
+Scheduling of the listings against the API quotas
+
+* a token bucket per API (i.e. the service class `GROUP` e.g. 'compute')
+  paces the start of the listings
+* a listing throttled by its API (e.g. RESOURCE_EXHAUSTED, 429) is
+  retried after a jittered exponential backoff
+* past the deadline of the run, no listing is started nor retried
+
+The retries are counted per project & service class: they are
+recorded in the snapshot.
+
+https://cloud.google.com/apis/design/errors#handling_errors
+
+@author: jldupont
+"""
+import re
+import time
+import random
+import logging
+import threading
+from typing import Dict, Tuple, Union
+from pygcloud.models import GCPService  # type: ignore
+from models import Config, DEFAULT_MAX_RETRIES, DEFAULT_BACKOFF_BASE, \
+    DEFAULT_BACKOFF_MAX
+
+
+warning = logging.warning
+
+#
+# The HTTP status is only matched as such e.g. 'HTTPError 429',
+# '"code": 429': not any 429 of the message e.g. in a resource name
+#
+RETRYABLE = re.compile(r"RESOURCE_EXHAUSTED|RATE_LIMIT_EXCEEDED|"
+                       r"rateLimitExceeded|Quota exceeded|"
+                       r"Too Many Requests|"
+                       r"\b(?:code|status|HTTPError|HTTP/[\d.]+)"
+                       r"\"?[ :=]*429\b",
+                       re.IGNORECASE)
+
+
+def is_retryable(message: Union[str, None], code: int = 0) -> bool:
+    return code == 429 or RETRYABLE.search(message or "") is not None
+
+
+def get_api(service_class: GCPService) -> str:
+    """
+    The API of a service class e.g. ['beta', 'run'] -> 'run'
+    """
+    group = [name for name in getattr(service_class, "GROUP", [])
+             if name not in ["alpha", "beta"]]
+    return group[0] if group else service_class.__name__
+
+
+class TokenBucket:
+    """
+    Thread-safe. A token is reserved even when none is available:
+    the caller waits for the time returned, outside of the lock.
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """
+        Returns the seconds to wait before using the token
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens +
+                              (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+
+class Limiter:
+
+    def __init__(self,
+                 rate: float = 0,
+                 burst: int = 0,
+                 max_retries: int = DEFAULT_MAX_RETRIES,
+                 backoff_base: float = DEFAULT_BACKOFF_BASE,
+                 backoff_max: float = DEFAULT_BACKOFF_MAX,
+                 deadline: float = 0):
+        """
+        rate: 0 disables the token buckets
+        deadline: seconds from now, 0: none
+        """
+        self.rate = rate
+        self.burst = burst or max(1, int(rate))
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.deadline = time.monotonic() + deadline if deadline > 0 else None
+        self.buckets: Dict[str, TokenBucket] = {}
+        self.retries: Dict[Tuple[str, str], int] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config: Config):
+        return cls(rate=config.RateLimit,
+                   burst=config.RateBurst,
+                   max_retries=config.MaxRetries,
+                   backoff_base=config.BackoffBase,
+                   backoff_max=config.BackoffMax,
+                   deadline=config.Deadline)
+
+    def remaining(self) -> Union[float, None]:
+        if self.deadline is None:
+            return None
+        return self.deadline - time.monotonic()
+
+    def reserve(self, service_class: GCPService) -> Union[float, None]:
+        """
+        The seconds to wait before starting a listing,
+        None if the deadline would be passed
+        """
+        delay = 0.0
+        if self.rate > 0:
+            api = get_api(service_class)
+            with self._lock:
+                bucket = self.buckets.get(api, None)
+                if bucket is None:
+                    bucket = TokenBucket(self.rate, self.burst)
+                    self.buckets[api] = bucket
+            delay = bucket.reserve()
+
+        remaining = self.remaining()
+        if remaining is not None and delay >= remaining:
+            return None
+        return delay
+
+    def backoff(self, project: str, service_class: GCPService,
+                attempt: int) -> Union[float, None]:
+        """
+        The seconds to wait before retrying a throttled listing,
+        None if it is not to be retried
+
+        attempt: 0 for the first retry
+        """
+        name = service_class.__name__
+
+        if attempt >= self.max_retries:
+            warning(f"! {name} of project '{project}': still throttled "
+                    f"after {attempt} retries")
+            return None
+
+        delay = random.uniform(0, min(self.backoff_max,
+                                      self.backoff_base * 2 ** attempt))
+
+        remaining = self.remaining()
+        if remaining is not None and delay >= remaining:
+            warning(f"! {name} of project '{project}': throttled, "
+                    "no retry past the deadline")
+            return None
+
+        with self._lock:
+            key = (project, name)
+            self.retries[key] = self.retries.get(key, 0) + 1
+
+        warning(f"! {name} of project '{project}': throttled, "
+                f"retry {attempt + 1} in {delay:.1f}s")
+        return delay
+
+    def get_retries(self, project: str) -> Dict[str, int]:
+        with self._lock:
+            return {name: count
+                    for (_project, name), count in self.retries.items()
+                    if _project == project}
+
+
+LIMITER: Union[Limiter, None] = None
+
+
+def configure(config: Config) -> Limiter:
+    """
+    Set up the limiter shared by all the listings of the run
+    """
+    global LIMITER
+    LIMITER = Limiter.from_config(config)
+    return LIMITER
+
+
+def get_limiter() -> Limiter:
+    global LIMITER
+    if LIMITER is None:
+        LIMITER = Limiter()
+    return LIMITER
@@ -0,0 +1,386 @@
+"""
+REST listing backend
+
+The GCP list endpoints are called directly over keep-alive
+HTTP connections instead of starting one `gcloud` process per listing.
+The JSON payloads returned by the APIs are those `gcloud ... list
+--format json` prints for the service classes mapped in `ENDPOINTS`:
+the same `Spec` objects are thus produced through `SPEC_CLASS`.
+
+Service classes without a mapping (e.g. StorageBucket: `gcloud storage`
+reformats the API payload) are listed through `gcloud`.
+
+The snapshot files are also uploaded through the same connections.
+
+https://cloud.google.com/apis/design/design_patterns#list_pagination
+https://cloud.google.com/compute/docs/reference/rest/v1/addresses/aggregatedList
+
+@author: jldupont
+"""
+import os
+import json
+import uuid
+import logging
+import threading
+import http.client
+from dataclasses import dataclass
+from typing import List, Union, Dict, Tuple, Iterator, Iterable
+from urllib.parse import urlsplit, urlencode, quote
+from pygcloud.core import GCloud  # type: ignore
+from pygcloud.models import Result, GCPService  # type: ignore
+from pygcloud.gcp.models import Spec  # type: ignore
+from cmds import _get_inventory, parse_inventory_result, Listing, \
+    STATUS_FAILED
+from models import ServiceClassConfig
+from timings import span
+
+
+error = logging.error
+info = logging.info
+debug = logging.debug
+
+DEFAULT_TIMEOUT = 60
+
+
+@dataclass(frozen=True)
+class Endpoint:
+    """
+    host: API host when no base URL is configured
+    path: path template, with `project` and `location` placeholders
+    key: key of the list of entries in the response
+    aggregated: compute 'aggregatedList' i.e. entries grouped by scope
+    knative: Knative style API i.e. paginated through 'metadata.continue'
+             & 'continue' instead of 'nextPageToken' & 'pageToken'
+    """
+    host: str
+    path: str
+    key: str
+    aggregated: bool = False
+    knative: bool = False
+
+
+def _compute(collection: str) -> Endpoint:
+    return Endpoint("compute.googleapis.com",
+                    "/compute/v1/projects/{project}/aggregated/"
+                    f"{collection}",
+                    collection, aggregated=True)
+
+
+ENDPOINTS: Dict[str, Endpoint] = {
+    "ServicesAddress": _compute("addresses"),
+    "BackendService": _compute("backendServices"),
+    "SSLCertificateService": _compute("sslCertificates"),
+    "FwdRuleHTTPSProxyService": _compute("forwardingRules"),
+    "HTTPSProxyService": _compute("targetHttpsProxies"),
+    "CloudRunNeg": _compute("networkEndpointGroups"),
+    "UrlMap": _compute("urlMaps"),
+    "ServiceAccount": Endpoint("iam.googleapis.com",
+                               "/v1/projects/{project}/serviceAccounts",
+                               "accounts"),
+    "PubsubTopic": Endpoint("pubsub.googleapis.com",
+                            "/v1/projects/{project}/topics",
+                            "topics"),
+    "FirestoreDatabase": Endpoint("firestore.googleapis.com",
+                                  "/v1/projects/{project}/databases",
+                                  "databases"),
+    "CloudScheduler": Endpoint("cloudscheduler.googleapis.com",
+                               "/v1/projects/{project}"
+                               "/locations/{location}/jobs",
+                               "jobs"),
+    "TasksQueues": Endpoint("cloudtasks.googleapis.com",
+                            "/v2/projects/{project}"
+                            "/locations/{location}/queues",
+                            "queues"),
+    "CloudRun": Endpoint("run.googleapis.com",
+                         "/apis/serving.knative.dev/v1"
+                         "/namespaces/{project}/services",
+                         "items", knative=True),
+}
+
+UPLOAD_ENDPOINT = Endpoint("storage.googleapis.com",
+                           "/upload/storage/v1/b/{bucket}/o", "")
+
+
+class RestError(Exception):
+    """
+    Error returned by an API, formatted as `gcloud` does i.e.
+    "STATUS: message" e.g. "INVALID_ARGUMENT: Location ..."
+    """
+
+    def __init__(self, code: int, message: str):
+        super().__init__(message)
+        self.code = code
+
+
+class Session:
+    """
+    Keep-alive HTTP(S) connections, one per (scheme, host) and per thread
+
+    A connection dropped by the server is re-established once.
+    """
+
+    def __init__(self,
+                 base_url: Union[str, None] = None,
+                 token: Union[str, None] = None,
+                 timeout: int = DEFAULT_TIMEOUT):
+        self.base_url = base_url.rstrip("/") if base_url else None
+        self.timeout = timeout
+        self._token = token
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @property
+    def token(self) -> str:
+        with self._lock:
+            if self._token is None:
+                self._token = get_access_token()
+            return self._token
+
+    def url(self, endpoint: Endpoint, path: str) -> str:
+        return (self.base_url or f"https://{endpoint.host}") + path
+
+    def _connection(self, scheme: str, netloc: str) \
+            -> http.client.HTTPConnection:
+
+        connections = self._local.__dict__.setdefault("connections", {})
+        conn = connections.get((scheme, netloc), None)
+        if conn is None:
+            classe = http.client.HTTPSConnection if scheme == "https" \
+                else http.client.HTTPConnection
+            conn = classe(netloc, timeout=self.timeout)
+            connections[(scheme, netloc)] = conn
+        return conn
+
+    def request(self, method: str, url: str,
+                body: Union[bytes, Iterable[bytes], None] = None,
+                headers: Union[Dict[str, str], None] = None
+                ) -> Tuple[int, bytes]:
+
+        parts = urlsplit(url)
+        target = parts.path + (f"?{parts.query}" if parts.query else "")
+
+        _headers = {"Authorization": f"Bearer {self.token}"}
+        _headers.update(headers or {})
+
+        #
+        # A body can only be sent once
+        #
+        attempts = (1, 2) if body is None or isinstance(body, bytes) \
+            else (2,)
+
+        for attempt in attempts:
+            conn = self._connection(parts.scheme, parts.netloc)
+            try:
+                conn.request(method, target, body=body, headers=_headers)
+                response = conn.getresponse()
+                return response.status, response.read()
+            except (http.client.HTTPException, ConnectionError):
+                conn.close()
+                if attempt == 2:
+                    raise
+
+        raise AssertionError("unreachable")
+
+    def get_json(self, url: str, params: Dict[str, str]) -> dict:
+
+        query = urlencode(params)
+        status, data = self.request("GET", url + (f"?{query}"
+                                                  if query else ""))
+
+        if status != 200:
+            raise RestError(status, _error_message(status, data))
+
+        return json.loads(data or b"{}")
+
+
+def _error_message(status: int, data: bytes) -> str:
+    try:
+        err = json.loads(data)["error"]
+        return f"{err.get('status', status)}: {err.get('message', '')}"
+    except Exception:
+        return f"HTTP {status}: {data[:200]!r}"
+
+
+def get_access_token() -> str:
+    """
+    From the environment variable ACCESSTOKEN if available,
+    else from the active gcloud credentials
+    """
+    token = os.environ.get("ACCESSTOKEN", None)
+    if token:
+        return token
+
+    cmd = GCloud("auth", "print-access-token",
+                 cmd="gcloud",
+                 exit_on_error=False,
+                 log_error=True)
+    result: Result = cmd()
+    if not result.success:
+        raise RestError(result.code, "Unable to retrieve an access token")
+    return result.message
+
+
+SESSION: Union[Session, None] = None
+
+
+def configure(base_url: Union[str, None] = None,
+              token: Union[str, None] = None) -> Session:
+    """
+    Set up the session shared by all the listings of the run
+    """
+    global SESSION
+    SESSION = Session(base_url=base_url, token=token)
+    return SESSION
+
+
+def get_session() -> Session:
+    global SESSION
+    if SESSION is None:
+        SESSION = Session()
+    return SESSION
+
+
+def list_items(session: Session,
+               endpoint: Endpoint,
+               project: str,
+               location: Union[str, None] = None) -> Iterator[dict]:
+    """
+    Yields the entries of all the pages of a listing
+    """
+    path = endpoint.path.format(project=quote(project),
+                                location=quote(location or "-"))
+    url = session.url(endpoint, path)
+    params: Dict[str, str] = {}
+
+    while True:
+        page: dict = session.get_json(url, params)
+
+        if endpoint.aggregated:
+            scope: dict
+            for scope in page.get("items", {}).values():
+                yield from scope.get(endpoint.key, [])
+        else:
+            yield from page.get(endpoint.key, [])
+
+        if endpoint.knative:
+            token = (page.get("metadata", None) or {}).get("continue", None)
+        else:
+            token = page.get("nextPageToken", None)
+        if not token:
+            break
+        params["continue" if endpoint.knative else "pageToken"] = token
+
+
+def has_endpoint(service_class_name: str) -> bool:
+    """
+    Else the service class is listed through gcloud
+    """
+    return service_class_name in ENDPOINTS
+
+
+def get_inventory_rest(project: str,
+                       service_class: GCPService,
+                       location: Union[str, None] = None,
+                       page_size: int = 0,
+                       selection: Union[ServiceClassConfig, None] = None
+                       ) -> List[Spec]:
+    """
+    Same contract as `cmds.get_inventory`
+
+    page_size, selection: for the service classes listed through gcloud
+    """
+    endpoint = ENDPOINTS.get(service_class.__name__, None)
+
+    if endpoint is None:
+        debug(f"No REST endpoint for {service_class.__name__}: "
+              "listing through gcloud")
+        #
+        # Already paced & retried by the caller, see `cmds.get_inventory`
+        #
+        return _get_inventory(project, service_class, location,
+                              exit_on_error=False, backend="gcloud",
+                              page_size=page_size, selection=selection,
+                              argv=None)
+
+    name = service_class.__name__
+
+    with span("list", project, name, location) as _span:
+        try:
+            items: List[dict] = \
+                list(list_items(get_session(), endpoint, project, location))
+        except RestError as e:
+            result = Result(success=False, message=str(e), code=e.code)
+            listing = parse_inventory_result(service_class, location, result)
+            _span.Status = listing.status
+            return listing
+        except Exception as e:
+            error(f"Failed to list {name}: {e}")
+            _span.Status = STATUS_FAILED
+            return Listing(status=STATUS_FAILED)
+        _span.Entries = len(items)
+
+    spec_class: Spec = service_class.SPEC_CLASS  # type: ignore
+
+    with span("parse", project, name, location) as _span:
+        try:
+            specs: List[Spec] = [spec_class.from_obj(item) for item in items]
+        except Exception as e:
+            error(f"! Failed to parse entries related to {name}: {e}")
+            _span.Status = STATUS_FAILED
+            return Listing(status=STATUS_FAILED)
+        _span.Entries = len(specs)
+
+    return Listing(specs)
+
+
+def upload_object(bucket: str,
+                  file_path: str,
+                  object_path: str,
+                  content_type: Union[str, None] = None,
+                  content_encoding: Union[str, None] = None) -> Result:
+    """
+    Multipart upload i.e. the object metadata along the content
+
+    The file content is streamed from disk.
+    """
+    session = get_session()
+    boundary = uuid.uuid4().hex
+
+    metadata = {"name": object_path,
+                "contentType": content_type or "application/octet-stream"}
+    if content_encoding is not None:
+        metadata["contentEncoding"] = content_encoding
+
+    head = (f"--{boundary}\r\n"
+            "Content-Type: application/json; charset=UTF-8\r\n\r\n"
+            f"{json.dumps(metadata)}\r\n"
+            f"--{boundary}\r\n"
+            f"Content-Type: {metadata['contentType']}\r\n\r\n").encode()
+    tail = f"\r\n--{boundary}--\r\n".encode()
+
+    path = UPLOAD_ENDPOINT.path.format(bucket=quote(bucket, safe=""))
+    url = session.url(UPLOAD_ENDPOINT, path) + "?uploadType=multipart"
+
+    try:
+        with open(file_path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+
+            def body():
+                yield head
+                while chunk := f.read(1024 * 1024):
+                    yield chunk
+                yield tail
+
+            status, data = session.request(
+                "POST", url, body=body(),
+                headers={"Content-Type":
+                         f"multipart/related; boundary={boundary}",
+                         "Content-Length": str(len(head) + size + len(tail))})
+    except Exception as e:
+        return Result(success=False, message=str(e), code=1)
+
+    if status != 200:
+        return Result(success=False,
+                      message=_error_message(status, data), code=status)
+
+    return Result(success=True, message=data.decode(), code=0)
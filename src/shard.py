@@ -0,0 +1,329 @@
+"""
+Sharded execution across the tasks of a Cloud Run Job execution
+
+With `TaskCount` > 1, the Cloud Run Job runs that many tasks in parallel
+(`CLOUD_RUN_TASK_INDEX` / `CLOUD_RUN_TASK_COUNT`). Each inventories a
+share of the (project, service class) pairs. A service class file
+gathers all the locations of the service class: it is the unit of work.
+
+1. Plan: the first task to start decides the timestamp, the service
+   classes of each project and their costs (i.e. the listing time in the
+   previous snapshot, from its `timings.json`). The plan is written to
+   `_shards/{EXECUTION}/plan.json` only if not there already: the other
+   tasks use the plan found there.
+
+2. Partition: the pairs are assigned to the tasks, longest first, each
+   to the least loaded task (LPT). Each task computes the same partition
+   from the same plan.
+
+3. Each task uploads its service class files then a marker, i.e.
+   `{PROJECT}/{TIMESTAMP}/_shards/{INDEX}.json`, holding its part of the
+   snapshot, timings & negative cache (see `cache`).
+
+4. Finalize: the task that sees the markers of all the tasks, once its
+   own is uploaded, claims the finalization and writes the files closing
+   the snapshot from the merged markers: config.json and latest.json
+   are thus written once all the tasks have completed. It alone saves
+   the negative cache of the project.
+
+https://cloud.google.com/run/docs/container-contract#jobs-env-vars
+
+@author: jldupont
+"""
+import os
+import json
+import heapq
+import logging
+from typing import List, Dict, Tuple, Union
+from models import Config, Shard, ExecutionPlan, Snapshot
+from store import get_temp_dir, load_previous_timings
+from plan import get_task_costs
+from cmds import cat_object, create_object, list_objects
+from uploader import Uploader
+from utils import abort
+
+
+info = logging.info
+warning = logging.warning
+
+SHARDS_PREFIX = "_shards"
+DEFAULT_COST = 1.0
+
+Work = Tuple[str, str]
+
+
+def get_shard() -> Union[Shard, None]:
+    """
+    The task of the execution, None unless several tasks are run
+    """
+    count = int(os.environ.get("CLOUD_RUN_TASK_COUNT", None) or 1)
+    if count <= 1:
+        return None
+
+    return Shard(Index=int(os.environ.get("CLOUD_RUN_TASK_INDEX", 0)),
+                 Count=count,
+                 Execution=os.environ.get("CLOUD_RUN_EXECUTION", "local"))
+
+
+def get_costs(timings: dict) -> Dict[str, float]:
+    """
+    The seconds spent listing each service class, all locations
+    """
+    costs: Dict[str, float] = {}
+    for (name, _), cost in get_task_costs(timings).items():
+        costs[name] = round(costs.get(name, 0.0) + cost, 6)
+    return costs
+
+
+def load_costs(config: Config, project: str) -> Dict[str, float]:
+    """
+    From the timings of the previous snapshot, if any
+    """
+    timings = load_previous_timings(config, project)
+    return get_costs(timings) if timings is not None else {}
+
+
+def get_plan_object_path(shard: Shard) -> str:
+    return f"{SHARDS_PREFIX}/{shard.Execution}/plan.json"
+
+
+def load_plan(config: Config, shard: Shard) -> Union[ExecutionPlan, None]:
+    result = cat_object(config.TargetBucketProject, config.TargetBucket,
+                        get_plan_object_path(shard))
+    if not result.success:
+        return None
+    return ExecutionPlan(**json.loads(result.message))
+
+
+def claim_plan(config: Config, shard: Shard,
+               plan: ExecutionPlan) -> ExecutionPlan:
+    """
+    Writes the plan unless another task did first
+
+    Returns the plan of the execution
+    """
+    path = f"{get_temp_dir()}/plan.json"
+    with open(path, "w") as f:
+        f.write(plan.to_json())
+
+    result = create_object(config.TargetBucketProject, config.TargetBucket,
+                           path, get_plan_object_path(shard))
+    if result.success:
+        info(f"> Execution plan written by task {shard.Index}")
+        return plan
+
+    existing = load_plan(config, shard)
+    if existing is None:
+        abort(f"! Unable to write or read the execution plan: "
+              f"{result.message}")
+    return existing  # type: ignore
+
+
+def partition(costs: Dict[Work, float], count: int) -> List[List[Work]]:
+    """
+    Longest processing time first: each work goes to the least loaded
+    shard. Deterministic: ties are broken by the work, then by the index
+    of the shard.
+    """
+    shards: List[List[Work]] = [[] for _ in range(count)]
+    loads: List[Tuple[float, int]] = [(0.0, index) for index in range(count)]
+
+    for work in sorted(costs, key=lambda work: (-costs[work], work)):
+        load, index = heapq.heappop(loads)
+        shards[index].append(work)
+        heapq.heappush(loads, (load + costs[work], index))
+
+    return shards
+
+
+def get_work(plan: ExecutionPlan, shard: Shard) -> Dict[str, List[str]]:
+    """
+    The service class names of each project assigned to a shard
+    """
+    costs: Dict[Work, float] = {}
+
+    for project, names in plan.Services.items():
+        known = plan.Costs.get(project, {})
+        #
+        # Service classes without history cost the average
+        #
+        default = sum(known.values()) / len(known) if known \
+            else DEFAULT_COST
+        for name in names:
+            costs[(project, name)] = known.get(name, default)
+
+    work: Dict[str, List[str]] = {project: [] for project in plan.Services}
+    for project, name in partition(costs, shard.Count)[shard.Index]:
+        work[project].append(name)
+
+    info(f"> Task {shard.Index}/{shard.Count}: "
+         f"{sum(len(names) for names in work.values())} service class(es)")
+    return work
+
+
+def get_marker_object_path(project: str, ts: str, index: int) -> str:
+    return f"{project}/{ts}/{SHARDS_PREFIX}/{index}.json"
+
+
+def store_marker(project: str, ts: str, shard: Shard,
+                 snapshot: Snapshot, timings: dict,
+                 negative: Union[dict, None] = None) -> str:
+    """
+    Returns the path of the local file
+
+    negative: the entries of the negative cache of the project
+    """
+    base_path = f"{get_temp_dir()}/{project}/{ts}/{SHARDS_PREFIX}"
+    os.makedirs(base_path, exist_ok=True)
+
+    path = f"{base_path}/{shard.Index}.json"
+    with open(path, "w") as f:
+        json.dump({"Index": shard.Index,
+                   "Snapshot": snapshot.to_dict(),
+                   "Timings": timings,
+                   "Negative": negative}, f)
+    return path
+
+
+def is_complete(config: Config, project: str, ts: str, shard: Shard) -> bool:
+    """
+    All the tasks uploaded their marker
+    """
+    prefix = f"{project}/{ts}/{SHARDS_PREFIX}/"
+    names = {path[len(prefix):] for path in
+             list_objects(config.TargetBucketProject, config.TargetBucket,
+                          prefix)}
+    return all(f"{index}.json" in names for index in range(shard.Count))
+
+
+def claim_finalize(config: Config, project: str, ts: str,
+                   shard: Shard) -> bool:
+    """
+    Only one task finalizes the snapshot of a project
+    """
+    path = f"{get_temp_dir()}/{project}/{ts}/{SHARDS_PREFIX}/finalize"
+    with open(path, "w") as f:
+        f.write(str(shard.Index))
+
+    result = create_object(config.TargetBucketProject, config.TargetBucket,
+                           path, f"{project}/{ts}/{SHARDS_PREFIX}/finalize")
+    return result.success
+
+
+def load_markers(config: Config, project: str, ts: str,
+                 shard: Shard) -> List[dict]:
+    markers: List[dict] = []
+    for index in range(shard.Count):
+        result = cat_object(config.TargetBucketProject, config.TargetBucket,
+                            get_marker_object_path(project, ts, index))
+        if not result.success:
+            abort(f"! Unable to read the marker of task {index}: "
+                  f"{result.message}")
+        markers.append(json.loads(result.message))
+    return markers
+
+
+def merge_markers(markers: List[dict]) -> Tuple[Snapshot, dict]:
+    """
+    The snapshot and the timings of the project, from all the tasks
+
+    The spans are tagged with the index of their task: their
+    start is relative to the start of their task.
+    """
+    snapshot: Union[Snapshot, None] = None
+    spans: List[dict] = []
+    shards: List[dict] = []
+
+    for marker in sorted(markers, key=lambda marker: marker["Index"]):
+        part = Snapshot.from_json(json.dumps(marker["Snapshot"]))
+        if snapshot is None:
+            snapshot = Snapshot(Timestamp=part.Timestamp, Format=part.Format,
+                                Archive=part.Archive)
+
+        snapshot.ServiceClasses.extend(part.ServiceClasses)
+        snapshot.Manifest.update(part.Manifest)
+        snapshot.Retries.update(part.Retries)
+        snapshot.Failed.extend(part.Failed)
+
+        timings = marker["Timings"]
+        shards.append({"Index": marker["Index"],
+                       "Started": timings["Started"],
+                       "Elapsed": timings["Elapsed"]})
+        spans.extend(dict(span, Shard=marker["Index"])
+                     for span in timings["Spans"])
+
+    assert snapshot is not None, "No marker to merge"
+
+    snapshot.Manifest = dict(sorted(snapshot.Manifest.items()))
+    snapshot.Failed.sort()
+
+    started = min(shard["Started"] for shard in shards)
+    ended = max(shard["Started"] + shard["Elapsed"] for shard in shards)
+
+    return snapshot, {
+        "Started": started,
+        "Elapsed": round(ended - started, 6),
+        "Shards": shards,
+        "Spans": spans,
+    }
+
+
+def merge_negative_entries(markers: List[dict]) -> Union[dict, None]:
+    """
+    The entries of the negative cache of the project, from all the tasks
+
+    All the tasks start from the same entries: those of a service class
+    are taken from the task that listed it, the others are kept as is.
+    """
+    parts = [(set(marker["Snapshot"].get("ServiceClasses", [])),
+              marker["Negative"]) for marker in markers
+             if marker.get("Negative", None) is not None]
+    if len(parts) == 0:
+        return None
+
+    listed = set().union(*(names for names, _ in parts))
+
+    entries: Dict[str, float] = {}
+    for names, negative in parts:
+        for key, expiry in negative.items():
+            name = key.split("@")[0]
+            if name in names or name not in listed:
+                entries[key] = max(expiry, entries.get(key, 0))
+    return entries
+
+
+def finalize_shard(config: Config, project: str, snapshot: Snapshot,
+                   timings: dict, uploader: Uploader, shard: Shard,
+                   negative: Union[dict, None] = None
+                   ) -> Union[Tuple[Snapshot, dict, Union[dict, None]], None]:
+    """
+    Uploads the marker of the task
+
+    Returns the snapshot, timings & negative cache entries merged from
+    all the tasks if this task is to close the snapshot of the project,
+    else None
+    """
+    ts = snapshot.Timestamp
+
+    path = store_marker(project, ts, shard, snapshot, timings, negative)
+    uploader.submit(project, path,
+                    get_marker_object_path(project, ts, shard.Index),
+                    "application/json")
+    if not uploader.wait(project):
+        abort(f"! Failed to upload the marker of task {shard.Index} "
+              f"for project '{project}'")
+
+    if not is_complete(config, project, ts, shard):
+        info(f"> Task {shard.Index}: other tasks still running "
+             f"for project '{project}'")
+        return None
+
+    if not claim_finalize(config, project, ts, shard):
+        info(f"> Task {shard.Index}: project '{project}' finalized "
+             "by another task")
+        return None
+
+    info(f"> Task {shard.Index}: finalizing project '{project}'")
+    markers = load_markers(config, project, ts, shard)
+    snapshot, timings = merge_markers(markers)
+    return snapshot, timings, merge_negative_entries(markers)
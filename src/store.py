@@ -5,50 +5,239 @@ gcloud storage cp OBJECT_LOCATION gs://DESTINATION_BUCKET_NAME
 
 @author: jldupont
 """
+import io
+import os
+import gzip
+import json
+import hashlib
 import logging
-from typing import List
+from dataclasses import dataclass
+from typing import Dict, List, Tuple, Union, Iterable, Iterator, Callable, \
+    BinaryIO
 from tempfile import mkdtemp
 from pygcloud.tools import mkdir  # type: ignore
 from pygcloud.gcp.models import Spec  # type: ignore
-from models import Config, Snapshot
-from utils import spec_list_to_json
+from models import Config, Snapshot, ManifestEntry
+from utils import write_spec_list_json, write_spec_list_ndjson
+from cmds import cat_object, cat_object_range
+from archive import ARCHIVE_FILE, TAIL_SIZE, TRAILER, pack, parse_trailer, \
+    parse_toc, open_binary, get_members
+from timings import span
+
+try:
+    import zstandard  # type: ignore
+except ImportError:
+    zstandard = None
 
 
 error = logging.error
 info = logging.info
+warning = logging.warning
+
+#
+# Created on first use, not at import
+#
+TEMPDIR: Union[str, None] = None
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+
+@dataclass(frozen=True)
+class OutputFormat:
+    """
+    The format of the service class files
+
+    content_encoding: also used as 'Content-Encoding' of the bucket objects
+    """
+    name: str
+    extension: str
+    content_type: str
+    content_encoding: Union[str, None]
+    writer: Callable
+
+
+FORMATS: Dict[str, OutputFormat] = {
+    "json": OutputFormat("json", ".json", "application/json",
+                         None, write_spec_list_json),
+    "ndjson": OutputFormat("ndjson", ".ndjson", "application/x-ndjson",
+                           None, write_spec_list_ndjson),
+    "ndjson.gz": OutputFormat("ndjson.gz", ".ndjson.gz",
+                              "application/x-ndjson",
+                              "gzip", write_spec_list_ndjson),
+    "ndjson.zst": OutputFormat("ndjson.zst", ".ndjson.zst",
+                               "application/x-ndjson",
+                               "zstd", write_spec_list_ndjson),
+}
+
+
+def get_output_format(name: Union[str, None]) -> OutputFormat:
+    """
+    'ndjson.zst' falls back to 'ndjson.gz'
+    if the package 'zstandard' is not available
+    """
+    name = name or "json"
+    if name == "ndjson.zst" and zstandard is None:
+        warning("! Package 'zstandard' not available, using 'ndjson.gz'")
+        name = "ndjson.gz"
+    return FORMATS[name]
+
+
+def _open_for_writing(path: str, fmt: OutputFormat):
+
+    if fmt.content_encoding == "gzip":
+        #
+        # mtime=0 : identical content yields identical bytes
+        #
+        return gzip.GzipFile(path, mode="wb", mtime=0)
 
-TEMPDIR = mkdtemp()
+    if fmt.content_encoding == "zstd":
+        return zstandard.ZstdCompressor().stream_writer(open(path, "wb"))
+
+    return open(path, "wb")
+
+
+def _open_for_reading(raw: BinaryIO) -> io.TextIOBase:
+    """
+    The compression is detected from the content rather than from the
+    file name: objects stored with 'Content-Encoding: gzip' are usually
+    decompressed on download
+    """
+    magic = raw.read(4)
+    raw.seek(0)
+
+    if magic.startswith(GZIP_MAGIC):
+        return io.TextIOWrapper(gzip.GzipFile(fileobj=raw),  # type: ignore
+                                encoding="utf-8")
+
+    if magic.startswith(ZSTD_MAGIC):
+        if zstandard is None:
+            raise ValueError("Package 'zstandard' required to read: "
+                             f"{getattr(raw, 'name', 'archive member')}")
+        reader = zstandard.ZstdDecompressor().stream_reader(raw)
+        return io.TextIOWrapper(reader, encoding="utf-8")
+
+    return io.TextIOWrapper(raw, encoding="utf-8")  # type: ignore
+
+
+def read_spec_stream(raw: BinaryIO, name: str) -> Iterator[dict]:
+    """
+    Yields the entries of the content of a service class file
+    named `name`, whatever its format
+    """
+    with raw, _open_for_reading(raw) as f:
+        if ".ndjson" in name:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from json.load(f)
+
+
+def read_spec_dicts(path: str) -> Iterator[dict]:
+    """
+    Yields the entries of a service class file, whatever its format
+
+    The file may be a member of an archive (see `archive`)
+    """
+    yield from read_spec_stream(open_binary(path), os.path.basename(path))
 
 
-def get_temp_dir():
+def get_temp_dir() -> str:
     global TEMPDIR
+    if TEMPDIR is None:
+        TEMPDIR = mkdtemp()
     return TEMPDIR
 
 
-def store_spec_list(config: Config,
+class HashingWriter:
+    """
+    Writes text to a binary file whilst computing the sha256 of the content
+    """
+
+    def __init__(self, f):
+        self._f = f
+        self._hash = hashlib.sha256()
+        self.size = 0
+
+    def write(self, text: str):
+        data = text.encode()
+        self._hash.update(data)
+        self._f.write(data)
+        self.size += len(data)
+
+    def hexdigest(self) -> str:
+        return self._hash.hexdigest()
+
+
+def get_spec_list_path(project: str, ts: str, service_class_name: str,
+                       fmt: OutputFormat = FORMATS["json"]) -> str:
+    return f"{get_temp_dir()}/{project}/{ts}/" \
+        f"{service_class_name}{fmt.extension}"
+
+
+def store_spec_list(project: str,
                     ts: str,
                     service_class_name: str,
-                    specs: List[Spec]):
+                    specs: Iterable[Spec],
+                    fmt: OutputFormat = FORMATS["json"]) -> str:
+    """
+    The specs are serialized to the file as they are produced
 
-    base_path = f"{config.TargetProjectId}/{ts}"
-    path = f"{TEMPDIR}/{base_path}/{service_class_name}.json"
-    liste: str = spec_list_to_json(specs)
+    Returns the sha256 of the file content, before compression
+    """
+    base_path = f"{project}/{ts}"
+    path = get_spec_list_path(project, ts, service_class_name, fmt)
 
-    mkdir(f"{TEMPDIR}/{base_path}")
+    mkdir(f"{get_temp_dir()}/{base_path}")
 
     info(f"> Writing inventory to temporary file: {path}")
 
-    with open(path, 'w') as f:
-        f.write(liste)
+    count = 0
+
+    def counted() -> Iterator[Spec]:
+        nonlocal count
+        for spec in specs:
+            count += 1
+            yield spec
+
+    with span("store", project, service_class_name) as _span:
+        try:
+            with _open_for_writing(path, fmt) as f:
+                writer = HashingWriter(f)
+                fmt.writer(counted(), writer.write)
+        except Exception:
+            #
+            # Never leave a partial file behind: it would get uploaded
+            #
+            os.remove(path)
+            raise
+        finally:
+            _span.Entries = count
+
+        _span.Bytes = os.path.getsize(path)
+
+    return writer.hexdigest()
+
+
+def discard_spec_list(project: str, ts: str, service_class_name: str,
+                      fmt: OutputFormat = FORMATS["json"]):
+    """
+    The file is referenced from a previous snapshot:
+    it does not need to be uploaded again
+    """
+    path = get_spec_list_path(project, ts, service_class_name, fmt)
+    info(f"> Unchanged since previous snapshot, not uploading: {path}")
+    os.remove(path)
 
 
-def store_config(config: Config, ts: str):
+def store_config(config: Config, project: str, ts: str):
 
-    base_path = f"{config.TargetProjectId}/{ts}"
-    path = f"{TEMPDIR}/{base_path}/config.json"
+    base_path = f"{project}/{ts}"
+    path = f"{get_temp_dir()}/{base_path}/config.json"
     obj_str: str = config.to_json()
 
-    mkdir(f"{TEMPDIR}/{base_path}")
+    mkdir(f"{get_temp_dir()}/{base_path}")
 
     info(f"> Writing config to temporary file: {path}")
 
@@ -56,14 +245,293 @@ def store_config(config: Config, ts: str):
         f.write(obj_str)
 
 
-def store_snapshot(config: Config, snapshot: Snapshot):
+def store_timings(project: str, ts: str, timings: dict):
+
+    path = f"{get_temp_dir()}/{project}/{ts}/timings.json"
+
+    info(f"> Writing timings to temporary file: {path}")
+
+    with open(path, 'w') as f:
+        json.dump(timings, f)
+
+
+def store_snapshot(project: str, snapshot: Snapshot):
     """
     This assumes the base path is already available
     """
-    path = f"{TEMPDIR}/{config.TargetProjectId}/latest.json"
+    path = f"{get_temp_dir()}/{project}/latest.json"
     obj_str: str = snapshot.to_json()
 
     info(f"> Writing 'latest.json' to temporary file: {path}")
 
     with open(path, 'w') as f:
         f.write(obj_str)
+
+
+def store_manifest(project: str, ts: str,
+                   manifest: Dict[str, ManifestEntry]):
+
+    path = f"{get_temp_dir()}/{project}/{ts}/manifest.json"
+    obj_str: str = json.dumps({name: entry.to_dict()
+                               for name, entry in manifest.items()})
+
+    info(f"> Writing manifest to temporary file: {path}")
+
+    with open(path, 'w') as f:
+        f.write(obj_str)
+
+
+def store_archive(project: str, snapshot: Snapshot) -> str:
+    """
+    Packs the files of the snapshot written in this run, i.e. the
+    service class files then manifest.json, timings.json and config.json,
+    into a single archive (see `archive`)
+
+    Returns the path of the archive
+    """
+    ts = snapshot.Timestamp
+    fmt = FORMATS[snapshot.Format]
+    base_path = f"{get_temp_dir()}/{project}/{ts}"
+
+    files: List[Tuple[str, str]] = [
+        (f"{name}{fmt.extension}", f"{base_path}/{name}{fmt.extension}")
+        for name, entry in snapshot.Manifest.items()
+        if entry.Timestamp == ts
+    ]
+    files.extend((name, f"{base_path}/{name}")
+                 for name in ["manifest.json", "timings.json", "config.json"])
+
+    path = f"{base_path}/{ARCHIVE_FILE}"
+    members = pack(path, files)
+
+    info(f"> Archive of {len(members)} file(s) written: {path}")
+    return path
+
+
+def load_archive_member(config: Config, project: str, ts: str,
+                        name: str) -> Union[bytes, None]:
+    """
+    A member of the archive of a snapshot in the bucket, through range
+    reads: the tail of the archive (usually the table of contents along
+    the trailer) then the member
+    """
+    object_path = f"{project}/{ts}/{ARCHIVE_FILE}"
+
+    def read(byte_range: str) -> Union[bytes, None]:
+        return cat_object_range(config.TargetBucketProject,
+                                config.TargetBucket, object_path, byte_range)
+
+    tail = read(f"-{TAIL_SIZE}")
+    if tail is None:
+        return None
+
+    try:
+        offset, size = parse_trailer(tail)
+        if size + TRAILER.size <= len(tail):
+            data = tail[-(size + TRAILER.size):-TRAILER.size]
+        else:
+            data = read(f"{offset}-{offset + size - 1}") or b""
+        member = parse_toc(data).get(name, None)
+    except ValueError as e:
+        error(f"! Invalid archive '{object_path}': {e}")
+        return None
+
+    if member is None:
+        return None
+    if member["Size"] == 0:
+        return b""
+
+    start = member["Offset"]
+    return read(f"{start}-{start + member['Size'] - 1}")
+
+
+def load_spec_dicts(config: Config, project: str,
+                    service_class_name: str) -> Iterator[dict]:
+    """
+    The entries of a service class in the snapshot 'latest' in the
+    bucket: only its file is retrieved, also from an archive
+    """
+    snapshot = load_previous_snapshot(config, project)
+    if snapshot is None:
+        raise ValueError(f"No snapshot of project '{project}'")
+
+    entry = snapshot.Manifest.get(service_class_name, None)
+    if entry is None:
+        raise ValueError(f"No {service_class_name} in snapshot "
+                         f"'{snapshot.Timestamp}' of project '{project}'")
+
+    name = f"{service_class_name}{FORMATS[snapshot.Format].extension}"
+
+    if snapshot.Archive:
+        data = load_archive_member(config, project, entry.Timestamp, name)
+    else:
+        #
+        # As is: the object may be compressed
+        #
+        data = cat_object_range(config.TargetBucketProject,
+                                config.TargetBucket,
+                                get_object_path(project, snapshot,
+                                                service_class_name), "0-")
+
+    if data is None:
+        raise ValueError(f"Unable to retrieve {name} of snapshot "
+                         f"'{entry.Timestamp}' of project '{project}'")
+
+    yield from read_spec_stream(io.BytesIO(data), name)
+
+
+def load_previous_snapshot(config: Config,
+                           project: str) -> Union[Snapshot, None]:
+    """
+    The snapshot 'latest' currently in the bucket, if any
+    """
+    result = cat_object(config.TargetBucketProject,
+                        config.TargetBucket,
+                        f"{project}/latest.json")
+    if not result.success:
+        info(f"> No previous snapshot found for project '{project}'")
+        return None
+
+    try:
+        return Snapshot.from_json(result.message)
+    except Exception as e:
+        error(f"! Unable to parse previous snapshot of '{project}': {e}")
+        return None
+
+
+def load_previous_timings(config: Config, project: str,
+                          previous: Union[Snapshot, None] = None
+                          ) -> Union[dict, None]:
+    """
+    The timings of the snapshot 'latest' currently in the bucket, if any
+
+    previous: the snapshot 'latest', if already loaded
+    """
+    if previous is None:
+        previous = load_previous_snapshot(config, project)
+    if previous is None:
+        return None
+
+    if previous.Archive:
+        data = load_archive_member(config, project, previous.Timestamp,
+                                   "timings.json")
+    else:
+        result = cat_object(config.TargetBucketProject, config.TargetBucket,
+                            f"{project}/{previous.Timestamp}/timings.json")
+        data = result.message.encode() if result.success else None
+
+    if data is None:
+        return None
+
+    try:
+        return json.loads(data)
+    except Exception as e:
+        warning(f"! Unable to parse the timings of '{project}': {e}")
+        return None
+
+
+def get_object_path(project: str, snapshot: Snapshot,
+                    service_class_name: str) -> str:
+    """
+    Resolve the bucket object path of a service class file of a snapshot
+
+    In incremental mode, unchanged files are not uploaded again:
+    the manifest then refers to the snapshot holding the file.
+    """
+    entry = snapshot.Manifest.get(service_class_name, None)
+    ts = entry.Timestamp if entry is not None else snapshot.Timestamp
+    extension = FORMATS[snapshot.Format].extension
+    return f"{project}/{ts}/{service_class_name}{extension}"
+
+
+#
+# The files of a snapshot other than the service class files
+#
+SNAPSHOT_FILES = ["config.json", "manifest.json", "timings.json",
+                  "findings.json"]
+
+
+def get_local_files(base_path: str) -> Dict[str, str]:
+    """
+    The files of a snapshot directory, in a local copy of the bucket,
+    and their paths: the members of its archive, if any, included
+    """
+    files: Dict[str, str] = {
+        name: f"{base_path}/{name}"
+        for name in sorted(os.listdir(base_path))
+        if name != ARCHIVE_FILE and os.path.isfile(f"{base_path}/{name}")
+    } if os.path.isdir(base_path) else {}
+
+    files.update(get_members(base_path))
+    return files
+
+
+def load_local_json(base_path: str, name: str) -> Union[dict, None]:
+    """
+    A JSON file of a snapshot directory, also from its archive
+    """
+    path = get_local_files(base_path).get(name, None)
+    if path is None:
+        return None
+    with open_binary(path) as f:
+        return json.load(f)
+
+
+def get_local_snapshots(root: str,
+                        project: Union[str, None] = None
+                        ) -> List[Tuple[str, str]]:
+    """
+    The (project, timestamp) of the complete snapshots i.e. holding
+    a 'config.json' or an archive, in a local copy of the bucket,
+    oldest first
+    """
+    projects = [project] if project is not None else sorted(
+        name for name in os.listdir(root)
+        if os.path.isdir(f"{root}/{name}"))
+
+    snapshots: List[Tuple[str, str]] = []
+    for _project in projects:
+        if not os.path.isdir(f"{root}/{_project}"):
+            continue
+        for ts in sorted(os.listdir(f"{root}/{_project}")):
+            base_path = f"{root}/{_project}/{ts}"
+            if os.path.exists(f"{base_path}/config.json") or \
+                    os.path.exists(f"{base_path}/{ARCHIVE_FILE}"):
+                snapshots.append((_project, ts))
+    return snapshots
+
+
+def get_local_spec_list_paths(root: str, project: str,
+                              ts: str) -> Dict[str, str]:
+    """
+    The paths of the service class files of a snapshot, in a local
+    copy of the bucket, resolved through the manifest if available
+
+    The paths of the files packed in an archive are those of
+    its members, see `read_spec_dicts`
+    """
+    files = get_local_files(f"{root}/{project}/{ts}")
+
+    if "manifest.json" not in files:
+        return {
+            name.split(".")[0]: path
+            for name, path in files.items()
+            if name not in SNAPSHOT_FILES and not name.startswith("_")
+        }
+
+    manifest: dict = load_local_json(f"{root}/{project}/{ts}",
+                                     "manifest.json") or {}
+
+    paths: Dict[str, str] = {}
+    for name, entry in manifest.items():
+        _files = files if entry["Timestamp"] == ts else \
+            get_local_files(f"{root}/{project}/{entry['Timestamp']}")
+        for fmt in FORMATS.values():
+            path = _files.get(f"{name}{fmt.extension}", None)
+            if path is not None:
+                paths[name] = path
+                break
+        else:
+            warning(f"! Missing file of {name} in snapshot '{ts}' "
+                    f"of project '{project}'")
+    return paths
@@ -0,0 +1,347 @@
+"""
+Streamed listings
+
+`gcloud ... list --page-size N --format json` prints the entries
+of a listing as the pages are retrieved. The output is parsed
+incrementally, one entry at a time, and each spec is written to
+a part file as soon as it is parsed: neither the JSON text nor the
+whole list of specs is ever held in memory.
+
+The store stage then reads the part files back, one entry at a time.
+
+@author: jldupont
+"""
+import os
+import json
+import codecs
+import asyncio
+import logging
+import tempfile
+import subprocess
+from typing import List, Union, Tuple, Iterator, IO
+from pygcloud.models import Result, GCPService  # type: ignore
+from pygcloud.gcp.models import Spec  # type: ignore
+from pygcloud.utils import FlexJSONEncoder  # type: ignore
+from cmds import get_cmd_list, get_cmd_args, parse_inventory_result, \
+    Listing, STATUS_OK, STATUS_FAILED, CHUNK_SIZE, DEFAULT_TIMEOUT
+from models import ServiceClassConfig
+from store import get_temp_dir
+from timings import span
+
+
+error = logging.error
+debug = logging.debug
+
+WHITESPACE = " \t\r\n"
+
+
+class JsonArrayParser:
+    """
+    Incremental parser of a JSON array of objects
+
+    The text is fed in chunks of any size: the entries
+    completed by each chunk are returned.
+    """
+
+    def __init__(self):
+        self._decoder = json.JSONDecoder()
+        self._utf8 = codecs.getincrementaldecoder("utf-8")()
+        self._buffer = ""
+        self._started = False
+        self.done = False
+
+    def feed(self, data: bytes) -> List[dict]:
+        self._buffer += self._utf8.decode(data)
+        return self._parse()
+
+    def close(self):
+        self._buffer += self._utf8.decode(b"", final=True)
+        self._parse()
+        if not self.done and (self._started or self._buffer.strip()):
+            raise ValueError("Truncated JSON array")
+
+    def _parse(self) -> List[dict]:
+        entries: List[dict] = []
+        buffer = self._buffer
+        index = 0
+
+        while not self.done:
+            while index < len(buffer) and buffer[index] in WHITESPACE:
+                index += 1
+            if index == len(buffer):
+                break
+
+            char = buffer[index]
+
+            if not self._started:
+                if char != "[":
+                    raise ValueError(f"Expected a JSON array, got: {char!r}")
+                self._started = True
+                index += 1
+                continue
+
+            if char == "]":
+                self.done = True
+                index += 1
+                break
+
+            if char == ",":
+                index += 1
+                continue
+
+            try:
+                entry, end = self._decoder.raw_decode(buffer, index)
+            except json.JSONDecodeError:
+                #
+                # The entry is not complete yet
+                #
+                break
+
+            entries.append(entry)
+            index = end
+
+        self._buffer = buffer[index:]
+        return entries
+
+
+class RawSpec:
+    """
+    An entry read back from a part file: already sanitized
+    through its `Spec` class
+    """
+
+    __slots__ = ["_dic"]
+
+    def __init__(self, dic: dict):
+        self._dic = dic
+
+    def to_dict(self) -> dict:
+        return self._dic
+
+
+class StreamedListing:
+    """
+    The specs of a listing, held in a part file
+
+    Not a `Listing`: the specs are only read, one at a time,
+    when iterated over. The part file is deleted once it
+    has been read through.
+    """
+
+    def __init__(self, path: str, count: int, status: str = STATUS_OK):
+        self.path = path
+        self.count = count
+        self.status = status
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __iter__(self) -> Iterator[RawSpec]:  # type: ignore
+        try:
+            with open(self.path, "r") as f:
+                for line in f:
+                    yield RawSpec(json.loads(line))
+        finally:
+            discard_part(self.path)
+
+
+def discard_part(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def new_part(project: str) -> Tuple[str, IO[str]]:
+    base_dir = f"{get_temp_dir()}/_parts/{project}"
+    os.makedirs(base_dir, exist_ok=True)
+    fd, path = tempfile.mkstemp(suffix=".ndjson", dir=base_dir)
+    return path, os.fdopen(fd, "w")
+
+
+class PartWriter:
+    """
+    Parses the output of a listing and writes its specs to a part file
+    """
+
+    def __init__(self, project: str, service_class: GCPService):
+        self.spec_class: Spec = service_class.SPEC_CLASS  # type: ignore
+        self.parser = JsonArrayParser()
+        self.encoder = FlexJSONEncoder()
+        self.path, self.file = new_part(project)
+        self.count = 0
+        self.size = 0
+
+    def feed(self, data: bytes):
+        self.size += len(data)
+        for entry in self.parser.feed(data):
+            spec = self.spec_class.from_obj(entry)
+            self.file.write(self.encoder.encode(spec.to_dict()))
+            self.file.write("\n")
+            self.count += 1
+
+    def close(self):
+        self.file.close()
+        self.parser.close()
+
+
+def finish(service_class: GCPService,
+           location: Union[str, None],
+           writer: PartWriter,
+           code: int,
+           stderr: str,
+           failure: Union[Exception, None]
+           ) -> Union[Listing, StreamedListing]:
+    """
+    The listing held in the part file, or the empty listing
+    with the status of the failure
+
+    A process killed following a parsing failure exits with
+    a negative code: the parsing failure is then reported.
+    """
+    name = service_class.__name__
+
+    if code > 0 or (code < 0 and failure is None):
+        discard_part(writer.path)
+        result = Result(success=False, message=stderr.strip(), code=code)
+        return parse_inventory_result(service_class, location, result)
+
+    if failure is not None:
+        discard_part(writer.path)
+        error(f"! Failed to parse entries related to {name}: {failure}")
+        return Listing(status=STATUS_FAILED)
+
+    return StreamedListing(writer.path, writer.count)
+
+
+def get_args(project: str,
+             service_class: GCPService,
+             location: Union[str, None],
+             page_size: int,
+             selection: Union[ServiceClassConfig, None],
+             argv: Union[Tuple[str, ...], None]) -> List[str]:
+    """
+    The command compiled in the plan, else built
+    """
+    if argv:
+        return list(argv)
+    return get_cmd_args(get_cmd_list(project, service_class, location,
+                                     page_size=page_size,
+                                     selection=selection))
+
+
+def get_inventory_streamed(project: str,
+                           service_class: GCPService,
+                           location: Union[str, None] = None,
+                           page_size: int = 0,
+                           selection: Union[ServiceClassConfig, None] = None,
+                           argv: Union[Tuple[str, ...], None] = None
+                           ) -> Union[Listing, StreamedListing]:
+    """
+    Same contract as `cmds.get_inventory`
+    """
+    args: List[str] = get_args(project, service_class, location,
+                               page_size, selection, argv)
+    debug(f"exec streamed: {args}")
+
+    with span("list", project, service_class.__name__, location) as _span:
+
+        writer = PartWriter(project, service_class)
+        failure: Union[Exception, None] = None
+
+        #
+        # stderr goes to a file: only stdout is read as it is produced
+        #
+        with tempfile.TemporaryFile() as errors, \
+                subprocess.Popen(args, stdout=subprocess.PIPE,
+                                 stderr=errors) as proc:
+
+            assert proc.stdout is not None
+
+            try:
+                while chunk := proc.stdout.read1(CHUNK_SIZE):  # type: ignore
+                    writer.feed(chunk)
+                writer.close()
+            except Exception as e:
+                failure = e
+                proc.kill()
+                writer.file.close()
+
+            code = proc.wait()
+            errors.seek(0)
+            stderr = errors.read().decode()
+
+        listing = finish(service_class, location, writer,
+                         code, stderr, failure)
+        _span.Entries = len(listing)
+        _span.Bytes = writer.size
+        _span.Status = listing.status
+
+    return listing
+
+
+async def get_inventory_streamed_async(project: str,
+                                       service_class: GCPService,
+                                       location: Union[str, None] = None,
+                                       page_size: int = 0,
+                                       timeout: float = DEFAULT_TIMEOUT,
+                                       selection: Union[ServiceClassConfig,
+                                                        None] = None,
+                                       argv: Union[Tuple[str, ...],
+                                                   None] = None
+                                       ) -> Union[Listing, StreamedListing]:
+    """
+    Same as `get_inventory_streamed` but the `gcloud` process
+    is driven by the running event loop
+    """
+    args: List[str] = get_args(project, service_class, location,
+                               page_size, selection, argv)
+    debug(f"exec streamed async: {args}")
+
+    with span("list", project, service_class.__name__, location) as _span:
+
+        writer = PartWriter(project, service_class)
+        failure: Union[Exception, None] = None
+        stderr = ""
+
+        proc = await asyncio.create_subprocess_exec(
+            *args,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE)
+
+        assert proc.stdout is not None
+        assert proc.stderr is not None
+
+        async def _stdout():
+            while chunk := await proc.stdout.read(CHUNK_SIZE):
+                writer.feed(chunk)
+            writer.close()
+
+        async def _stderr() -> bytes:
+            return await proc.stderr.read()
+
+        try:
+            _, data = await asyncio.wait_for(
+                asyncio.gather(_stdout(), _stderr()), timeout)
+            stderr = data.decode()
+            code = await proc.wait()
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            writer.file.close()
+            stderr = f"Timeout after {timeout}s: {' '.join(args)}"
+            code = -1
+        except Exception as e:
+            proc.kill()
+            await proc.wait()
+            writer.file.close()
+            failure = e
+            code = -1
+
+        listing = finish(service_class, location, writer,
+                         code, stderr, failure)
+        _span.Entries = len(listing)
+        _span.Bytes = writer.size
+        _span.Status = listing.status
+
+    return listing
@@ -0,0 +1,155 @@
+"""
+@author: jldupont
+"""
+import json
+import pytest
+import store
+from models import Config, Snapshot, ManifestEntry
+from archive import ARCHIVE_FILE, TAIL_SIZE, pack, read_toc, open_binary, \
+    split_member_path, parse_trailer
+from store import store_spec_list, get_spec_list_path, read_spec_dicts, \
+    get_local_snapshots, get_local_spec_list_paths, load_local_json, \
+    load_archive_member, FORMATS
+
+
+def write(path, data: bytes):
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def test_pack_and_read_members(tmp_path):
+    write(tmp_path / "a", b"first")
+    write(tmp_path / "b", b"")
+    write(tmp_path / "c", b"third")
+    path = f"{tmp_path}/{ARCHIVE_FILE}"
+
+    members = pack(path, [("a", f"{tmp_path}/a"), ("b", f"{tmp_path}/b"),
+                          ("c", f"{tmp_path}/c")])
+
+    assert members == {"a": {"Offset": 0, "Size": 5},
+                       "b": {"Offset": 5, "Size": 0},
+                       "c": {"Offset": 5, "Size": 5}}
+    assert read_toc(path) == members
+
+    assert split_member_path(f"{path}/c") == (path, "c")
+    assert split_member_path(f"{tmp_path}/c") is None
+
+    with open_binary(f"{path}/c") as f:
+        assert f.read(2) == b"th"
+        assert f.read() == b"ird"
+    with open_binary(f"{path}/b") as f:
+        assert f.read() == b""
+
+    with pytest.raises(FileNotFoundError):
+        open_binary(f"{path}/d")
+
+
+@pytest.mark.parametrize("name", ["json", "ndjson.gz"])
+def test_read_spec_dicts_from_member(tmp_path, name, fake_spec, temp_dir):
+    fmt = FORMATS[name]
+    specs = [fake_spec(name=f"e{index}") for index in range(3)]
+
+    store_spec_list("p", f"archive-{name}", "Fake", iter(specs), fmt)
+    file_path = get_spec_list_path("p", f"archive-{name}", "Fake", fmt)
+    write(tmp_path / "config.json", b"{}")
+
+    path = f"{tmp_path}/{ARCHIVE_FILE}"
+    pack(path, [("config.json", f"{tmp_path}/config.json"),
+                (f"Fake{fmt.extension}", file_path)])
+
+    assert list(read_spec_dicts(f"{path}/Fake{fmt.extension}")) == \
+        [spec.kw for spec in specs]
+
+
+def read_toc_size(data: bytes) -> int:
+    return parse_trailer(data)[1]
+
+
+def make_snapshot(root, ts, members: dict, manifest: dict):
+    base_path = root / "p" / ts
+    base_path.mkdir(parents=True)
+
+    files = []
+    for name, content in dict(members, **{
+            "manifest.json": json.dumps(manifest),
+            "config.json": "{}"}).items():
+        write(base_path / f"_{name}", content.encode())
+        files.append((name, f"{base_path}/_{name}"))
+    pack(f"{base_path}/{ARCHIVE_FILE}", files)
+
+    for _, file_path in files:
+        (base_path / file_path.split("/")[-1]).unlink()
+
+
+def test_local_snapshots_with_archives(tmp_path):
+    make_snapshot(tmp_path, "ts1", {"A.json": '[{"name": "a"}]',
+                                    "B.json": '[{"name": "b1"}]'},
+                  {"A": {"Hash": "h1", "Timestamp": "ts1"},
+                   "B": {"Hash": "h2", "Timestamp": "ts1"}})
+    make_snapshot(tmp_path, "ts2", {"B.json": '[{"name": "b2"}]'},
+                  {"A": {"Hash": "h1", "Timestamp": "ts1"},
+                   "B": {"Hash": "h3", "Timestamp": "ts2"}})
+
+    assert get_local_snapshots(str(tmp_path)) == [("p", "ts1"), ("p", "ts2")]
+    assert load_local_json(f"{tmp_path}/p/ts2", "manifest.json")["B"] == \
+        {"Hash": "h3", "Timestamp": "ts2"}
+
+    paths = get_local_spec_list_paths(str(tmp_path), "p", "ts2")
+
+    assert paths == {
+        "A": f"{tmp_path}/p/ts1/{ARCHIVE_FILE}/A.json",
+        "B": f"{tmp_path}/p/ts2/{ARCHIVE_FILE}/B.json",
+    }
+    assert list(read_spec_dicts(paths["A"])) == [{"name": "a"}]
+    assert list(read_spec_dicts(paths["B"])) == [{"name": "b2"}]
+
+
+@pytest.mark.parametrize("count", [3, 3000])
+def test_load_archive_member_range_reads(tmp_path, monkeypatch, count):
+    write(tmp_path / "empty", b"")
+    write(tmp_path / "timings.json", b'{"Spans": []}')
+    path = f"{tmp_path}/{ARCHIVE_FILE}"
+    pack(path, [(f"M{index:05d}", f"{tmp_path}/empty")
+                for index in range(count)] +
+         [("timings.json", f"{tmp_path}/timings.json")])
+
+    with open(path, "rb") as f:
+        data = f.read()
+
+    ranges = []
+
+    def fake_range(project, bucket, object_path, byte_range):
+        assert object_path == f"p/ts/{ARCHIVE_FILE}"
+        ranges.append(byte_range)
+        start, end = byte_range.split("-")
+        if start == "":
+            return data[-int(end):]
+        return data[int(start):int(end) + 1]
+
+    monkeypatch.setattr(store, "cat_object_range", fake_range)
+    config = Config(TargetBucket="b", TargetBucketProject="bp",
+                    Schedule=None)
+
+    assert load_archive_member(config, "p", "ts", "timings.json") == \
+        b'{"Spans": []}'
+    assert load_archive_member(config, "p", "ts", "other") is None
+    #
+    # The table of contents is read along the trailer
+    # unless it is larger than the tail
+    #
+    large = read_toc_size(data) > TAIL_SIZE
+    assert large == (count > 3)
+    assert len(ranges) == (5 if large else 3)
+
+
+def test_previous_timings_from_archive(monkeypatch):
+    previous = Snapshot(Timestamp="ts", Archive=True,
+                        Manifest={"A": ManifestEntry("h", "ts")})
+
+    monkeypatch.setattr(store, "load_archive_member",
+                        lambda config, project, ts, name:
+                        b'{"Spans": []}' if name == "timings.json" else None)
+
+    assert store.load_previous_timings(Config(Schedule=None), "p",
+                                       previous) == \
+        {"Spans": []}
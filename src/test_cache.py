@@ -0,0 +1,41 @@
+"""
+@author: jldupont
+"""
+import time
+from models import Config
+from cache import NegativeCache, load_services_cache, save_services_cache
+
+
+def test_negative_cache_record():
+    cache = NegativeCache(ttl=60)
+
+    cache.record("CloudScheduler", "l1", unavailable=True)
+    assert cache.is_unavailable("CloudScheduler", "l1")
+    assert not cache.is_unavailable("CloudScheduler", "l2")
+
+    cache.record("CloudScheduler", "l1", unavailable=False)
+    assert not cache.is_unavailable("CloudScheduler", "l1")
+
+
+def test_negative_cache_expiry():
+    cache = NegativeCache(ttl=60, entries={
+        "CloudScheduler@l1": time.time() - 1,
+        "TasksQueues@l1": time.time() + 60,
+    })
+
+    assert not cache.is_unavailable("CloudScheduler", "l1")
+    assert cache.is_unavailable("TasksQueues", "l1")
+    assert list(cache.to_dict()) == ["TasksQueues@l1"]
+
+
+def test_services_cache(tmp_path):
+    config = Config(CacheDir=str(tmp_path), ServicesCacheTtl=60,
+                    Schedule=None)
+
+    assert load_services_cache(config, "p") is None
+
+    save_services_cache(config, "p", ["PubsubTopic", "CloudRun"])
+    assert load_services_cache(config, "p") == ["PubsubTopic", "CloudRun"]
+
+    config.ServicesCacheTtl = 0
+    assert load_services_cache(config, "p") is None
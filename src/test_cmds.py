@@ -0,0 +1,90 @@
+"""
+@author: jldupont
+"""
+import sys
+import asyncio
+from pygcloud.core import GCloud
+from pygcloud.gcp.catalog import lookup
+from models import ServiceClassConfig
+from cmds import exec_async, get_cmd_args, get_cmd_list, \
+    resolve_target_projects
+
+
+#
+# 'gcloud projects list': by folder or label, failing for folder 'bad'
+#
+FAKE_GCLOUD = """#!/usr/bin/env python3
+import sys, json
+query = sys.argv[sys.argv.index("--filter") + 1]
+assert query.endswith(" AND lifecycleState=ACTIVE"), query
+if "parent.id=bad" in query:
+    sys.stderr.write("PERMISSION_DENIED")
+    sys.exit(1)
+projects = {
+    "parent.type=folder AND parent.id=f1": ["a", "b"],
+    "labels.env=prod": ["b", "c"],
+}[query[:-len(" AND lifecycleState=ACTIVE")]]
+print(json.dumps([{"projectId": project} for project in projects]))
+"""
+
+
+def python(*args) -> GCloud:
+    return GCloud("-c", *args, cmd=sys.executable, exit_on_error=False)
+
+
+def test_get_cmd_args():
+    cmd = GCloud("storage", "ls", "--project", "p", cmd="gcloud")
+    assert get_cmd_args(cmd) == ["gcloud", "storage", "ls", "--project", "p"]
+
+
+def test_exec_async_success():
+    cmd = python("print('[' + ','.join(['1'] * 100000) + ']')")
+    result = asyncio.run(exec_async(cmd))
+
+    assert result.success
+    assert len(result.message) == 2 * 100000 + 1
+
+
+def test_exec_async_failure():
+    cmd = python("import sys; sys.exit('INVALID_ARGUMENT: Location')")
+    result = asyncio.run(exec_async(cmd))
+
+    assert not result.success
+    assert result.code == 1
+    assert "INVALID_ARGUMENT: Location" in result.message
+
+
+def test_exec_async_timeout():
+    cmd = python("import time; time.sleep(10)")
+    result = asyncio.run(exec_async(cmd, timeout=0.2))
+
+    assert not result.success
+    assert "Timeout" in result.message
+
+
+def test_get_cmd_list_selection():
+    selection = ServiceClassConfig(Filter="state=ENABLED",
+                                   Fields=["name", "schedule"])
+
+    cmd = get_cmd_list("p", lookup("CloudScheduler"), "l1",
+                       selection=selection)
+
+    args = get_cmd_args(cmd)
+    assert args[args.index("--filter") + 1] == "state=ENABLED"
+    assert args[args.index("--format") + 1] == \
+        "json(name,schedule,retryConfig,state,timeZone)"
+
+
+def test_resolve_target_projects(fake_gcloud):
+    fake_gcloud(FAKE_GCLOUD)
+
+    assert resolve_target_projects("x; folder:f1;label:env=prod;a;") == \
+        ["x", "a", "b", "c"]
+
+
+def test_resolve_target_projects_failure(fake_gcloud, caplog):
+    fake_gcloud(FAKE_GCLOUD)
+
+    assert resolve_target_projects("folder:bad;label:env=prod") == \
+        ["b", "c"]
+    assert "Failed to resolve projects from 'folder:bad'" in caplog.text
@@ -0,0 +1,74 @@
+"""
+@author: jldupont
+"""
+import time
+import pytest
+from models import Config
+import proc_deploy
+from proc_deploy import preflight, DeployError, run_batch
+
+
+FAKE_GCLOUD = """#!/bin/sh
+sleep 0.5
+case "$1 $2" in
+  "projects describe")
+    echo '{"name": "p", "projectId": "p", "projectNumber": "123",
+           "lifecycleState": "ACTIVE", "parent": {}}' ;;
+  "run jobs") echo '{}' ;;
+  *) echo "NOT_FOUND" >&2; exit 1 ;;
+esac
+"""
+
+
+def get_config(**kwargs) -> Config:
+    return Config(Schedule=None, ProjectId="p", JobRegion="r",
+                  TargetBucket="b", TargetBucketProject="p", **kwargs)
+
+
+def test_preflight(fake_gcloud):
+    fake_gcloud(FAKE_GCLOUD)
+    config = get_config()
+
+    start = time.perf_counter()
+    with pytest.raises(DeployError) as exc:
+        preflight(config)
+    elapsed = time.perf_counter() - start
+
+    assert config.ProjectNumber == "123"
+    assert len(exc.value.failures) == 1
+    assert "bucket 'b'" in exc.value.failures[0]
+    #
+    # The checks run concurrently
+    #
+    assert elapsed < 1.5
+
+
+def test_preflight_reports_all_failures(fake_gcloud):
+    fake_gcloud(FAKE_GCLOUD)
+    config = get_config(ServiceAccountEmail="sa@p.iam.gserviceaccount.com")
+
+    with pytest.raises(DeployError) as exc:
+        preflight(config)
+
+    assert len(exc.value.failures) == 2
+    assert "service account" in exc.value.failures[1]
+
+
+def test_run_batch_reports_all_failures(monkeypatch, caplog):
+    def deploy(config):
+        if config.ProjectId == "p1":
+            raise DeployError("p1", ["bucket 'b' not found"])
+        if config.ProjectId == "p2":
+            raise RuntimeError("boom")
+
+    monkeypatch.setattr(proc_deploy, "safe_get_config",
+                        lambda path: Config(Schedule=None, ProjectId=path))
+    monkeypatch.setattr(proc_deploy, "deploy", deploy)
+
+    with pytest.raises(SystemExit) as exc:
+        run_batch(["p1", "p2", "p3"])
+
+    assert exc.value.code == 1
+    assert "Project 'p1': bucket 'b' not found" in caplog.text
+    assert "Project 'p2': RuntimeError('boom')" in caplog.text
+    assert "Failed to deploy to 2 project(s)" in caplog.text
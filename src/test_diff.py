@@ -0,0 +1,84 @@
+"""
+@author: jldupont
+"""
+import json
+import pytest
+from gcp_inventory import Commands
+from diff import diff_values, diff_snapshots, resolve_timestamps
+
+
+def write(path, obj):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(obj))
+
+
+def test_diff_values():
+    old = {"name": "a", "labels": {"env": "dev"}, "ports": [80, 443]}
+    new = {"name": "a", "labels": {"env": "prod", "team": "x"},
+           "ports": [80]}
+
+    assert diff_values(old, new) == [
+        {"Path": "labels.env", "Old": "dev", "New": "prod"},
+        {"Path": "labels.team", "New": "x"},
+        {"Path": "ports[1]", "Old": 443},
+    ]
+
+
+def test_diff_snapshots(tmp_path):
+    write(tmp_path / "p/ts1/config.json", {})
+    write(tmp_path / "p/ts1/manifest.json", {
+        "PubsubTopic": {"Hash": "h1", "Timestamp": "ts1"},
+        "UrlMap": {"Hash": "u1", "Timestamp": "ts1"},
+    })
+    write(tmp_path / "p/ts1/PubsubTopic.json", [
+        {"name": "t1", "labels": {"env": "dev"}},
+        {"name": "t2"},
+    ])
+    write(tmp_path / "p/ts1/UrlMap.json", [{"selfLink": "u"}])
+
+    write(tmp_path / "p/ts2/config.json", {})
+    write(tmp_path / "p/ts2/manifest.json", {
+        "PubsubTopic": {"Hash": "h2", "Timestamp": "ts2"},
+        "UrlMap": {"Hash": "u1", "Timestamp": "ts1"},
+    })
+    write(tmp_path / "p/ts2/PubsubTopic.json", [
+        {"labels": {"env": "prod"}, "name": "t1"},
+        {"name": "t3"},
+    ])
+    write(tmp_path / "p/latest.json", {"Timestamp": "ts2"})
+
+    old_ts, new_ts = resolve_timestamps(str(tmp_path), "p", None, None)
+    assert (old_ts, new_ts) == ("ts1", "ts2")
+
+    with pytest.raises(ValueError, match="No snapshot 'ts9'"):
+        resolve_timestamps(str(tmp_path), "p", "ts9", None)
+    with pytest.raises(ValueError, match="No snapshot 'ts9'"):
+        resolve_timestamps(str(tmp_path), "p", None, "ts9")
+
+    report = diff_snapshots(str(tmp_path), "p", old_ts, new_ts)
+
+    assert report["ServiceClasses"] == {
+        "PubsubTopic": {
+            "Added": ["t3"],
+            "Removed": ["t2"],
+            "Changed": [{"Id": "t1", "Changes": [
+                {"Path": "labels.env", "Old": "dev", "New": "prod"}]}],
+        }
+    }
+
+
+def test_diff_command_aborts_without_snapshot(tmp_path, caplog):
+    with pytest.raises(SystemExit):
+        Commands().diff(str(tmp_path), "p")
+
+    assert "No snapshot found for project 'p'" in caplog.text
+
+
+def test_resolve_numeric_timestamps(tmp_path):
+    for ts in ["1999", "2000"]:
+        write(tmp_path / f"p/{ts}/config.json", {})
+
+    assert resolve_timestamps(str(tmp_path), "p", 1999, 2000) == \
+        ("1999", "2000")
+    assert resolve_timestamps(str(tmp_path), "p", None, 2000) == \
+        ("1999", "2000")
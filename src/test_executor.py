@@ -0,0 +1,134 @@
+"""
+@author: jldupont
+"""
+import time
+import random
+from executor import execute, get_tasks, get_execution_order
+from plan import compile_plan
+
+
+class Located:
+    LISTING_REQUIRES_LOCATION = True
+
+
+class Global:
+    LISTING_REQUIRES_LOCATION = False
+
+
+def fake_listing(task):
+    time.sleep(random.random() / 100)
+    return [f"{task.Project}/{task.ServiceClass.__name__}/{task.Location}"]
+
+
+def get_plan(projects_services, locations, skip=None):
+    return compile_plan(projects_services, locations, skip=skip,
+                        with_argv=False)
+
+
+def test_get_tasks():
+    assert get_tasks(Global, "a;b") == [(Global, None)]
+    assert get_tasks(Located, "a;b") == [(Located, "a"), (Located, "b")]
+
+
+def by_group(result):
+    return sorted(result, key=lambda item: (item[0], item[1].__name__))
+
+
+def test_execute_is_merged_like_sequential():
+    services = [Located, Global]
+
+    result = list(execute(get_plan([("p", services)], "l1;l2;l3"),
+                          fake_listing,
+                          max_concurrency=4))
+
+    assert by_group(result) == by_group([
+        ("p", Located, ["p/Located/l1", "p/Located/l2", "p/Located/l3"]),
+        ("p", Global, ["p/Global/None"]),
+    ])
+
+
+def test_execute_projects_share_workers():
+    jobs = [("p1", [Global]), ("p2", [Located, Global])]
+
+    result = list(execute(get_plan(jobs, "l1"), fake_listing,
+                          max_concurrency=3))
+
+    assert by_group(result) == [
+        ("p1", Global, ["p1/Global/None"]),
+        ("p2", Global, ["p2/Global/None"]),
+        ("p2", Located, ["p2/Located/l1"]),
+    ]
+
+
+def test_execute_yields_as_completed():
+    def listing(task):
+        if task.ServiceClass is Located:
+            time.sleep(0.2)
+        return [task.Location]
+
+    plan = get_plan([("p", [Located, Global])], "l1")
+
+    result = list(execute(plan, listing, max_concurrency=2))
+
+    assert result == [("p", Global, [None]), ("p", Located, ["l1"])]
+
+
+async def fake_listing_async(task):
+    import asyncio
+    await asyncio.sleep(random.random() / 100)
+    return [f"{task.Project}/{task.ServiceClass.__name__}/{task.Location}"]
+
+
+def test_execute_asyncio_engine():
+    services = [Global, Located]
+
+    result = list(execute(get_plan([("p", services)], "l1;l2"),
+                          fake_listing_async,
+                          max_concurrency=2, engine="asyncio"))
+
+    assert by_group(result) == [
+        ("p", Global, ["p/Global/None"]),
+        ("p", Located, ["p/Located/l1", "p/Located/l2"]),
+    ]
+
+
+def test_execute_skipped_tasks():
+    plan = get_plan([("p", [Located])], "l1;l2",
+                    skip=lambda project, service_class, location:
+                    location == "l1")
+
+    result = list(execute(plan, fake_listing, max_concurrency=2))
+
+    assert result == [("p", Located, ["p/Located/l2"])]
+
+
+def test_execute_longest_first():
+    started = []
+
+    def listing(task):
+        started.append(task.Location)
+        return [task.Location]
+
+    costs = {"p": {("Located", "l1"): 1.0, ("Located", "l3"): 5.0}}
+    plan = compile_plan([("p", [Located])], "l1;l2;l3", with_argv=False,
+                        costs=costs)
+
+    result = list(execute(plan, listing, max_concurrency=1))
+
+    assert started == ["l3", "l2", "l1"]
+    assert result == [("p", Located, ["l1", "l2", "l3"])]
+
+
+def test_execution_order_without_history():
+    costs = {"p": {("Located", "l1"): 1.0, ("Located", "l2"): 5.0}}
+    plan = compile_plan([("q", [Located]), ("p", [Located])], "l1;l2;l3",
+                        with_argv=False, costs=costs)
+
+    assert [task.key for task in get_execution_order(plan)] == [
+        ("p", "Located", "l2"),
+        ("p", "Located", "l3"),
+        ("p", "Located", "l1"),
+        ("q", "Located", "l1"),
+        ("q", "Located", "l2"),
+        ("q", "Located", "l3"),
+    ]
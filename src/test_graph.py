@@ -0,0 +1,105 @@
+"""
+@author: jldupont
+"""
+import json
+import pytest
+from gcp_inventory import Commands
+from graph import build_graph, get_graph, export
+
+
+def ref(service_type, name, region=None):
+    return {"project": "p", "project_number": None, "region": region,
+            "name": name, "service_type": service_type,
+            "origin_service": None}
+
+
+RESOURCES = {
+    "BackendService": [
+        {"name": ref("backend-services", "bs"),
+         "backends": [{"group": ref("network-endpoint-groups", "neg",
+                                    "us-east1")}],
+         "usedBy": [ref("url-maps", "um")]},
+    ],
+    "NetworkEndpointGroup": [
+        {"name": ref("network-endpoint-groups", "neg", "us-east1")},
+    ],
+    "UrlMap": [
+        {"name": ref("url-maps", "um")},
+    ],
+    "PubsubTopic": [
+        {"name": "projects/p/topics/t"},
+    ],
+    "SchedulerJob": [
+        {"name": "projects/p/locations/l/jobs/j",
+         "description": "d",
+         "pubsubTarget": {"topicName": "projects/p/topics/t"},
+         "serviceAccount": ref("service-accounts", "sa@other")},
+    ],
+    "Repository": [
+        {"name": "d",
+         "spec": {"template": [{"serviceAccount": "sa@p.iam"}]}},
+    ],
+    "ServiceAccount": [
+        {"name": "sa", "email": "sa@p.iam"},
+    ],
+}
+
+
+def test_build_graph():
+    graph = build_graph(RESOURCES)
+    edges = {(graph.nodes[source]["Name"], graph.nodes[target]["Name"],
+              field) for source, target, field in graph.edges}
+
+    assert edges == {
+        ("bs", "neg", "backends.group"),
+        ("um", "bs", "usedBy"),
+        ("j", "t", "pubsubTarget.topicName"),
+        ("j", "sa@other", "serviceAccount"),
+        ("d", "sa", "spec.template.serviceAccount"),
+    }
+
+    externals = [node["Name"] for node in graph.nodes.values()
+                 if node["External"]]
+    assert externals == ["sa@other"]
+
+    topic = "projects/p/topics/t"
+    assert [source for source, _ in graph.incoming[topic]] == \
+        ["projects/p/locations/l/jobs/j"]
+
+
+def write_snapshot(root):
+    for name, entries in RESOURCES.items():
+        path = root / "p/ts1" / f"{name}.json"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps(entries))
+    (root / "p/ts1/config.json").write_text("{}")
+
+
+def test_export(tmp_path):
+    write_snapshot(tmp_path)
+
+    graph = get_graph(str(tmp_path), "p")
+
+    dot = export(graph, "dot")
+    assert dot.startswith("digraph G {")
+    assert dot.count("subgraph cluster_") == 8
+    assert dot.count(" -> ") == 5
+
+    dic = json.loads(export(graph, "json"))
+    assert len(dic["Nodes"]) == 8
+    assert len(dic["Edges"]) == 5
+
+
+def test_graph_command_aborts(tmp_path, caplog):
+    with pytest.raises(SystemExit):
+        Commands().graph(str(tmp_path), "p")
+    assert "No snapshot found for project 'p'" in caplog.text
+
+    write_snapshot(tmp_path)
+    with pytest.raises(SystemExit):
+        Commands().graph(str(tmp_path), "p", format="svg")
+    assert "Invalid graph format: svg" in caplog.text
+
+    with pytest.raises(SystemExit):
+        Commands().graph(str(tmp_path), "p", ts=1999)
+    assert "No snapshot '1999' found for project 'p'" in caplog.text
@@ -0,0 +1,51 @@
+"""
+Import time budget of the entry point of the scheduled executions
+
+@author: jldupont
+"""
+import os
+import sys
+import subprocess
+from typing import Dict
+
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+
+#
+# Cumulated import time of the inventory path, in microseconds.
+# Generous: the point is to catch heavy imports creeping back in.
+#
+IMPORT_BUDGET_US = 1_000_000
+
+NOT_NEEDED = ["fire", "yaml", "croniter", "proc_deploy", "rest"]
+
+
+def get_import_times(code: str) -> Dict[str, int]:
+    """
+    The cumulated import time of each module, from `-X importtime`
+    """
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                          cwd=SRC_DIR, capture_output=True, text=True,
+                          check=True)
+    times: Dict[str, int] = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _self, cumulative, name = line[len("import time:"):].split("|")
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def test_entry_point_imports():
+    times = get_import_times("import gcp_inventory")
+
+    assert "proc_inventory" not in times
+    assert not set(NOT_NEEDED) & set(times)
+
+
+def test_inventory_import_budget():
+    times = get_import_times("import proc_inventory, store; "
+                             "assert store.TEMPDIR is None")
+
+    assert not set(NOT_NEEDED) & set(times)
+    assert times["proc_inventory"] < IMPORT_BUDGET_US
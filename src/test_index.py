@@ -0,0 +1,122 @@
+"""
+@author: jldupont
+"""
+import json
+import pytest
+from gcp_inventory import Commands
+from index import ingest, connect, first_seen, search, query
+
+
+def write(path, obj):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(obj))
+
+
+def make_tree(root):
+    """
+    ts2 references the unchanged PubsubTopic file of ts1
+    """
+    topic = {"name": "projects/p/topics/t1"}
+    jobs = [{"name": f"projects/p/locations/l/jobs/j{index}",
+             "schedule": f"{index} * * * *"} for index in [1, 2]]
+
+    write(root / "p/ts1/config.json", {})
+    write(root / "p/ts1/manifest.json",
+          {"PubsubTopic": {"Hash": "h", "Timestamp": "ts1"}})
+    write(root / "p/ts1/PubsubTopic.json", [topic])
+
+    write(root / "p/ts2/config.json", {})
+    write(root / "p/ts2/manifest.json",
+          {"PubsubTopic": {"Hash": "h", "Timestamp": "ts1"},
+           "CloudScheduler": {"Hash": "h2", "Timestamp": "ts2"}})
+    (root / "p/ts2/CloudScheduler.ndjson").write_text(
+        "\n".join(json.dumps(job) for job in jobs) + "\n")
+
+    #
+    # Incomplete snapshot: no config.json
+    #
+    write(root / "p/ts3/PubsubTopic.json", [topic])
+
+
+def test_ingest_incremental(tmp_path):
+    make_tree(tmp_path / "bucket")
+    db = str(tmp_path / "index.sqlite")
+
+    assert ingest(str(tmp_path / "bucket"), db) == 2
+    assert ingest(str(tmp_path / "bucket"), db) == 0
+
+    conn = connect(db)
+    assert conn.execute("SELECT count(*) FROM resources").fetchone()[0] == 4
+    assert conn.execute("SELECT count(*) FROM documents").fetchone()[0] == 3
+
+
+def test_lookups(tmp_path):
+    make_tree(tmp_path / "bucket")
+    db = str(tmp_path / "index.sqlite")
+    ingest(str(tmp_path / "bucket"), db)
+
+    conn = connect(db)
+
+    assert first_seen(conn, "projects/p/topics/t1") == \
+        ("p", "ts1", "PubsubTopic")
+    assert first_seen(conn, "unknown") is None
+
+    [(project, ts, name, doc)] = search(conn, "CloudScheduler",
+                                        "$.schedule", "2 * * * *")
+    assert (project, ts, name) == ("p", "ts2",
+                                   "projects/p/locations/l/jobs/j2")
+    assert doc["schedule"] == "2 * * * *"
+
+
+def test_query(tmp_path):
+    make_tree(tmp_path / "bucket")
+    db = str(tmp_path / "index.sqlite")
+
+    with pytest.raises(ValueError):
+        query(connect(db))
+
+    ingest(str(tmp_path / "bucket"), db)
+    conn = connect(db)
+
+    def keys(rows):
+        return [(ts, service_class, name)
+                for _, ts, service_class, name, _ in rows]
+
+    assert keys(query(conn)) == [
+        ("ts2", "CloudScheduler", "projects/p/locations/l/jobs/j1"),
+        ("ts2", "CloudScheduler", "projects/p/locations/l/jobs/j2"),
+        ("ts2", "PubsubTopic", "projects/p/topics/t1"),
+    ]
+    assert keys(query(conn, service_class="PubsubTopic", ts="ts1")) == \
+        [("ts1", "PubsubTopic", "projects/p/topics/t1")]
+    assert keys(query(conn, project="p", name="j2")) == \
+        [("ts2", "CloudScheduler", "projects/p/locations/l/jobs/j2")]
+    assert query(conn, name="2") == []
+    assert query(conn, project="other") == []
+
+
+def test_query_command(tmp_path, capsys, caplog):
+    db = str(tmp_path / "index.sqlite")
+
+    with pytest.raises(SystemExit):
+        Commands().query(db)
+    assert "Index database not found" in caplog.text
+
+    make_tree(tmp_path / "bucket")
+    ingest(str(tmp_path / "bucket"), db)
+
+    Commands().query(db, name="t1")
+
+    [line] = capsys.readouterr().out.splitlines()
+    assert json.loads(line) == {
+        "Project": "p", "Timestamp": "ts2", "ServiceClass": "PubsubTopic",
+        "Id": "projects/p/topics/t1",
+        "Resource": {"name": "projects/p/topics/t1"}}
+
+
+def test_index_command_without_directory(tmp_path, caplog):
+    with pytest.raises(SystemExit):
+        Commands().index(str(tmp_path / "nope"), db=str(tmp_path / "x"))
+
+    assert "Directory not found" in caplog.text
+    assert not (tmp_path / "x").exists()
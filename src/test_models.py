@@ -32,3 +32,24 @@ def test_optional_param(config):
 
     assert osa == []
     assert osc == ["--sc", config.Schedule]
+
+
+def test_service_classes_from_environment():
+    config = Config(Schedule=None,
+                    ServiceClasses='{"CloudRun": {"Enabled": "false"}, '
+                                   '"PubsubTopic": {"Fields": "name"}}')
+
+    assert not config.ServiceClasses["CloudRun"].Enabled
+    assert config.ServiceClasses["PubsubTopic"].Fields == ["name"]
+
+
+def test_service_classes_unknown_option():
+    with pytest.raises(ValueError):
+        Config(Schedule=None, ServiceClasses={"CloudRun": {"Field": "x"}})
+
+
+def test_archive_with_several_tasks():
+    assert Config(Schedule=None, Archive="true").Archive
+
+    with pytest.raises(ValueError):
+        Config(Schedule=None, Archive=True, TaskCount=2)
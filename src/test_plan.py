@@ -0,0 +1,110 @@
+"""
+@author: jldupont
+"""
+import json
+import pytest
+import dataclasses
+from pygcloud.gcp.catalog import lookup
+from models import ServiceClassConfig
+from cmds import get_cmd_from_argv, get_cmd_args
+from plan import compile_plan, to_json, get_task_costs, get_estimate
+
+
+def test_compile_plan_order_and_dedup():
+    scheduler = lookup("CloudScheduler")
+    topic = lookup("PubsubTopic")
+
+    plan = compile_plan([("p", [scheduler, topic, scheduler])], "l1;l2;l1")
+
+    assert [task.key for task in plan] == [
+        ("p", "CloudScheduler", "l1"),
+        ("p", "CloudScheduler", "l2"),
+        ("p", "PubsubTopic", None),
+    ]
+
+
+def test_compile_plan_argv():
+    selection = ServiceClassConfig(Filter="state=ENABLED")
+
+    plan = compile_plan([("p", [lookup("CloudScheduler")])], "l1",
+                        page_size=50,
+                        selections={"CloudScheduler": selection})
+
+    argv = plan[0].Argv
+    assert argv[:4] == ("gcloud", "scheduler", "jobs", "list")
+    assert argv[argv.index("--location") + 1] == "l1"
+    assert argv[argv.index("--page-size") + 1] == "50"
+    assert argv[argv.index("--filter") + 1] == "state=ENABLED"
+
+    assert tuple(get_cmd_args(get_cmd_from_argv(argv))) == argv
+
+
+def test_compile_plan_skip_and_immutable():
+    plan = compile_plan([("p", [lookup("CloudScheduler")])], "l1;l2",
+                        skip=lambda project, service_class, location:
+                        location == "l2",
+                        with_argv=False)
+
+    assert [(task.Location, task.Skipped) for task in plan] == \
+        [("l1", False), ("l2", True)]
+    assert plan[0].Argv == ()
+
+    with pytest.raises(dataclasses.FrozenInstanceError):
+        plan[0].Skipped = True
+
+
+def test_to_json():
+    plan = compile_plan([("p", [lookup("PubsubTopic")])], "l1")
+
+    [task] = json.loads(to_json(plan))
+
+    assert task["ServiceClass"] == "PubsubTopic"
+    assert task["Location"] is None
+    assert task["Argv"][:3] == ["gcloud", "pubsub", "topics"]
+
+
+TIMINGS = {"Spans": [
+    {"Name": "list", "ServiceClass": "CloudScheduler", "Location": "l1",
+     "Duration": 1.0},
+    {"Name": "list", "ServiceClass": "CloudScheduler", "Location": "l1",
+     "Duration": 2.0},
+    {"Name": "list", "ServiceClass": "PubsubTopic", "Duration": 9.0},
+    {"Name": "store", "ServiceClass": "PubsubTopic", "Duration": 5.0},
+]}
+
+
+def test_get_task_costs():
+    assert get_task_costs(TIMINGS) == {
+        ("CloudScheduler", "l1"): 3.0,
+        ("PubsubTopic", None): 9.0,
+    }
+
+
+def test_compile_plan_costs():
+    costs = {"p": get_task_costs(TIMINGS)}
+
+    plan = compile_plan([("p", [lookup("CloudScheduler")]),
+                         ("q", [lookup("PubsubTopic")])], "l1;l2",
+                        with_argv=False, costs=costs)
+
+    assert [task.Cost for task in plan] == [3.0, 6.0, None]
+
+
+def test_get_estimate():
+    costs = {"p": {("CloudScheduler", "l1"): 4.0,
+                   ("CloudScheduler", "l2"): 1.0,
+                   ("CloudScheduler", "l3"): 3.0,
+                   ("PubsubTopic", None): 2.0}}
+    plan = compile_plan([("p", [lookup("CloudScheduler"),
+                                lookup("PubsubTopic")])], "l1;l2;l3",
+                        with_argv=False, costs=costs)
+
+    estimate = get_estimate(plan, max_concurrency=2)
+
+    assert estimate["Total"] == 10.0
+    assert estimate["Estimate"] == 5.0
+    assert estimate["Unknown"] == 0
+    assert [cost["Cost"] for cost in estimate["Costs"]] == \
+        [4.0, 3.0, 2.0, 1.0]
+
+    assert get_estimate(plan)["Estimate"] == 10.0
@@ -0,0 +1,139 @@
+"""
+@author: jldupont
+"""
+import json
+import pytest
+from gcp_inventory import Commands
+from policy import Policy, parse_rules, run
+
+
+BUCKETS = [
+    {"name": "b1",
+     "iamConfiguration": {"publicAccessPrevention": "enforced"},
+     "labels": {"env": "prod"}},
+    {"name": "b2",
+     "iamConfiguration": {"publicAccessPrevention": "inherited"}},
+    {"name": "b3"},
+]
+
+RULES = [
+    {"Name": "public-access", "ServiceClass": "StorageBucket",
+     "Field": "iamConfiguration.publicAccessPrevention",
+     "Operator": "ne", "Value": "enforced", "Severity": "HIGH"},
+    {"Name": "env-label", "ServiceClass": "*",
+     "Field": "labels.env", "Operator": "missing"},
+    {"Name": "dev-name", "ServiceClass": "StorageBucket",
+     "Field": "name", "Operator": "matches", "Value": "^b[23]$"},
+]
+
+
+def test_parse_rules_invalid():
+    with pytest.raises(ValueError):
+        parse_rules([{"Name": "x", "ServiceClass": "y", "Field": "z",
+                      "Operator": "gt"}])
+
+    with pytest.raises(ValueError):
+        parse_rules([RULES[0], RULES[0]])
+
+    with pytest.raises(ValueError, match="'x': unknown key.*'Operater'"):
+        parse_rules([{"Name": "x", "ServiceClass": "y", "Field": "z",
+                      "Operater": "eq"}])
+
+    with pytest.raises(ValueError, match="'x': invalid regular expression"):
+        parse_rules([{"Name": "x", "ServiceClass": "y", "Field": "z",
+                      "Operator": "matches", "Value": "[a-"}])
+
+
+def test_evaluate():
+    policy = Policy(parse_rules(RULES))
+
+    findings = [(finding["Rule"], finding["Id"])
+                for finding in policy.evaluate("StorageBucket", BUCKETS)]
+
+    assert findings == [
+        ("public-access", "b2"), ("dev-name", "b2"), ("env-label", "b2"),
+        ("public-access", "b3"), ("dev-name", "b3"), ("env-label", "b3"),
+    ]
+
+    assert policy.evaluate("PubsubTopic", [{"name": "t"}]) == [
+        {"Rule": "env-label", "Severity": "MEDIUM",
+         "ServiceClass": "PubsubTopic", "Id": "t"}]
+
+
+def test_evaluate_lists():
+    policy = Policy(parse_rules([
+        {"Name": "image", "ServiceClass": "CloudRun",
+         "Field": "spec.containers.image", "Operator": "contains",
+         "Value": ":latest"}]))
+
+    entries = [{"name": "s1", "spec": {"containers": [
+        {"image": "a:1"}, {"image": "b:latest"}]}},
+        {"name": "s2", "spec": {"containers": [{"image": "a:1"}]}}]
+
+    assert [finding["Id"] for finding in
+            policy.evaluate("CloudRun", entries)] == ["s1"]
+
+
+def test_run(tmp_path):
+    snapshot = tmp_path / "p/ts1"
+    snapshot.mkdir(parents=True)
+    (snapshot / "config.json").write_text("{}")
+    (snapshot / "StorageBucket.json").write_text(json.dumps(BUCKETS))
+
+    rules = tmp_path / "policy.yaml"
+    rules.write_text("Rules:\n"
+                     "  - Name: public-access\n"
+                     "    ServiceClass: StorageBucket\n"
+                     "    Field: iamConfiguration.publicAccessPrevention\n"
+                     "    Operator: in\n"
+                     "    Value: [inherited]\n")
+
+    report = run(str(tmp_path), "p", str(rules))
+
+    assert report["Timestamp"] == "ts1"
+    assert json.loads((snapshot / "findings.json").read_text()) == report
+    assert [finding["Id"] for finding in report["Findings"]] == ["b2"]
+
+
+def test_policy_command_aborts(tmp_path, caplog):
+    rules = tmp_path / "policy.yaml"
+    rules.write_text("Rules:\n"
+                     "  - Name: x\n"
+                     "    ServiceClass: StorageBucket\n"
+                     "    Field: name\n"
+                     "    Operator: gt\n")
+
+    with pytest.raises(SystemExit):
+        Commands().policy(str(tmp_path), "p", str(rules))
+    assert "No snapshot found for project 'p'" in caplog.text
+
+    (tmp_path / "p/ts1").mkdir(parents=True)
+    (tmp_path / "p/ts1/config.json").write_text("{}")
+
+    with pytest.raises(SystemExit):
+        Commands().policy(str(tmp_path), "p", str(rules))
+    assert "invalid operator: gt" in caplog.text
+
+
+VALID = "    Value: b1\n"
+
+
+@pytest.mark.parametrize("rules, extra, ts, message", [
+    ("missing.yaml", VALID, None, "Policy rules file not found"),
+    ("policy.yaml", "    Valeu: b1\n", None, "unknown key(s): ['Valeu']"),
+    ("policy.yaml", "    Operator: matches\n    Value: '[a-'\n", None,
+     "invalid regular expression"),
+    ("policy.yaml", VALID, 1999, "No snapshot '1999' found for project 'p'"),
+])
+def test_policy_command_aborts_on_input(tmp_path, caplog, rules, extra, ts,
+                                        message):
+    (tmp_path / "p/ts1").mkdir(parents=True)
+    (tmp_path / "p/ts1/config.json").write_text("{}")
+    (tmp_path / "policy.yaml").write_text("Rules:\n"
+                                          "  - Name: x\n"
+                                          "    ServiceClass: StorageBucket\n"
+                                          "    Field: name\n" + extra)
+
+    with pytest.raises(SystemExit):
+        Commands().policy(str(tmp_path), "p", str(tmp_path / rules), ts)
+    assert message in caplog.text
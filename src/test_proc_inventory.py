@@ -0,0 +1,187 @@
+"""
+@author: jldupont
+"""
+import os
+import json
+import time
+import pytest
+import uploader as uploader_module
+from pygcloud.models import Result
+from models import Config, Snapshot, ManifestEntry
+from uploader import Uploader
+from store import store_spec_list, get_spec_list_path, FORMATS
+from cache import save_services_cache, load_services_cache
+from proc_inventory import get_manifest_entry, store_listings, \
+    finalize_project, run
+
+BENCH_DIR = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "bench")
+
+
+class Service:
+    """
+    Stands for a pygcloud service class
+    """
+    LISTING_REQUIRES_LOCATION = False
+
+
+class FakeUploader:
+
+    def __init__(self):
+        self.objects = []
+
+    def submit(self, project, file_path, object_path, content_type=None,
+               content_encoding=None):
+        self.objects.append(object_path)
+
+
+def store(fake_spec, ts, name, fmt=FORMATS["json"]):
+    return store_spec_list("p", ts, "Service", iter([fake_spec(name=name)]),
+                           fmt)
+
+
+def test_unchanged_file_references_previous_snapshot(fake_spec, temp_dir):
+    digest = store(fake_spec, "ts2", "a")
+    previous = Snapshot(Timestamp="ts1",
+                        Manifest={"Service": ManifestEntry(digest, "ts1")})
+
+    entry = get_manifest_entry("p", "Service", digest,
+                               Snapshot(Timestamp="ts2"), previous)
+
+    assert entry == ManifestEntry(digest, "ts1")
+    assert not os.path.exists(get_spec_list_path("p", "ts2", "Service"))
+
+
+def test_changed_file_gets_new_entry(fake_spec, temp_dir):
+    digest = store(fake_spec, "ts2", "b")
+    previous = Snapshot(Timestamp="ts1",
+                        Manifest={"Service": ManifestEntry("other", "ts1")})
+
+    entry = get_manifest_entry("p", "Service", digest,
+                               Snapshot(Timestamp="ts2"), previous)
+
+    assert entry == ManifestEntry(digest, "ts2")
+    assert os.path.exists(get_spec_list_path("p", "ts2", "Service"))
+
+
+@pytest.mark.parametrize("previous", [
+    Snapshot(Timestamp="ts1", Format="ndjson"),
+    Snapshot(Timestamp="ts1", Archive=True),
+])
+def test_no_reference_across_layouts(previous, fake_spec, temp_dir):
+    digest = store(fake_spec, "ts2", "a")
+    previous.Manifest = {"Service": ManifestEntry(digest, "ts1")}
+
+    entry = get_manifest_entry("p", "Service", digest,
+                               Snapshot(Timestamp="ts2"), previous)
+
+    assert entry == ManifestEntry(digest, "ts2")
+
+
+def test_only_changed_files_are_uploaded(fake_spec, temp_dir):
+    digest = store(fake_spec, "ts1", "a")
+    previous = Snapshot(Timestamp="ts1",
+                        Manifest={"Service": ManifestEntry(digest, "ts1")})
+
+    class Changed(Service):
+        pass
+
+    snapshots = {"p": Snapshot(Timestamp="ts2")}
+    uploader = FakeUploader()
+
+    store_listings(iter([("p", Service, [fake_spec(name="a")]),
+                         ("p", Changed, [fake_spec(name="c")])]),
+                   snapshots, {"p": previous}, uploader, FORMATS["json"])
+
+    manifest = snapshots["p"].Manifest
+    assert manifest["Service"] == ManifestEntry(digest, "ts1")
+    assert manifest["Changed"].Timestamp == "ts2"
+    assert uploader.objects == ["p/ts2/Changed.json"]
+
+
+def test_latest_is_uploaded_last(monkeypatch, fake_spec, temp_dir):
+    names = ["A", "B", "C"]
+    uploaded = []
+
+    def upload_object(config, file_path, object_path, content_type=None,
+                      content_encoding=None):
+        #
+        # The service class files take longer to upload
+        #
+        if os.path.basename(object_path)[:-len(".json")] in names:
+            time.sleep(0.05)
+        uploaded.append(object_path)
+        return Result(success=True, message="", code=0)
+
+    monkeypatch.setattr(uploader_module, "upload_object", upload_object)
+
+    config = Config(TargetBucket="b", TargetBucketProject="bp",
+                    Schedule=None)
+    snapshot = Snapshot(Timestamp="ts")
+    uploader = Uploader(config, max_workers=4)
+
+    store_listings(iter([("p", type(name, (Service,), {}),
+                          [fake_spec(name=name)]) for name in names]),
+                   {"p": snapshot}, {}, uploader, FORMATS["json"])
+    finalize_project(config, "p", snapshot, uploader)
+    uploader.close()
+
+    assert sorted(uploaded[:3]) == [f"p/ts/{name}.json" for name in names]
+    assert uploaded[3:] == ["p/ts/manifest.json", "p/ts/timings.json",
+                            "p/ts/config.json", "p/latest.json"]
+
+
+def test_services_enabled_since_cached(tmp_path, monkeypatch, temp_dir):
+    bucket = tmp_path / "bucket"
+    monkeypatch.setenv("FAKEGCLOUD", json.dumps({
+        "services": ["pubsub.googleapis.com",
+                     "cloudscheduler.googleapis.com"],
+        "entries": 2,
+        "bucket": str(bucket)}))
+    monkeypatch.setenv("PATH", f"{BENCH_DIR}{os.pathsep}"
+                               f"{os.environ['PATH']}")
+    monkeypatch.delenv("CLOUD_RUN_TASK_COUNT", raising=False)
+    for name, value in {"TARGETPROJECTID": "p", "TARGETLOCATIONS": "l0",
+                        "TARGETBUCKET": "b", "TARGETBUCKETPROJECT": "b",
+                        "SERVICESCACHETTL": "3600", "NEGATIVECACHETTL": "0",
+                        "CACHEDIR": str(tmp_path / "cache")}.items():
+        monkeypatch.setenv(name, value)
+
+    #
+    # CloudScheduler was enabled since the cache was written
+    #
+    config = Config(CacheDir=str(tmp_path / "cache"), Schedule=None)
+    save_services_cache(config, "p", ["PubsubTopic"])
+
+    run()
+
+    latest = json.loads((bucket / "b/p/latest.json").read_text())
+    ts = latest["Timestamp"]
+    assert latest["ServiceClasses"] == ["CloudScheduler", "PubsubTopic"]
+    assert (bucket / f"b/p/{ts}/CloudScheduler.json").exists()
+    assert sorted(load_services_cache(config, "p")) == \
+        ["CloudScheduler", "PubsubTopic"]
+
+
+def test_run_span_is_persisted(monkeypatch, temp_dir):
+    from timings import reset, span
+
+    monkeypatch.setattr(uploader_module, "upload_object",
+                        lambda *args: Result(success=True, message="",
+                                             code=0))
+    config = Config(TargetBucket="b", TargetBucketProject="bp",
+                    Schedule=None)
+    uploader = Uploader(config)
+
+    reset()
+    with span("list", "p", "Service"):
+        time.sleep(0.01)
+    finalize_project(config, "p", Snapshot(Timestamp="ts"), uploader)
+    uploader.close()
+
+    with open(f"{temp_dir}/p/ts/timings.json") as f:
+        timings = json.load(f)
+
+    run_span = timings["Spans"][-1]
+    assert (run_span["Name"], run_span["Project"]) == ("run", "p")
+    assert run_span["Duration"] >= timings["Spans"][0]["Duration"] > 0
@@ -0,0 +1,94 @@
+"""
+@author: jldupont
+"""
+import asyncio
+import pytest
+import ratelimit
+from pygcloud.gcp.catalog import lookup
+from ratelimit import TokenBucket, Limiter, get_api, is_retryable
+from cmds import get_inventory, get_inventory_async, STATUS_OK, \
+    STATUS_FAILED
+
+
+#
+# Throttled on the first 2 calls
+#
+FAKE_GCLOUD = """#!/bin/sh
+count=$(cat "$0.count" 2>/dev/null || echo 0)
+echo $((count + 1)) > "$0.count"
+if [ "$count" -lt 2 ]; then
+  echo "ERROR: (gcloud) RESOURCE_EXHAUSTED: Quota exceeded" >&2
+  exit 1
+fi
+echo '[]'
+"""
+
+
+def test_is_retryable():
+    assert is_retryable("RESOURCE_EXHAUSTED: Quota exceeded for quota metric")
+    assert is_retryable("", 429)
+    assert not is_retryable("INVALID_ARGUMENT: Location")
+    assert not is_retryable("PERMISSION_DENIED")
+
+
+def test_is_retryable_http_status():
+    assert is_retryable("HTTPError 429: Too many requests")
+    assert is_retryable('{"error": {"code": 429, "status": "UNAVAILABLE"}}')
+    assert is_retryable("HTTP/1.1 429")
+    assert not is_retryable("NOT_FOUND: projects/p/instances/vm-429")
+    assert not is_retryable("Listed 429 items, HTTPError 503")
+
+
+def test_get_api():
+    assert get_api(lookup("CloudRun")) == "run"
+    assert get_api(lookup("UrlMap")) == "compute"
+
+
+def test_token_bucket():
+    bucket = TokenBucket(rate=10, burst=2)
+
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == pytest.approx(0.1, abs=0.01)
+    assert bucket.reserve() == pytest.approx(0.2, abs=0.01)
+
+
+def test_limiter_backoff():
+    limiter = Limiter(max_retries=2, backoff_base=1, backoff_max=3)
+    service_class = lookup("PubsubTopic")
+
+    assert 0 <= limiter.backoff("p", service_class, 0) <= 1
+    assert 0 <= limiter.backoff("p", service_class, 1) <= 2
+    assert limiter.backoff("p", service_class, 2) is None
+
+    assert limiter.get_retries("p") == {"PubsubTopic": 2}
+    assert limiter.get_retries("other") == {}
+
+
+def test_limiter_deadline():
+    limiter = Limiter(rate=1, burst=1, deadline=0.5)
+    service_class = lookup("PubsubTopic")
+
+    assert limiter.reserve(service_class) == 0
+    assert limiter.reserve(service_class) is None
+
+
+def test_get_inventory_retries(fake_gcloud, monkeypatch):
+    fake_gcloud(FAKE_GCLOUD)
+    monkeypatch.setattr(ratelimit, "LIMITER", Limiter(backoff_base=0.01))
+
+    listing = get_inventory("p", lookup("PubsubTopic"))
+
+    assert listing.status == STATUS_OK
+    assert ratelimit.get_limiter().get_retries("p") == {"PubsubTopic": 2}
+
+
+def test_get_inventory_async_retries_exhausted(fake_gcloud, monkeypatch):
+    fake_gcloud(FAKE_GCLOUD)
+    monkeypatch.setattr(ratelimit, "LIMITER",
+                        Limiter(max_retries=1, backoff_base=0.01))
+
+    listing = asyncio.run(get_inventory_async("p", lookup("PubsubTopic")))
+
+    assert listing.status == STATUS_FAILED
+    assert ratelimit.get_limiter().get_retries("p") == {"PubsubTopic": 1}
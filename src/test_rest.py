@@ -0,0 +1,178 @@
+"""
+End to end tests of the REST backend against a local fake API server
+
+@author: jldupont
+"""
+import json
+import threading
+import pytest
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+from pygcloud.gcp.catalog import lookup
+from rest import Session, list_items, get_inventory_rest, configure, \
+    upload_object, ENDPOINTS
+
+
+def address(name: str, region: str) -> dict:
+    return {
+        "name": name,
+        "address": "10.0.0.1",
+        "addressType": "INTERNAL",
+        "ipVersion": "IPV4",
+        "selfLink": "https://www.googleapis.com/compute/v1/projects/p"
+                    f"/regions/{region}/addresses/{name}",
+    }
+
+
+PAGES = {
+    "/v1/projects/p/topics": {
+        "": {"topics": [{"name": "projects/p/topics/t1"}],
+             "nextPageToken": "page2"},
+        "page2": {"topics": [{"name": "projects/p/topics/t2"}]},
+    },
+    "/compute/v1/projects/p/aggregated/addresses": {
+        "": {"items": {
+                "regions/r1": {"addresses": [address("a1", "r1")]},
+                "regions/r2": {"warning": {"code": "NO_RESULTS_ON_PAGE"}},
+             },
+             "nextPageToken": "page2"},
+        "page2": {"items": {
+                "regions/r3": {"addresses": [address("a2", "r3")]},
+             }},
+    },
+    "/apis/serving.knative.dev/v1/namespaces/p/services": {
+        "": {"items": [{"metadata": {"name": "s1"}}],
+             "metadata": {"continue": "page2"}},
+        "page2": {"items": [{"metadata": {"name": "s2"}}],
+                  "metadata": {}},
+    },
+}
+
+
+class FakeApi(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+    clients: set = set()
+    uploads: list = []
+
+    def do_GET(self):
+        self.clients.add(self.client_address)
+
+        parts = urlsplit(self.path)
+        query = parse_qs(parts.query)
+        token = (query.get("pageToken", None) or
+                 query.get("continue", None) or [""])[0]
+
+        if "/locations/" in parts.path:
+            status = 400
+            body = {"error": {"code": 400, "status": "INVALID_ARGUMENT",
+                              "message": "Location unknown"}}
+        else:
+            status = 200
+            body = PAGES[parts.path][token]
+
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        length = int(self.headers["Content-Length"])
+        self.uploads.append((self.path, self.headers["Content-Type"],
+                             self.rfile.read(length)))
+
+        data = b"{}"
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def base_url():
+    FakeApi.clients = set()
+    FakeApi.uploads = []
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeApi)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def test_pagination_over_single_connection(base_url):
+    session = Session(base_url=base_url, token="token")
+
+    items = list(list_items(session, ENDPOINTS["PubsubTopic"], "p"))
+
+    assert [item["name"] for item in items] == \
+        ["projects/p/topics/t1", "projects/p/topics/t2"]
+    assert len(FakeApi.clients) == 1
+
+
+def test_knative_pagination(base_url):
+    session = Session(base_url=base_url, token="token")
+
+    items = list(list_items(session, ENDPOINTS["CloudRun"], "p"))
+
+    assert [item["metadata"]["name"] for item in items] == ["s1", "s2"]
+
+
+def test_aggregated_listing(base_url):
+    configure(base_url, token="token")
+
+    specs = get_inventory_rest("p", lookup("ServicesAddress"))
+
+    assert [spec.name for spec in specs] == ["a1", "a2"]
+
+
+def test_location_not_available(base_url):
+    configure(base_url, token="token")
+
+    specs = get_inventory_rest("p", lookup("CloudScheduler"), "nowhere")
+
+    assert specs == []
+
+
+def test_upload_object(base_url, tmp_path):
+    configure(base_url, token="token")
+    path = tmp_path / "PubsubTopic.ndjson.gz"
+    path.write_bytes(b"\x1f\x8bcontent")
+
+    result = upload_object("bucket", str(path), "p/ts/PubsubTopic.ndjson.gz",
+                           "application/x-ndjson", "gzip")
+
+    assert result.success
+    [(url, content_type, body)] = FakeApi.uploads
+    assert url == "/upload/storage/v1/b/bucket/o?uploadType=multipart"
+    assert content_type.startswith("multipart/related; boundary=")
+    assert b'"contentEncoding": "gzip"' in body
+    assert b'"name": "p/ts/PubsubTopic.ndjson.gz"' in body
+    assert b"\x1f\x8bcontent" in body
+
+
+def test_fallback_to_gcloud_listing(monkeypatch):
+    import rest
+    from models import ServiceClassConfig
+    calls = []
+
+    def fake_listing(project, service_class, location, **kw):
+        calls.append(kw)
+        return []
+
+    monkeypatch.setattr(rest, "_get_inventory", fake_listing)
+    selection = ServiceClassConfig(Filter="state=ENABLED")
+    service_class = lookup("StorageBucket")
+    assert service_class.__name__ not in ENDPOINTS
+
+    get_inventory_rest("p", service_class, None, page_size=50,
+                       selection=selection)
+
+    assert calls == [{"exit_on_error": False, "backend": "gcloud",
+                      "page_size": 50, "selection": selection,
+                      "argv": None}]
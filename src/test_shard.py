@@ -0,0 +1,206 @@
+"""
+@author: jldupont
+"""
+import pytest
+import cmds
+import shard as shard_module
+from pygcloud.models import Result
+from models import Config, Shard, ExecutionPlan, Snapshot, ManifestEntry
+from shard import get_shard, get_costs, partition, get_work, merge_markers, \
+    merge_negative_entries, claim_plan, finalize_shard
+
+
+def test_get_shard(monkeypatch):
+    monkeypatch.delenv("CLOUD_RUN_TASK_COUNT", raising=False)
+    assert get_shard() is None
+
+    monkeypatch.setenv("CLOUD_RUN_TASK_COUNT", "3")
+    monkeypatch.setenv("CLOUD_RUN_TASK_INDEX", "2")
+    monkeypatch.setenv("CLOUD_RUN_EXECUTION", "job-abc")
+    assert get_shard() == Shard(Index=2, Count=3, Execution="job-abc")
+
+
+def test_get_costs():
+    timings = {"Spans": [
+        {"Name": "list", "ServiceClass": "A", "Duration": 1.5},
+        {"Name": "list", "ServiceClass": "A", "Duration": 0.5},
+        {"Name": "parse", "ServiceClass": "A", "Duration": 9},
+        {"Name": "list", "ServiceClass": "B", "Duration": 1},
+    ]}
+    assert get_costs(timings) == {"A": 2.0, "B": 1.0}
+
+
+def test_partition():
+    costs = {("p", "A"): 7, ("p", "B"): 5, ("p", "C"): 4,
+             ("p", "D"): 3, ("p", "E"): 1}
+
+    shards = partition(costs, 2)
+
+    assert shards == [[("p", "A"), ("p", "D")],
+                      [("p", "B"), ("p", "C"), ("p", "E")]]
+    assert partition(dict(reversed(list(costs.items()))), 2) == shards
+
+
+def test_get_work():
+    plan = ExecutionPlan(Timestamp="ts",
+                         Services={"p1": ["A", "B", "C"], "p2": ["A", "D"]},
+                         Costs={"p1": {"A": 10, "B": 2}})
+
+    works = [get_work(plan, Shard(Index=index, Count=3, Execution="e"))
+             for index in range(3)]
+
+    assigned = sorted((project, name) for work in works
+                      for project, names in work.items() for name in names)
+    assert assigned == [("p1", "A"), ("p1", "B"), ("p1", "C"),
+                        ("p2", "A"), ("p2", "D")]
+    assert works[0] == {"p1": ["A"], "p2": []}
+
+
+def test_merge_markers():
+    def marker(index, name, started, elapsed):
+        snapshot = Snapshot(Timestamp="ts", ServiceClasses=[name],
+                            Manifest={name: ManifestEntry(Hash=name,
+                                                          Timestamp="ts")},
+                            Retries={name: index},
+                            Failed=[name] if index else [])
+        return {"Index": index,
+                "Snapshot": snapshot.to_dict(),
+                "Timings": {"Started": started, "Elapsed": elapsed,
+                            "Spans": [{"Name": "list",
+                                       "ServiceClass": name}]}}
+
+    snapshot, timings = merge_markers([marker(1, "B", 100.5, 2),
+                                       marker(0, "A", 100, 1)])
+
+    assert snapshot.ServiceClasses == ["A", "B"]
+    assert list(snapshot.Manifest) == ["A", "B"]
+    assert snapshot.Retries == {"A": 0, "B": 1}
+    assert snapshot.Failed == ["B"]
+    assert timings["Started"] == 100
+    assert timings["Elapsed"] == 2.5
+    assert [span["Shard"] for span in timings["Spans"]] == [0, 1]
+
+
+def test_merge_negative_entries():
+    def marker(names, negative):
+        return {"Snapshot": Snapshot(ServiceClasses=names).to_dict(),
+                "Negative": negative}
+
+    #
+    # Both tasks start from A@l1 & C@l1: the first lists A, now
+    # available in l1, and the second lists B, unavailable in l2
+    #
+    merged = merge_negative_entries([
+        marker(["A"], {"C@l1": 10.0}),
+        marker(["B"], {"A@l1": 10.0, "B@l2": 20.0, "C@l1": 10.0}),
+    ])
+
+    assert merged == {"B@l2": 20.0, "C@l1": 10.0}
+    assert merge_negative_entries([marker(["A"], None)]) is None
+
+
+class FakeBucket:
+    """
+    The objects of the bucket, created only if they do not exist
+    as with '--if-generation-match=0'
+    """
+
+    def __init__(self):
+        self.objects = {}
+
+    def create_object(self, project, bucket, file_path, object_path):
+        if object_path in self.objects:
+            return Result(success=False, message="Precondition", code=1)
+        return self.upload(file_path, object_path)
+
+    def upload(self, file_path, object_path):
+        with open(file_path) as f:
+            self.objects[object_path] = f.read()
+        return Result(success=True, message="", code=0)
+
+    def cat_object(self, project, bucket, object_path):
+        if object_path not in self.objects:
+            return Result(success=False, message="Not found", code=1)
+        return Result(success=True, message=self.objects[object_path],
+                      code=0)
+
+    def list_objects(self, project, bucket, prefix):
+        return [path for path in self.objects if path.startswith(prefix)]
+
+
+class BucketUploader:
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+
+    def submit(self, project, file_path, object_path, content_type=None):
+        self.bucket.upload(file_path, object_path)
+
+    def wait(self, project):
+        return True
+
+
+@pytest.fixture
+def bucket(monkeypatch, temp_dir):
+    bucket = FakeBucket()
+    for name in ["create_object", "cat_object", "list_objects"]:
+        monkeypatch.setattr(shard_module, name, getattr(bucket, name))
+    return bucket
+
+
+CONFIG = Config(TargetBucket="b", TargetBucketProject="bp", Schedule=None)
+
+
+def test_create_object_only_if_missing(monkeypatch):
+    calls = []
+
+    class FakeGCloud:
+        def __init__(self, *args, **kw):
+            calls.append(args)
+
+        def __call__(self):
+            return Result(success=True, message="", code=0)
+
+    monkeypatch.setattr(cmds, "GCloud", FakeGCloud)
+
+    assert cmds.create_object("bp", "b", "/tmp/f", "o").success
+    assert "--if-generation-match=0" in calls[0]
+
+
+def test_claim_plan(bucket):
+    shards = [Shard(Index=index, Count=2, Execution="e")
+              for index in range(2)]
+    first = ExecutionPlan(Timestamp="ts1", Services={"p": ["A"]})
+    second = ExecutionPlan(Timestamp="ts2", Services={"p": ["A"]})
+
+    assert claim_plan(CONFIG, shards[1], first) == first
+    #
+    # The claim is lost: the plan of the other task is used
+    #
+    assert claim_plan(CONFIG, shards[0], second) == first
+
+
+def test_finalize_once_all_markers_exist(bucket):
+    uploader = BucketUploader(bucket)
+    shards = [Shard(Index=index, Count=2, Execution="e")
+              for index in range(2)]
+
+    def finalize(shard, name):
+        snapshot = Snapshot(Timestamp="ts", ServiceClasses=[name])
+        timings = {"Started": 0, "Elapsed": 1, "Spans": []}
+        return finalize_shard(CONFIG, "p", snapshot, timings, uploader,
+                              shard, {f"{name}@l": 1e12})
+
+    assert finalize(shards[0], "A") is None
+    assert "p/ts/_shards/finalize" not in bucket.objects
+
+    snapshot, timings, negative = finalize(shards[1], "B")
+
+    assert snapshot.ServiceClasses == ["A", "B"]
+    assert negative == {"A@l": 1e12, "B@l": 1e12}
+    assert bucket.objects["p/ts/_shards/finalize"] == "1"
+
+    #
+    # Another task seeing all the markers loses the claim
+    #
+    assert finalize(shards[0], "A") is None
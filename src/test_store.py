@@ -0,0 +1,39 @@
+"""
+@author: jldupont
+"""
+import pytest
+from models import Snapshot, ManifestEntry
+from store import get_object_path, store_spec_list, get_spec_list_path, \
+    read_spec_dicts, FORMATS
+
+
+def test_snapshot_manifest_roundtrip():
+    snapshot = Snapshot(Timestamp="ts2", ServiceClasses=["A", "B"],
+                        Manifest={"A": ManifestEntry("h1", "ts1"),
+                                  "B": ManifestEntry("h2", "ts2")})
+
+    assert Snapshot.from_json(snapshot.to_json()) == snapshot
+
+
+def test_get_object_path_resolves_references():
+    snapshot = Snapshot(Timestamp="ts2", ServiceClasses=["A", "B"],
+                        Manifest={"A": ManifestEntry("h1", "ts1")})
+
+    assert get_object_path("p", snapshot, "A") == "p/ts1/A.json"
+    assert get_object_path("p", snapshot, "B") == "p/ts2/B.json"
+
+    snapshot.Format = "ndjson.gz"
+    assert get_object_path("p", snapshot, "A") == "p/ts1/A.ndjson.gz"
+
+
+@pytest.mark.parametrize("name", ["json", "ndjson", "ndjson.gz"])
+def test_output_formats_roundtrip(name, fake_spec, temp_dir):
+    fmt = FORMATS[name]
+    specs = [fake_spec(name="a", value=1), fake_spec(name="b", value=None)]
+
+    digest = store_spec_list("p", name, "Fake", iter(specs), fmt)
+    path = get_spec_list_path("p", name, "Fake", fmt)
+
+    assert path.endswith(f"/Fake{fmt.extension}")
+    assert list(read_spec_dicts(path)) == [spec.kw for spec in specs]
+    assert store_spec_list("p", name, "Fake", iter(specs), fmt) == digest
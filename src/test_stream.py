@@ -0,0 +1,71 @@
+"""
+@author: jldupont
+"""
+import os
+import json
+import pytest
+from pygcloud.models import Result
+from pygcloud.gcp.catalog import lookup
+from stream import JsonArrayParser, get_inventory_streamed
+from store import store_spec_list, get_spec_list_path
+from cmds import parse_inventory_result, STATUS_UNAVAILABLE
+
+ENTRIES = [{"name": f"projects/p/topics/t{index}", "labels": {"k": "é"}}
+           for index in range(50)]
+
+
+def test_parser_any_chunk_size():
+    data = json.dumps(ENTRIES, indent=2).encode()
+
+    for size in [1, 7, 100, len(data)]:
+        parser = JsonArrayParser()
+        entries = []
+        for index in range(0, len(data), size):
+            entries.extend(parser.feed(data[index:index + size]))
+        parser.close()
+
+        assert entries == ENTRIES
+
+
+def test_parser_truncated():
+    parser = JsonArrayParser()
+    parser.feed(b'[{"name": "t1"}, {"na')
+
+    with pytest.raises(ValueError):
+        parser.close()
+
+
+FAKE_GCLOUD = ("#!/usr/bin/env python3\n"
+               "import sys, json\n"
+               "if '--location' in sys.argv:\n"
+               "    sys.stderr.write('INVALID_ARGUMENT: Location x')\n"
+               "    sys.exit(1)\n"
+               f"print(json.dumps({ENTRIES!r}))\n")
+
+
+def test_streamed_identical_to_buffered(fake_gcloud, temp_dir):
+    fake_gcloud(FAKE_GCLOUD)
+    service_class = lookup("PubsubTopic")
+
+    listing = get_inventory_streamed("p", service_class, page_size=10)
+    assert len(listing) == len(ENTRIES)
+    streamed = store_spec_list("p", "ts", "streamed", listing)
+
+    result = Result(success=True, message=json.dumps(ENTRIES), code=0)
+    specs = parse_inventory_result(service_class, None, result)
+    buffered = store_spec_list("p", "ts", "buffered", specs)
+
+    assert streamed == buffered
+    assert not os.path.exists(listing.path)
+    with open(get_spec_list_path("p", "ts", "streamed")) as f:
+        assert len(json.load(f)) == len(ENTRIES)
+
+
+def test_streamed_unavailable_location(fake_gcloud):
+    fake_gcloud(FAKE_GCLOUD)
+    service_class = lookup("CloudScheduler")
+
+    listing = get_inventory_streamed("p", service_class, "x", page_size=10)
+
+    assert listing.status == STATUS_UNAVAILABLE
+    assert list(listing) == []
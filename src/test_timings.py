@@ -0,0 +1,36 @@
+"""
+@author: jldupont
+"""
+import pytest
+from timings import Timings
+
+
+def test_span_counters():
+    timings = Timings()
+
+    with timings.span("list", "p", "PubsubTopic") as span:
+        span.Bytes = 10
+    with timings.span("list", "other", "PubsubTopic"):
+        pass
+
+    dic = timings.to_dict("p")
+
+    [span, run] = dic["Spans"]
+    assert span["Name"] == "list"
+    assert span["Bytes"] == 10
+    assert span["Status"] == "ok"
+    assert span["Duration"] >= 0
+
+    assert (run["Name"], run["Project"], run["Start"]) == ("run", "p", 0)
+    assert run["Duration"] == dic["Elapsed"] >= span["Duration"]
+
+
+def test_span_error():
+    timings = Timings()
+
+    with pytest.raises(ValueError):
+        with timings.span("store", "p", "PubsubTopic"):
+            raise ValueError("boom")
+
+    [span] = timings.spans
+    assert span.Status == "error"
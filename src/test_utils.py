@@ -5,7 +5,7 @@ import pytest
 import os
 from models import Config
 from utils import get_config_from_string, parse_config, \
-    get_config_from_environment
+    get_config_from_environment, spec_list_to_json, write_spec_list_json
 
 
 @pytest.fixture
@@ -38,3 +38,13 @@ def test_config_from_environment():
 
     c = get_config_from_environment()
     assert c.Schedule == "0 */1 * * *"
+
+
+def test_write_spec_list_json_is_identical(fake_spec):
+    specs = [fake_spec(name="a", nested=fake_spec(x=1), items=[1, "é"]),
+             fake_spec(name="b", value=None)]
+
+    for liste in ([], specs[:1], specs):
+        chunks = []
+        write_spec_list_json(iter(liste), chunks.append)
+        assert "".join(chunks) == spec_list_to_json(liste)
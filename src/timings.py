@@ -0,0 +1,97 @@
+"""
+Timing spans of the inventory process
+
+The spans are collected, from all the worker threads, for the
+duration of a run. Each is emitted as a log line when it ends and
+those of a project are written along its snapshot as `timings.json`.
+
+@author: jldupont
+"""
+import time
+import json
+import logging
+import threading
+from contextlib import contextmanager
+from typing import List, Union, Iterator
+from models import Span
+
+
+info = logging.info
+
+
+class Timings:
+    """
+    Thread-safe collector of spans
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self._origin = time.perf_counter()
+        self._lock = threading.Lock()
+        self.spans: List[Span] = []
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self._origin
+
+    @contextmanager
+    def span(self, name: str,
+             project: Union[str, None] = None,
+             service_class: Union[str, None] = None,
+             location: Union[str, None] = None) -> Iterator[Span]:
+        """
+        The span is yielded so that the counters and
+        the status can be filled in by the caller
+        """
+        span = Span(Name=name, Project=project, ServiceClass=service_class,
+                    Location=location, Start=round(self.elapsed(), 6))
+        try:
+            yield span
+        except BaseException:
+            span.Status = "error"
+            raise
+        finally:
+            span.Duration = round(self.elapsed() - span.Start, 6)
+            with self._lock:
+                self.spans.append(span)
+            info(f"> Span {json.dumps(span.to_dict())}")
+
+    def to_dict(self, project: str) -> dict:
+        """
+        The spans of a project, in order of completion, closed by
+        the span of the run up to now i.e. to the finalization of
+        the project: the run itself ends after its files are written
+        """
+        elapsed = round(self.elapsed(), 6)
+        with self._lock:
+            spans = [span.to_dict() for span in self.spans
+                     if span.Project == project]
+        spans.append(Span(Name="run", Project=project, Start=0.0,
+                          Duration=elapsed).to_dict())
+        return {
+            "Started": self.started,
+            "Elapsed": elapsed,
+            "Spans": spans,
+        }
+
+
+TIMINGS = Timings()
+
+
+def reset() -> Timings:
+    """
+    Starts the collection for a new run
+    """
+    global TIMINGS
+    TIMINGS = Timings()
+    return TIMINGS
+
+
+def span(name: str,
+         project: Union[str, None] = None,
+         service_class: Union[str, None] = None,
+         location: Union[str, None] = None):
+    return TIMINGS.span(name, project, service_class, location)
+
+
+def get_timings() -> Timings:
+    return TIMINGS
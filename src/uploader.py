@@ -0,0 +1,103 @@
+"""
+Background uploads of the snapshot files
+
+The service class files are uploaded as soon as they are stored,
+in parallel with the listings still in progress. The files closing
+a snapshot (i.e. config.json then latest.json) are uploaded only once
+all the service class files of the project have been uploaded.
+
+With the 'rest' backend, the objects are uploaded through the
+JSON API over the keep-alive connections of the listings:
+https://cloud.google.com/storage/docs/uploading-objects#uploading-an-object
+
+@author: jldupont
+"""
+import os
+import logging
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import List, Dict, Union
+from pygcloud.models import Result  # type: ignore
+from models import Config
+from cmds import upload_files, STATUS_OK, STATUS_FAILED
+from timings import span
+
+
+info = logging.info
+error = logging.error
+
+
+def upload_object(config: Config,
+                  file_path: str,
+                  object_path: str,
+                  content_type: Union[str, None] = None,
+                  content_encoding: Union[str, None] = None) -> Result:
+
+    if config.Backend == "rest":
+        from rest import upload_object as upload_object_rest
+        return upload_object_rest(config.TargetBucket, file_path,
+                                  object_path, content_type,
+                                  content_encoding)
+
+    #
+    # The local file and the object share the same name
+    #
+    prefix = object_path.rpartition("/")[0]
+    return upload_files(config.TargetBucketProject,
+                        config.TargetBucket,
+                        [file_path], f"{prefix}/",
+                        content_type, content_encoding)
+
+
+class Uploader:
+    """
+    Uploads objects in a pool of worker threads, tracked per project
+    """
+
+    def __init__(self, config: Config, max_workers: int = 1):
+        self._config = config
+        self._pool = ThreadPoolExecutor(max_workers=max_workers)
+        self._futures: Dict[str, List[Future]] = {}
+
+    def _upload(self, project: str, file_path: str, object_path: str,
+                content_type: Union[str, None],
+                content_encoding: Union[str, None]) -> Result:
+
+        info(f"> Uploading: gs://{self._config.TargetBucket}/{object_path}")
+
+        name = os.path.basename(object_path).split(".")[0]
+
+        with span("upload", project, name) as _span:
+            _span.Bytes = os.path.getsize(file_path)
+            result = upload_object(self._config, file_path, object_path,
+                                   content_type, content_encoding)
+            _span.Status = STATUS_OK if result.success else STATUS_FAILED
+
+        if not result.success:
+            error(f"! Failed to upload '{object_path}': {result.message}")
+        return result
+
+    def submit(self, project: str,
+               file_path: str,
+               object_path: str,
+               content_type: Union[str, None] = None,
+               content_encoding: Union[str, None] = None) -> Future:
+
+        future = self._pool.submit(self._upload, project, file_path,
+                                   object_path, content_type,
+                                   content_encoding)
+        self._futures.setdefault(project, []).append(future)
+        return future
+
+    def wait(self, project: str) -> bool:
+        """
+        Wait for the uploads of a project to complete
+
+        Returns True if all succeeded
+        """
+        results: List[Result] = [
+            future.result() for future in self._futures.pop(project, [])
+        ]
+        return all(result.success for result in results)
+
+    def close(self):
+        self._pool.shutdown(wait=True)
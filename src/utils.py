@@ -3,9 +3,10 @@
 """
 import os
 import sys
-import yaml
+import json
+import hashlib
 import logging
-from typing import List
+from typing import List, Iterable, Iterator, Callable
 from dataclasses import fields
 from models import Config
 from pygcloud.gcp.models import Spec  # type: ignore
@@ -73,6 +74,7 @@ def get_config_from_path(path: str = 'config.yaml') -> dict:
 
 def get_config_from_file(path: str = 'config.yaml') -> dict:
 
+    import yaml
     assert isinstance(path, str), print(f"Invalid path: {path}")
 
     with open(path, 'r') as stream:
@@ -85,6 +87,7 @@ def get_config_from_file(path: str = 'config.yaml') -> dict:
 
 
 def get_config_from_string(yaml_str: str) -> dict:
+    import yaml
 
     try:
         result = yaml.load(yaml_str, Loader=yaml.FullLoader)
@@ -121,3 +124,119 @@ def spec_list_to_json(spec_list: List[Spec]) -> str:
     import json
     dics = [spec.to_dict() for spec in spec_list]
     return json.dumps(dics, cls=FlexJSONEncoder)
+
+
+def write_spec_list_json(spec_list: Iterable[Spec],
+                         write: Callable[[str], None]):
+    """
+    Streaming version of `spec_list_to_json`
+
+    The JSON array is emitted one spec at a time: memory is bounded
+    by the largest spec instead of the whole list. The output is
+    identical to that of `spec_list_to_json`.
+    """
+    encoder = FlexJSONEncoder()
+
+    write("[")
+    for index, spec in enumerate(spec_list):
+        if index > 0:
+            write(", ")
+        write(encoder.encode(spec.to_dict()))
+    write("]")
+
+
+def write_spec_list_ndjson(spec_list: Iterable[Spec],
+                           write: Callable[[str], None]):
+    """
+    One JSON document per line (aka NDJSON / JSON Lines)
+    """
+    encoder = FlexJSONEncoder()
+
+    for spec in spec_list:
+        write(encoder.encode(spec.to_dict()))
+        write("\n")
+
+
+class PrunedSpec:
+    """
+    A spec restricted to some of its top level fields
+    """
+
+    __slots__ = ["_spec", "_keys"]
+
+    def __init__(self, spec: Spec, keys: List[str]):
+        self._spec = spec
+        self._keys = keys
+
+    def to_dict(self) -> dict:
+        dic = self._spec.to_dict()
+        return {key: value for key, value in dic.items()
+                if key in self._keys}
+
+
+def prune_spec_list(spec_list: Iterable[Spec],
+                    fields: List[str]) -> Iterator[PrunedSpec]:
+    """
+    fields: e.g. ["name", "labels.env"] retains the 'name'
+            and 'labels' top level fields
+    """
+    keys = list(dict.fromkeys(name.split(".")[0] for name in fields))
+
+    for spec in spec_list:
+        yield PrunedSpec(spec, keys)
+
+
+def is_ref(value) -> bool:
+    """
+    A reference to a resource as serialized by pygcloud
+    i.e. `Ref` with project, region, service_type & name
+    """
+    return isinstance(value, dict) and "service_type" in value \
+        and "name" in value
+
+
+def format_ref(ref: dict) -> str:
+    """
+    e.g. projects/$project/regions/$region/$service_type/$name
+    """
+    project = ref.get("project") or ref.get("project_number") or "-"
+    region = ref.get("region", None)
+    where = "global" if region in [None, "global"] else f"regions/{region}"
+    return f"projects/{project}/{where}/{ref['service_type']}/{ref['name']}"
+
+
+def get_resource_id(dic: dict) -> str:
+    """
+    The stable identity of a resource across snapshots:
+    its selfLink if any, else its name
+
+    Entries without either are identified by their content.
+    """
+    metadata = dic.get("metadata", None)
+    if isinstance(metadata, dict):
+        if metadata.get("selfLink"):
+            return _id(metadata["selfLink"])
+        if metadata.get("name"):
+            return f"{metadata.get('namespace', '')}/{metadata['name']}"
+
+    for key in ["selfLink", "name"]:
+        if dic.get(key):
+            return _id(dic[key])
+
+    return get_canonical_hash(dic)
+
+
+def _id(value) -> str:
+    return format_ref(value) if is_ref(value) else str(value)
+
+
+def get_canonical_json(dic: dict) -> str:
+    """
+    The canonical form i.e. independent of the order of the keys
+    """
+    return json.dumps(dic, sort_keys=True, separators=(",", ":"),
+                      cls=FlexJSONEncoder)
+
+
+def get_canonical_hash(dic: dict) -> str:
+    return hashlib.sha256(get_canonical_json(dic).encode()).hexdigest()